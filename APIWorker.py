@@ -0,0 +1,126 @@
+#
+# Drive a long lived SFMC API helper over stdin/stdout
+#
+# Spawning node for each of update_waypoint_plan.js and deploy_goto_file.js pays for node's
+# startup and an SFMC login while the glider waits on the surface. Instead a helper,
+# apiWorker.js in this directory, is started once in --apiDir and sent one JSON request
+# per line on stdin:
+#
+#   {"id": 1, "script": "update_waypoint_plan.js", "argv": ["osu684", "goto_list.ma"]}
+#
+# and replies with one JSON line per request on stdout:
+#
+#   {"id": 1, "ok": true, "msg": ""}
+#
+# Any other output from the helper is logged. If the helper dies or does not reply in time,
+# it is killed and restarted on the next request. The helper keeps each --apiModule script
+# loaded, so its SFMC session is reused, and runs any other script in a child node, see
+# apiWorker.js for what such a module must export.
+
+import argparse
+import logging
+import json
+import os
+import time
+import selectors
+import subprocess
+from LineFramer import LineFramer
+
+class APIWorker:
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        self.cmd = (args.nodeCommand, args.apiWorker) + tuple(args.apiModule or ())
+        self.timeout = args.apiTimeout
+        self.pipe = None
+        self.framer = None
+        self.id = 0
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Persistent API helper options")
+        grp.add_argument("--apiWorker", type=str, metavar="filename",
+                help="Long lived SFMC API helper, apiWorker.js, relative to --apiDir")
+        grp.add_argument("--apiModule", type=str, action="append", metavar="filename",
+                help="SFMC API script the helper keeps loaded, see apiWorker.js")
+        grp.add_argument("--apiTimeout", type=float, default=60, metavar="seconds",
+                help="How long to wait for the API helper to reply")
+        grp.add_argument("--apiCheck", type=float, default=60, metavar="seconds",
+                help="How often to check the idle API helper is running, restarting it if not")
+
+    def qAlive(self) -> bool:
+        return (self.pipe is not None) and (self.pipe.poll() is None)
+
+    def start(self) -> None:
+        """ Start the helper, if it is not already running, so it is warm for the next goto """
+        if self.qAlive(): return
+        if self.pipe is not None:
+            self.logger.warning("API helper exited, rc=%s, restarting", self.pipe.returncode)
+            self.stop()
+        self.pipe = subprocess.Popen(self.cmd,
+                cwd=self.args.apiDir,
+                shell=False,
+                bufsize=0,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        self.framer = LineFramer(newline=b"\n")
+        self.logger.info("Started API helper %s", " ".join(self.cmd))
+
+    def stop(self) -> None:
+        pipe = self.pipe
+        self.pipe = None
+        if pipe is None: return
+        try:
+            if pipe.poll() is None: pipe.kill()
+            pipe.stdin.close()
+            pipe.stdout.close()
+            pipe.wait()
+        except:
+            self.logger.exception("Error stopping API helper")
+
+    def request(self, script:str, *argv) -> bool:
+        """ Run script with argv in the helper
+            returns True/False for the script's success, or None if the helper failed """
+        logger = self.logger
+        try:
+            self.start()
+            self.id += 1
+            req = {"id": self.id, "script": script, "argv": list(argv)}
+            self.pipe.stdin.write(bytes(json.dumps(req) + "\n", "utf-8"))
+            reply = self.__reply(self.id)
+        except:
+            logger.exception("Error talking to API helper, %s", script)
+            reply = None
+        if reply is None:
+            self.stop() # Restarted on the next request
+            return None
+        if not reply.get("ok", False):
+            logger.error("Error executing %s %s, %s", script, " ".join(argv), reply.get("msg"))
+            return False
+        return True
+
+    def __reply(self, id:int) -> dict:
+        logger = self.logger
+        fd = self.pipe.stdout.fileno()
+        tEnd = time.monotonic() + self.timeout
+        with selectors.DefaultSelector() as sel:
+            sel.register(fd, selectors.EVENT_READ)
+            while True:
+                for line in self.framer.lines():
+                    try:
+                        msg = json.loads(line)
+                    except ValueError:
+                        msg = None
+                    if isinstance(msg, dict) and (msg.get("id") == id):
+                        return msg
+                    logger.info("API helper: %s", str(line, "utf-8", "replace").strip())
+                dt = tEnd - time.monotonic()
+                if (dt <= 0) or not sel.select(dt):
+                    logger.error("API helper did not reply in %s seconds", self.timeout)
+                    return None
+                data = os.read(fd, 65536)
+                if not data:
+                    logger.error("API helper exited, rc=%s", self.pipe.poll())
+                    return None
+                self.framer.put(data)
@@ -0,0 +1,58 @@
+#
+# Drop Iridium retransmits before they are written or forwarded
+#
+# Gateways resend MO messages. Each message is keyed on its header's (MOMSN, cdr), or a
+# hash of the whole message if it has no header, and the most recent keys are kept for
+# each IMEI. A repeat then costs a dictionary lookup rather than two database writes
+# and a forward.
+
+import argparse
+import hashlib
+import threading
+from collections import OrderedDict
+from ParseMessage import headerOffset
+
+class Dedup:
+    """ Bounded memory of recently seen messages per IMEI """
+    def __init__(self, args:argparse.ArgumentParser) -> None:
+        self.perIMEI = args.dedupPerIMEI
+        self.maxIMEI = args.dedupIMEIs
+        self.lock = threading.Lock()
+        self.seen = OrderedDict() # OrderedDict of keys by IMEI, least recent first
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Duplicate suppression options")
+        grp.add_argument("--dedupPerIMEI", type=int, default=64, metavar="count",
+                help="Recent messages remembered per IMEI, 0 to disable duplicate suppression")
+        grp.add_argument("--dedupIMEIs", type=int, default=10000, metavar="count",
+                help="Maximum number of IMEIs remembered")
+
+    @staticmethod
+    def key(msg:bytes) -> tuple:
+        """ (IMEI, key) identifying a message """
+        offset = headerOffset(msg)
+        if offset is None: return (None, hashlib.blake2b(msg, digest_size=16).digest())
+        IMEI = msg[(offset+7):(offset+22)]
+        cdr = msg[(offset+3):(offset+7)]
+        MOMSN = msg[(offset+23):(offset+25)]
+        return (IMEI, MOMSN + cdr)
+
+    def qDuplicate(self, msg:bytes) -> bool:
+        """ Has msg been seen recently? If not, remember it """
+        if (self.perIMEI <= 0) or not msg: return False
+        (IMEI, key) = self.key(msg)
+        with self.lock:
+            keys = self.seen.get(IMEI)
+            if keys is None:
+                keys = OrderedDict()
+                self.seen[IMEI] = keys
+                if len(self.seen) > self.maxIMEI: self.seen.popitem(last=False)
+            else:
+                self.seen.move_to_end(IMEI)
+            if key in keys:
+                keys.move_to_end(key)
+                return True
+            keys[key] = None
+            if len(keys) > self.perIMEI: keys.popitem(last=False)
+            return False
@@ -12,6 +12,7 @@ import argparse
 import queue
 import sqlite3
 from Update import Update
+from Trace import Trace
 from MyBaseThread import MyBaseThread
 
 class MyPattern:
@@ -85,10 +86,10 @@ patterns = [
         ] 
 
 class Dialog(MyBaseThread):
-    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger):
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger, sinks:list = None):
         MyBaseThread.__init__(self, "Dialog", args, logger)
         self.__queue = queue.Queue()
-        self.__update = Update(args, logger)
+        self.__update = Update(args, logger, sinks)
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
@@ -134,7 +135,8 @@ class Dialog(MyBaseThread):
                     for key in info:
                         cur.execute(sql, (t, key, info[key]))
                     db.commit()
-                    if "FLAG" in info: update.put(t, args.gliderDB)
+                    if "FLAG" in info:
+                        update.put(t, args.gliderDB, Trace(args, logger, args.glider, t))
                     break
                 q.task_done()
             except queue.Empty:
@@ -153,8 +155,9 @@ class Dialog(MyBaseThread):
         sql+= "    val FLOAT, -- value of the field\n"
         sql+= "    PRIMARY KEY (t,name) -- Retain each t/name pair\n"
         sql+= ");"
-        db = sqlite3.connect(dbName)
+        db = sqlite3.connect(dbName, timeout=self.args.gliderTimeout)
         cur = db.cursor()
+        cur.execute("PRAGMA journal_mode=WAL;") # So Update's reads and these writes don't block
         cur.execute(sql)
         return db
 
@@ -6,8 +6,10 @@
 
 import argparse
 import logging
-import sqlite3
+import time
 import MyLogger
+import Partitions
+from FixRing import RingReader
 from datetime import datetime, timezone
 import numpy as np
 import pandas as pd
@@ -46,6 +48,14 @@ class Drifter:
         grp = parser.add_argument_group(description="Drifter options")
         grp.add_argument("--drifterDB", type=str, required=True, metavar="filename",
                 help="Drifter database name")
+        grp.add_argument("--drifterMonths", type=int, default=2, metavar="count",
+                help="Number of monthly partitions to search, if the database is partitioned")
+        grp.add_argument("--drifterTimeout", type=float, default=5, metavar="seconds",
+                help="How long to wait for the writer's lock on the drifter database")
+        grp.add_argument("--drifterRing", type=str, metavar="name",
+                help="Shared memory fix ring to read fixes from first, see FixRing.py")
+        grp.add_argument("--drifterRingAge", type=float, default=3600, metavar="seconds",
+                help="Use the database if the ring's newest fix is older than this")
         grp.add_argument("--drifterNBack", type=int, default=10, metavar="count",
                 help="Number of samples in the past to use in calculation")
         grp.add_argument("--drifterTau", type=float, default=60, metavar="minutes",
@@ -54,27 +64,59 @@ class Drifter:
                 help="Earliest time to fetch")
         grp.add_argument("--IMEI", type=str, help="Drifter's IMEI to work with")
 
+    def __fromRing(self) -> tuple:
+        """ Fixes from the shared memory ring, or None if it doesn't hold enough """
+        args = self.args
+        try:
+            recs = RingReader.get(args.drifterRing).fixes(self.IMEI)
+        except:
+            self.logger.exception("Unable to read fix ring %s", args.drifterRing)
+            return None
+        (secs, index) = np.unique(recs["t"], return_index=True) # Last written of each time
+        recs = recs[index][::-1] # Newest first
+        if args.drifterTearliest is not None:
+            tEarliest = args.drifterTearliest.replace(tzinfo=timezone.utc).timestamp()
+            recs = recs[recs["t"] >= tEarliest]
+        if len(recs) < args.drifterNBack: return None # Maybe the listener just started
+        if recs["t"][0] < (time.time() - args.drifterRingAge):
+            self.logger.info("Fix ring's newest fix for %s is stale, using the database",
+                    self.IMEI)
+            return None # Maybe the listener is not running, and the database is newer
+        recs = recs[:args.drifterNBack]
+        data = pd.DataFrame({
+            "t": pd.to_datetime(recs["t"], unit="s"),
+            "lat": recs["lat"],
+            "lon": recs["lon"],
+            "accuracy": recs["accuracy"],
+            })
+        return (datetime.fromtimestamp(recs["t"][0], tz=timezone.utc), data)
+
     def __fetch(self) -> tuple:
-        with sqlite3.connect(self.args.drifterDB) as conn:
-            cur = conn.cursor()
-            cur.execute(self.sql, self.vals)
-            data = None
-            tMax = None
-            for row in cur:
-                t = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S+00:00")
-                t = t.replace(tzinfo=timezone.utc)
-                a = [t, row[1], row[2], row[3]]
-                b = pd.DataFrame(a, index=['t', 'lat', 'lon', 'accuracy']).transpose()
-                b['t'] = b['t'].astype('datetime64[ns]')
-                b['lat'] = b['lat'].astype('float64')
-                b['lon'] = b['lon'].astype('float64')
-                b['accuracy'] = b['accuracy'].astype('float64')
-                if data is None:
-                    data = b
-                    tMax = t
-                else:
-                    data = data.append(b, ignore_index=True)
-            return (tMax, data)
+        args = self.args
+        if args.drifterRing is not None:
+            result = self.__fromRing()
+            if result is not None: return result
+        # Read only, and kept open between estimates, see Partitions.reader
+        conn = Partitions.reader(args.drifterDB, args.drifterMonths, timeout=args.drifterTimeout)
+        cur = conn.cursor()
+        cur.execute(self.sql, self.vals)
+        data = None
+        tMax = None
+        for row in cur:
+            t = datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S+00:00")
+            t = t.replace(tzinfo=timezone.utc)
+            a = [t, row[1], row[2], row[3]]
+            b = pd.DataFrame(a, index=['t', 'lat', 'lon', 'accuracy']).transpose()
+            b['t'] = b['t'].astype('datetime64[ns]')
+            b['lat'] = b['lat'].astype('float64')
+            b['lon'] = b['lon'].astype('float64')
+            b['accuracy'] = b['accuracy'].astype('float64')
+            if data is None:
+                data = b
+                tMax = t
+            else:
+                data = data.append(b, ignore_index=True)
+        return (tMax, data)
 
     def estimate(self, t:datetime) -> pd.DataFrame:
         """ Do a weighted linear regression on recent fixes
@@ -0,0 +1,262 @@
+#
+# Serve recent fixes as JSON over HTTP, from memory
+#
+# The Writer gives each committed MOM row to the FixCache, which keeps every IMEI's fixes
+# from the last --fixApiHours, so partners' and dashboards' queries don't touch the
+# database unless they ask for older fixes. Each response has an ETag, so a client polling
+# with If-None-Match gets a 304 until something changes, and a track's since lets a client
+# fetch only the fixes it has not seen. Times are ISO 8601 or seconds since the epoch.
+#
+#  GET /latest                           latest fix for every IMEI
+#  GET /latest/<IMEI>                    latest fix for one IMEI
+#  GET /track/<IMEI>?since=t&until=t     fixes after since, default --fixApiHours ago,
+#                                        and at or before until, default the latest
+
+import argparse
+import logging
+import bisect
+import json
+import threading
+import time
+import urllib.parse
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import Partitions
+from ParseMessage import jsonable
+from MyBaseThread import MyBaseThread
+from Metrics import metrics
+
+apiHist = metrics.histogram("api_seconds", "Time to answer an API request")
+apiNotModified = metrics.counter("api_not_modified_total", "API requests answered with a 304")
+apiDB = metrics.counter("api_database_total", "API requests which needed the database")
+
+def mkTime(s:str) -> datetime:
+    """ ISO 8601 or seconds since the epoch, UTC unless a zone is given """
+    try:
+        t = datetime.fromtimestamp(float(s), tz=timezone.utc)
+    except ValueError:
+        t = datetime.fromisoformat(s)
+    return t if t.tzinfo is not None else t.replace(tzinfo=timezone.utc)
+
+def fetch(conn, sql:str, vals:list):
+    """ MOM rows as dictionaries, with times stored as text parsed """
+    cur = conn.execute(sql, vals)
+    names = list(map(lambda x: x[0], cur.description))
+    for row in cur:
+        fix = dict(zip(names, row))
+        for key in ("t", "tRecv", "tSession"):
+            if isinstance(fix.get(key), str): fix[key] = datetime.fromisoformat(fix[key])
+        yield fix
+
+class Track:
+    """ One IMEI's fixes in time order """
+    def __init__(self, floor:datetime) -> None:
+        self.times = []
+        self.fixes = []
+        self.floor = floor # Every fix at or after this is here
+        self.version = 0 # Cache version when this last changed
+
+class FixCache:
+    """ Recent fixes by IMEI """
+    def __init__(self, args:argparse.ArgumentParser) -> None:
+        self.window = timedelta(hours=args.fixApiHours)
+        self.maxFixes = args.fixApiMaxFixes
+        self.lock = threading.Lock()
+        self.tracks = {}
+        self.version = 0 # Incremented on every change
+        self.boot = int(time.time()) # So ETags from before a restart never match
+        self.tStart = datetime.now(tz=timezone.utc) - self.window # Loaded from here by load
+
+    def etag(self, version:int, *query) -> str:
+        """ query, such as a track's since and until, tells apart responses of one version """
+        tag = "{}-{}".format(self.boot, version)
+        if query: tag += "-{:08x}".format(zlib.crc32(bytes(repr(query), "utf-8")))
+        return '"' + tag + '"'
+
+    def put(self, row:dict) -> None:
+        """ Called by the Writer with each committed MOM row """
+        IMEI = row["IMEI"]
+        t = row["t"]
+        with self.lock:
+            if IMEI not in self.tracks: self.tracks[IMEI] = Track(self.tStart)
+            track = self.tracks[IMEI]
+            index = bisect.bisect_left(track.times, t)
+            if (index < len(track.times)) and (track.times[index] == t):
+                track.fixes[index] = row # Replaced, as in the database
+            else:
+                track.times.insert(index, t)
+                track.fixes.insert(index, row)
+            # Forget fixes older than the window before the latest, and past maxFixes
+            cutoff = track.times[-1] - self.window
+            nWindow = bisect.bisect_left(track.times, cutoff)
+            nCap = len(track.times) - self.maxFixes
+            if max(nWindow, nCap) > 0:
+                del track.times[:max(nWindow, nCap)]
+                del track.fixes[:max(nWindow, nCap)]
+                # Everything from the cutoff is kept, unless maxFixes dropped some of it
+                floor = cutoff if nWindow >= nCap else track.times[0]
+                track.floor = max(track.floor, floor)
+            self.version += 1
+            track.version = self.version
+
+    def latest(self, IMEI:str = None) -> tuple:
+        """ (version, latest fix) for IMEI, or every IMEI's if None """
+        with self.lock:
+            if IMEI is None:
+                return (self.version,
+                        dict(map(lambda x: (x, self.tracks[x].fixes[-1]), self.tracks)))
+            if IMEI not in self.tracks: return (None, None)
+            track = self.tracks[IMEI]
+            return (track.version, track.fixes[-1])
+
+    def track(self, IMEI:str, since:datetime, until:datetime) -> tuple:
+        """ (version, fixes after since and at or before until), fixes is None
+            if the cache may not have all of them """
+        with self.lock:
+            if IMEI not in self.tracks: # No fixes since tStart
+                qCached = (since is not None) and (since >= self.tStart)
+                return (self.version, [] if qCached else None)
+            track = self.tracks[IMEI]
+            if since is None: since = track.times[-1] - self.window
+            if since < track.floor: return (track.version, None)
+            i = bisect.bisect_right(track.times, since)
+            j = len(track.times) if until is None else bisect.bisect_right(track.times, until)
+            return (track.version, track.fixes[i:j])
+
+class FixHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        with apiHist.time():
+            try:
+                self.__get()
+            except:
+                self.server.logger.exception("Error answering %s", self.path)
+                self.send_error(500)
+
+    def __get(self) -> None:
+        cache = self.server.cache
+        url = urllib.parse.urlsplit(self.path)
+        parts = list(filter(None, url.path.split("/")))
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if parts == ["latest"]:
+            (version, fixes) = cache.latest()
+            if self.__qNotModified(cache.etag(version)): return
+            body = dict(map(lambda x: (x, jsonable(fixes[x])), fixes))
+            self.__send(cache.etag(version), body)
+        elif (len(parts) == 2) and (parts[0] == "latest"):
+            (version, fix) = cache.latest(parts[1])
+            if fix is None:
+                self.send_error(404, "Unknown IMEI")
+            elif not self.__qNotModified(cache.etag(version)):
+                self.__send(cache.etag(version), jsonable(fix))
+        elif (len(parts) == 2) and (parts[0] == "track"):
+            try:
+                since = mkTime(query["since"]) if "since" in query else None
+                until = mkTime(query["until"]) if "until" in query else None
+            except ValueError:
+                self.send_error(400, "Invalid time")
+                return
+            (version, fixes) = cache.track(parts[1], since, until)
+            etag = cache.etag(version, since, until)
+            if self.__qNotModified(etag): return
+            if fixes is None: # Older than the cache holds
+                if since is None: since = datetime.now(tz=timezone.utc) - cache.window
+                fixes = self.__fromDB(parts[1], since, until)
+            body = {"IMEI": parts[1], "fixes": list(map(jsonable, fixes)),
+                    "since": fixes[-1]["t"] if fixes else since} # For the next request
+            self.__send(etag, jsonable(body))
+        else:
+            self.send_error(404)
+
+    def __qNotModified(self, etag:str) -> bool:
+        if etag not in map(str.strip, self.headers.get("If-None-Match", "").split(",")):
+            return False
+        apiNotModified.inc()
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.end_headers()
+        return True
+
+    def __send(self, etag:str, body) -> None:
+        data = bytes(json.dumps(body), "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache") # Revalidate with If-None-Match
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __fromDB(self, IMEI:str, since:datetime, until:datetime) -> list:
+        """ Fixes older than the cache holds """
+        apiDB.inc()
+        args = self.server.args
+        sql = "SELECT * FROM " + args.mom + " WHERE IMEI=?"
+        vals = [IMEI]
+        if since is not None:
+            sql+= " AND t>?"
+            vals.append(since)
+        if until is not None:
+            sql+= " AND t<=?"
+            vals.append(until)
+        sql+= " ORDER BY t;"
+        names = None if since is None else Partitions.after(args.db, since)
+        fixes = {}
+        for conn in Partitions.batches(args.db, names, (args.mom,), args.fixApiTimeout):
+            for fix in fetch(conn, sql, vals):
+                fixes[fix["t"]] = fix # A later file's copy replaces it, as in the database
+        return list(map(lambda x: fixes[x], sorted(fixes)))
+
+    def log_message(self, fmt, *args) -> None:
+        pass # Don't write requests to stderr
+
+class FixAPI(MyBaseThread):
+    """ Fill the cache from the database, then serve it """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "FixAPI", args, logger)
+        self.cache = FixCache(args)
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Fix API options")
+        grp.add_argument("--fixApiPort", type=int, metavar="port",
+                help="Local port to serve recent fixes as JSON on")
+        grp.add_argument("--fixApiHost", type=str, default="127.0.0.1", metavar="address",
+                help="Address to serve fixes on")
+        grp.add_argument("--fixApiHours", type=float, default=48, metavar="hours",
+                help="Keep each IMEI's fixes from this long before its latest in memory")
+        grp.add_argument("--fixApiMaxFixes", type=int, default=1000, metavar="count",
+                help="Maximum fixes kept in memory per IMEI")
+        grp.add_argument("--fixApiTimeout", type=float, default=5, metavar="seconds",
+                help="How long to wait for the Writer's lock, for older fixes")
+
+    @staticmethod
+    def qEnabled(args:argparse.ArgumentParser) -> bool:
+        return args.fixApiPort is not None
+
+    def __load(self) -> None:
+        """ Fixes from before this process started """
+        args = self.args
+        if not Partitions.files(args.db): return # A new database
+        sql = "SELECT * FROM " + args.mom + " WHERE t>=? ORDER BY t;"
+        n = 0
+        for conn in Partitions.batches(args.db, Partitions.after(args.db, self.cache.tStart),
+                (args.mom,), args.fixApiTimeout):
+            for fix in fetch(conn, sql, (self.cache.tStart,)):
+                self.cache.put(fix)
+                n += 1
+        self.logger.info("Loaded %s fixes", n)
+
+    def runAndCatch(self) -> None: # Called on start
+        args = self.args
+        try:
+            self.__load()
+        except:
+            self.logger.exception("Unable to load fixes from %s", args.db)
+        server = ThreadingHTTPServer((args.fixApiHost, args.fixApiPort), FixHandler)
+        server.daemon_threads = True
+        server.cache = self.cache
+        server.args = args
+        server.logger = self.logger
+        self.logger.info("Serving fixes on %s:%s", args.fixApiHost, args.fixApiPort)
+        server.serve_forever()
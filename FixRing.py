@@ -0,0 +1,186 @@
+#
+# Shared memory ring buffer of each beacon's recent fixes
+#
+# The listener's Writer puts each committed fix into a POSIX shared memory segment, so
+# glider followers in other processes can read a beacon's last fixes without SQLite.
+# Readers map /dev/shm/<name> read only, so a read is a few memory accesses.
+#
+# Layout, little endian:
+#   header   magic "FIXR", version u32, nSlots u32, depth u32
+#   nSlots slots, each
+#     IMEI 16 bytes, count u64 fixes ever written, sequence u64 odd while being written
+#     depth records of t, latitude, longitude, accuracy, float64s, t in seconds since the
+#     epoch, accuracy NaN if unknown, fix n is in record n % depth
+# Each IMEI is given a slot when first seen, the least recently updated slot being reused
+# once they are all taken. Readers retry if the sequence changes while they copy a slot.
+# A ring left by a previous run is kept if it has the same layout, otherwise it is replaced
+# by a new one, which readers notice by its inode and map instead.
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
+header = struct.Struct("<4sIII")
+slotHeader = struct.Struct("<16sQQ")
+record = struct.Struct("<dddd")
+recordType = np.dtype([("t", "<f8"), ("lat", "<f8"), ("lon", "<f8"), ("accuracy", "<f8")])
+magic = b"FIXR"
+version = 1
+
+def mkKey(IMEI:str) -> bytes:
+    return bytes(IMEI, "utf-8")[:16].ljust(16, b"\0") # As unpacked from a slot
+
+def slotSize(depth:int) -> int:
+    return slotHeader.size + depth * record.size
+
+class FixRing:
+    """ Writer sink putting each row's fix into the ring """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.logger = logger
+        self.nSlots = args.fixRingSlots
+        self.depth = args.fixRingDepth
+        size = header.size + self.nSlots * slotSize(self.depth)
+        self.offsets = list(map(lambda x: header.size + x * slotSize(self.depth),
+            range(self.nSlots)))
+        self.slots = OrderedDict() # Slot by IMEI, least recently updated first
+        try:
+            self.shm = shared_memory.SharedMemory(args.fixRing, create=True, size=size)
+        except FileExistsError: # Left by a previous run
+            self.shm = shared_memory.SharedMemory(args.fixRing)
+            if not self.__qReuse(size): # Another layout, so start afresh
+                self.shm.close()
+                self.shm.unlink()
+                self.shm = shared_memory.SharedMemory(args.fixRing, create=True, size=size)
+        self.buf = self.shm.buf
+        self.free = [x for x in self.offsets if x not in self.slots.values()]
+        header.pack_into(self.buf, 0, magic, version, self.nSlots, self.depth)
+        logger.info("Fix ring %s with %s slots of %s fixes, %s in use",
+                args.fixRing, self.nSlots, self.depth, len(self.slots))
+
+    def __qReuse(self, size:int) -> bool:
+        """ Keep the previous run's fixes if its ring has the same layout """
+        buf = self.shm.buf
+        if (self.shm.size < size) or \
+                (header.unpack_from(buf, 0) != (magic, version, self.nSlots, self.depth)):
+            return False
+        tLast = {}
+        for offset in self.offsets:
+            (key, count, seq) = slotHeader.unpack_from(buf, offset)
+            if seq & 1: # The previous run died while writing this slot
+                slotHeader.pack_into(buf, offset, bytes(16), 0, seq + 1)
+                continue
+            if not count: continue
+            IMEI = str(key.rstrip(b"\0"), "utf-8", "replace")
+            index = (count - 1) % self.depth
+            tLast[IMEI] = (record.unpack_from(buf,
+                offset + slotHeader.size + index * record.size)[0], offset)
+        for IMEI in sorted(tLast, key=lambda x: tLast[x]): # Least recently updated first
+            self.slots[IMEI] = tLast[IMEI][1]
+        return True
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Shared memory fix ring options")
+        grp.add_argument("--fixRing", type=str, metavar="name",
+                help="Shared memory name to put recent fixes in, for Drifter's --drifterRing")
+        grp.add_argument("--fixRingSlots", type=int, default=256, metavar="count",
+                help="Number of IMEIs the ring holds")
+        grp.add_argument("--fixRingDepth", type=int, default=64, metavar="count",
+                help="Number of fixes kept per IMEI")
+
+    @staticmethod
+    def qEnabled(args:argparse.ArgumentParser) -> bool:
+        return args.fixRing is not None
+
+    def __slot(self, IMEI:str) -> tuple:
+        """ (slot offset, qNew) """
+        if IMEI in self.slots:
+            self.slots.move_to_end(IMEI)
+            return (self.slots[IMEI], False)
+        if self.free:
+            offset = self.free.pop(0)
+        else:
+            (old, offset) = self.slots.popitem(last=False)
+            self.logger.info("Fix ring slot of %s given to %s", old, IMEI)
+        self.slots[IMEI] = offset
+        return (offset, True)
+
+    def put(self, row:dict) -> None:
+        """ Called by the Writer with each committed MOM row """
+        (lat, lon) = (row.get("latitude"), row.get("longitude"))
+        if (lat is None) or (lon is None): return # Not a fix
+        accuracy = row.get("accuracy")
+        (offset, qNew) = self.__slot(row["IMEI"])
+        (key, count, seq) = slotHeader.unpack_from(self.buf, offset)
+        key = mkKey(row["IMEI"])
+        if qNew: count = 0
+        slotHeader.pack_into(self.buf, offset, key, count, seq + 1) # Readers wait
+        index = count % self.depth
+        record.pack_into(self.buf, offset + slotHeader.size + index * record.size,
+                row["t"].timestamp(), lat, lon, np.nan if accuracy is None else accuracy)
+        slotHeader.pack_into(self.buf, offset, key, count + 1, seq + 2)
+
+class RingReader:
+    """ Read only view of a ring another process writes """
+    readers = {} # Open readers by name, so each process maps a ring once
+
+    @staticmethod
+    def filename(name:str) -> str:
+        return os.path.join("/dev/shm", name.lstrip("/"))
+
+    @classmethod
+    def get(cls, name:str):
+        """ The reader for name, reopened if the listener has since made a new ring """
+        reader = cls.readers.get(name)
+        if (reader is None) or (os.stat(cls.filename(name)).st_ino != reader.ino):
+            if reader is not None: reader.mm.close()
+            reader = cls.readers[name] = RingReader(name)
+        return reader
+
+    def __init__(self, name:str) -> None:
+        fd = os.open(self.filename(name), os.O_RDONLY)
+        try:
+            self.ino = os.fstat(fd).st_ino
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        (m, v, self.nSlots, self.depth) = header.unpack_from(self.mm, 0)
+        if (m != magic) or (v != version):
+            raise Exception("{} is not a version {} fix ring".format(name, version))
+        self.keys = np.ndarray((self.nSlots,), dtype="S16", buffer=self.mm,
+                offset=header.size, strides=(slotSize(self.depth),)) # IMEI column, no copy
+        self.slots = {} # Slot offset by IMEI
+
+    def __offset(self, IMEI:str, key:bytes) -> int:
+        offset = self.slots.get(IMEI)
+        if (offset is not None) and (slotHeader.unpack_from(self.mm, offset)[0] == key):
+            return offset
+        found = np.flatnonzero(self.keys == key)
+        if not len(found): return None
+        self.slots[IMEI] = offset = header.size + int(found[0]) * slotSize(self.depth)
+        return offset
+
+    def fixes(self, IMEI:str, n:int = None) -> np.ndarray:
+        """ IMEI's last n fixes, or all the ring holds, newest written first """
+        key = mkKey(IMEI)
+        for attempt in range(1000):
+            offset = self.__offset(IMEI, key)
+            if offset is None: return np.zeros(0, dtype=recordType)
+            (k, count, seq) = slotHeader.unpack_from(self.mm, offset)
+            if seq & 1:
+                time.sleep(0) # Being written
+                continue
+            recs = np.frombuffer(self.mm, dtype=recordType, count=self.depth,
+                    offset=offset + slotHeader.size)
+            m = min(count, self.depth) if n is None else min(n, count, self.depth)
+            order = (count - 1 - np.arange(m)) % self.depth
+            recs = recs[order] # Copies just these records
+            if slotHeader.unpack_from(self.mm, offset) == (k, count, seq) and (k == key):
+                return recs
+        raise Exception("Unable to read a consistent copy of {} from the fix ring".format(IMEI))
@@ -1,56 +1,345 @@
 #
 # Forward a byte array to another host:port
 #
+# A pool of sender threads takes messages off the queue. The target's address is resolved
+# once and cached. With --forwardPersistent, which the receiver must support, each sender
+# keeps its connection open between messages, otherwise each message is sent on its own
+# connection, as a DirectIP gateway does. Messages which can not be sent are written to
+# the --forwardSpool directory, which is drained, oldest first, with exponential backoff.
+#
+# With --forwardRoutes, each message is sent to the destinations its IMEI is routed to,
+# see Routes.py, and each destination has its own senders and spool, so a slow partner
+# does not hold up the others. The routing file is reloaded when it changes.
+#
+# With a Journal, see Journal.py, each message is marked done once every destination
+# has sent, spooled, or dropped it.
+#
 # Feb-2020, Pat Welch, pat@mousebrains.com
 
 import socket
-import queue
 import argparse
 import logging
+import itertools
+import os
+import queue
+import threading
+import time
 from MyBaseThread import MyBaseThread
+from Metrics import metrics, TimedQueue
+from ParseMessage import getIMEI
+from Routes import Routes
+
+forwardHist = metrics.histogram("forward_seconds", "Time to connect and send a message")
+forwardErrors = metrics.counter("forward_errors_total", "Messages which could not be forwarded")
+forwardSpooled = metrics.counter("forward_spooled_total", "Messages written to the retry spool")
+
+class Target:
+    """ Cache the target's address, resolving it again after --forwardResolve seconds
+        or a connection failure """
+    def __init__(self, hostname:str, port:int, args:argparse.ArgumentParser) -> None:
+        self.hostname = hostname
+        self.port = port
+        self.ttl = args.forwardResolve
+        self.lock = threading.Lock()
+        self.info = None
+        self.tExpire = 0
+
+    def __repr__(self) -> str:
+        return "{}:{}".format(self.hostname, self.port)
+
+    def addr(self) -> tuple:
+        with self.lock:
+            if (self.info is None) or (time.monotonic() > self.tExpire):
+                self.info = socket.getaddrinfo(self.hostname, self.port,
+                        type=socket.SOCK_STREAM)[0]
+                self.tExpire = time.monotonic() + self.ttl
+            return self.info
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.info = None
+
+class Connection:
+    """ Send messages to the target, optionally over a persistent connection """
+    def __init__(self, target:Target, args:argparse.ArgumentParser) -> None:
+        self.target = target
+        self.qPersistent = args.forwardPersistent
+        self.timeout = args.forwardTimeout
+        self.s = None
+
+    def __connect(self) -> socket.socket:
+        (family, sockType, proto, canonName, sockAddr) = self.target.addr()
+        s = socket.socket(family, sockType, proto)
+        try:
+            s.settimeout(self.timeout)
+            s.connect(sockAddr)
+        except:
+            s.close()
+            self.target.invalidate()
+            raise
+        return s
+
+    def send(self, msg:bytes) -> None:
+        if not self.qPersistent:
+            with self.__connect() as s:
+                s.sendall(msg)
+            return
+        qReused = self.s is not None
+        try:
+            if self.s is None: self.s = self.__connect()
+            self.s.sendall(msg)
+        except OSError:
+            self.close()
+            if not qReused: raise
+            self.s = self.__connect() # The old connection may have gone stale, so try once more
+            self.s.sendall(msg)
+
+    def close(self) -> None:
+        if self.s is None: return
+        try:
+            self.s.close()
+        except:
+            pass
+        self.s = None
+
+class Spool:
+    """ Directory of messages waiting to be resent, one file per message """
+    def __init__(self, dirName:str) -> None:
+        self.dirName = dirName
+        self.seq = itertools.count()
+        os.makedirs(dirName, exist_ok=True)
+
+    def put(self, msg:bytes) -> None:
+        name = "{:020d}-{:06d}.sbd".format(time.time_ns(), next(self.seq) % 1000000)
+        fn = os.path.join(self.dirName, name)
+        tmp = os.path.join(self.dirName, "." + name)
+        with open(tmp, "wb") as fp:
+            fp.write(msg)
+        os.replace(tmp, fn) # The drainer never sees a partial file
+
+    def files(self) -> list:
+        return sorted(filter(lambda x: x.endswith(".sbd") and not x.startswith("."),
+            os.listdir(self.dirName)))
+
+    def depth(self) -> int:
+        return len(self.files())
+
+    def get(self, name:str) -> bytes:
+        with open(os.path.join(self.dirName, name), "rb") as fp:
+            return fp.read()
+
+    def remove(self, name:str) -> None:
+        os.unlink(os.path.join(self.dirName, name))
+
+class Sender(MyBaseThread):
+    """ Take messages off a destination's queue and send them """
+    def __init__(self, name:str, dest, args:argparse.ArgumentParser,
+            logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, name, args, logger)
+        self.dest = dest
+        self.conn = Connection(dest.target, args)
+
+    def runAndCatch(self) -> None: # Called on thread start
+        dest = self.dest
+        q = dest.q
+        conn = self.conn
+        while True:
+            try:
+                (t, addr, msg, seq) = q.get(timeout=self.args.forwardIdle)
+            except queue.Empty:
+                conn.close() # Don't hold an idle connection open
+                continue
+            if dest.qBackoff(): # The target is down, so don't wait on it
+                dest.failed(msg)
+            else:
+                try:
+                    with forwardHist.time():
+                        conn.send(msg)
+                except:
+                    self.logger.exception("Error sending to %s", dest.target)
+                    dest.failed(msg)
+            dest.done(seq) # Sent, spooled, or dropped
+            q.task_done() # I'm done processing this message
+
+class Destination(MyBaseThread):
+    """ Send messages to one host:port, spooling those which can not be sent """
+    def __init__(self, name:str, args:argparse.ArgumentParser, logger:logging.Logger,
+            done = None) -> None:
+        MyBaseThread.__init__(self, "FWD:" + name, args, logger)
+        self.done = done if done is not None else (lambda seq: None) # Called per message
+        (hostname, port) = name.rsplit(":", 1)
+        self.q = queue.Queue()
+        self.target = Target(hostname, int(port), args)
+        self.spool = None
+        if args.forwardSpool is not None:
+            self.spool = Spool(os.path.join(args.forwardSpool, name.replace(":", "_")))
+        self.spooled = threading.Event() # Something was added to the spool
+        self.backoff = 0 # Current retry delay, 0 if the target is up
+        self.tRetry = 0 # Monotonic time before which the target is considered down
+
+    def qBackoff(self) -> bool:
+        """ Should new messages go straight to the spool? """
+        return (self.spool is not None) and (time.monotonic() < self.tRetry)
+
+    def failed(self, msg:bytes) -> None:
+        """ Spool, or drop, a message which could not be sent """
+        forwardErrors.inc()
+        if self.spool is None:
+            self.logger.error("Dropped message of %s bytes for %s", len(msg), self.target)
+            return
+        try:
+            self.spool.put(msg)
+            forwardSpooled.inc()
+            self.spooled.set()
+        except:
+            self.logger.exception("Unable to spool message of %s bytes", len(msg))
+
+    def __drain(self, conn:Connection) -> bool:
+        """ Send spooled messages, oldest first, returns False if the target is still down """
+        for name in self.spool.files():
+            msg = self.spool.get(name)
+            try:
+                with forwardHist.time():
+                    conn.send(msg)
+            except:
+                conn.close()
+                self.logger.debug("Unable to drain spool to %s", self.target, exc_info=True)
+                return False
+            self.spool.remove(name)
+        return True
+
+    def runAndCatch(self) -> None: # Called on thread start
+        args = self.args
+        logger = self.logger
+        logger.info("Starting %s", self.target)
+        for i in range(max(1, args.forwardConnections)):
+            Sender("{}({})".format(self.name, i), self, args, logger).start()
+
+        if self.spool is None: return # Nothing more to do
+        conn = Connection(self.target, args)
+        self.spooled.set() # Drain anything left from a previous run
+        while True: # Drain the spool
+            self.spooled.wait(timeout=None if not self.backoff else
+                    max(0, self.tRetry - time.monotonic()))
+            self.spooled.clear()
+            if self.backoff and (time.monotonic() < self.tRetry): continue # Still backing off
+            if self.__drain(conn):
+                if self.backoff: logger.info("Spool drained to %s", self.target)
+                self.backoff = 0
+                self.tRetry = 0
+            else:
+                self.backoff = min(args.forwardBackoff, max(1, self.backoff * 2))
+                self.tRetry = time.monotonic() + self.backoff
+                logger.warning("Unable to drain %s spooled messages to %s, retrying in %s seconds",
+                        self.spool.depth(), self.target, self.backoff)
+            conn.close()
 
 class Forwarder(MyBaseThread):
-    ''' Wait on a queue and send the received packets to a host:port '''
-    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+    ''' Wait on a queue and send the received packets to their destinations '''
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger,
+            journal = None) -> None:
         MyBaseThread.__init__(self, "FWD", args, logger)
+        self.journal = journal # Told when every destination is done with a journaled message
+        self.lock = threading.Lock()
+        self.pending = {} # Destinations still to finish each journaled sequence number
         self.hostname = args.hostname
         self.port = args.portForward
-        self.q = queue.Queue()
+        self.q = TimedQueue("forward_queue", "Forwarder queue")
+        self.default = () # Destinations for IMEIs which are not routed
+        if (args.hostname is not None) and (args.portForward is not None):
+            self.default = ("{}:{}".format(args.hostname, args.portForward),)
+        self.routes = None
+        self.tCheck = 0 # When to next check if the routing file has changed
+        self.destinations = {} # Started Destinations by host:port
+        if args.forwardSpool is not None:
+            metrics.gauge("forward_spool_depth", "Messages in the retry spools", self.__depth)
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
         grp = parser.add_argument_group("Packet Forwarding Options")
-        grp.add_argument("--hostname", type=str, metavar='host', help="Host to forward packets to")
+        grp.add_argument("--hostname", type=str, metavar='host',
+                help="Host to forward packets to, with --forwardRoutes those which are not routed")
         grp.add_argument("--portForward", type=int, metavar='port',
                 help="Port to forward packets to")
+        grp.add_argument("--forwardConnections", type=int, default=4, metavar="count",
+                help="Number of concurrent sender connections per destination")
+        grp.add_argument("--forwardPersistent", action="store_true",
+                help="Send many messages per connection, the receiver must allow this")
+        grp.add_argument("--forwardTimeout", type=float, default=10, metavar="seconds",
+                help="Connect and send timeout")
+        grp.add_argument("--forwardIdle", type=float, default=60, metavar="seconds",
+                help="Close persistent connections idle for this long")
+        grp.add_argument("--forwardResolve", type=float, default=300, metavar="seconds",
+                help="How long to cache the target's address")
+        grp.add_argument("--forwardSpool", type=str, metavar="directory",
+                help="Where to keep messages which could not be sent, else they are dropped")
+        grp.add_argument("--forwardBackoff", type=float, default=300, metavar="seconds",
+                help="Maximum delay between attempts to drain the spool")
+        grp.add_argument("--forwardRoutes", type=str, metavar="filename",
+                help="YAML file routing IMEIs to destinations, see Routes.py")
+        grp.add_argument("--forwardRoutesCheck", type=float, default=10, metavar="seconds",
+                help="How often to check if the routing file has changed")
 
     def put(self, msg) -> None:
         t = None
         addr = None
-        self.q.put((t, addr, msg))
+        seq = None
+        self.q.put((t, addr, msg, seq))
+
+    def __depth(self) -> int:
+        return sum(map(lambda x: x.spool.depth(), list(self.destinations.values())))
+
+    def __route(self, IMEI:str) -> tuple:
+        """ Destinations for IMEI, reloading the routing file if it has changed """
+        args = self.args
+        if args.forwardRoutes is None: return self.default
+        now = time.monotonic()
+        if now >= self.tCheck:
+            self.tCheck = now + args.forwardRoutesCheck
+            try:
+                if (self.routes is None) or self.routes.qChanged():
+                    self.routes = Routes(args.forwardRoutes, self.default)
+                    self.logger.info("Loaded %s", self.routes)
+            except:
+                self.logger.exception("Unable to load routes from %s", args.forwardRoutes)
+        return self.default if self.routes is None else self.routes.lookup(IMEI)
+
+    def __destination(self, name:str) -> Destination:
+        if name not in self.destinations:
+            dest = Destination(name, self.args, self.logger, self.__done)
+            dest.start()
+            self.destinations[name] = dest
+        return self.destinations[name]
+
+    def __done(self, seq:int) -> None:
+        """ A destination is done with seq, tell the journal once they all are """
+        if (seq is None) or (self.journal is None): return
+        with self.lock:
+            self.pending[seq] -= 1
+            if self.pending[seq] > 0: return
+            del self.pending[seq]
+        self.journal.done("forward", seq)
 
     def runAndCatch(self) -> None: # Called on thread start
-        hostname = self.hostname
-        port = self.port
-        logger = self.logger
         q = self.q
-        logger.info("Starting %s:%s", hostname, port)
         while True:
-            (t, addr, msg) = q.get()
-            if hostname is None or port is None: # Do nothing
-                q.task_done() # I'm done processing this message
-                continue # Do nothing
+            item = q.get()
+            seq = item[3]
+            names = ()
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    logger.debug("Opened socket")
-                    s.connect((hostname, port))
-                    logger.debug("Connected to {}:{}", hostname, port)
-                    while len(msg):
-                        n = s.send(msg)
-                        if n == 0:
-                            logger.error("Socket connection to %s:%s broken", hostname, port)
-                            break
-                        msg = msg[n:]
+                names = self.__route(getIMEI(item[2]))
             except:
-                logger.exception("Error sending to %s:%s", hostname, port)
+                forwardErrors.inc()
+                self.logger.exception("Unable to route message")
+            if (seq is not None) and (self.journal is not None):
+                with self.lock:
+                    self.pending[seq] = len(names)
+                if not names: self.journal.done("forward", seq) # Nowhere to send it
+            for name in names:
+                try:
+                    self.__destination(name).q.put(item)
+                except:
+                    forwardErrors.inc()
+                    self.logger.exception("Unable to queue message for %s", name)
+                    self.__done(seq)
             q.task_done() # I'm done processing this message
@@ -10,15 +10,28 @@
 import socket
 import argparse
 import threading
+import time
 import MyLogger
+from Metrics import metrics, MetricsServer
 from Forwarder import Forwarder
 from Writer import Writer
 from Reader import Reader
+from Dedup import Dedup
+from Journal import Journal
+from FixAPI import FixAPI
+from Publisher import Publisher
+from FixRing import FixRing
 
 parser = argparse.ArgumentParser(description="Listen for a GSatMicro message")
 MyLogger.addArgs(parser)
 Forwarder.addArgs(parser)
 Writer.addArgs(parser)
+Dedup.addArgs(parser)
+Journal.addArgs(parser)
+FixAPI.addArgs(parser)
+Publisher.addArgs(parser)
+FixRing.addArgs(parser)
+MetricsServer.addArgs(parser)
 grp = parser.add_argument_group('Listener Related Options')
 grp.add_argument('--port', type=int, required=True, metavar='port', help='Port to listen on')
 grp.add_argument('--maxConnections', type=int, default=10, metavar='count',
@@ -28,14 +41,47 @@ args = parser.parse_args()
 logger = MyLogger.mkLogger(args)
 logger.info('args=%s', args)
 
+acceptHist = metrics.histogram("accept_seconds", "Connection accepted until its reader started")
+acceptCount = metrics.counter("accept_total", "Connections accepted")
+metrics.gauge("threads", "Active threads", threading.active_count)
+
 try:
-    fwd = Forwarder(args, logger) # Create a packet forwarder
+    if MetricsServer.qEnabled(args):
+        MetricsServer(args, logger).start()
+
+    journal = None
+    if args.journal is not None:
+        journal = Journal(args, logger) # Received packets are durable before being queued
+        journal.start()
+
+    fwd = Forwarder(args, logger, journal) # Create a packet forwarder
     fwd.start() # Start the forwarder
 
-    writer = Writer(args, logger) # Create the db writer thread
+    sinks = [] # Given each MOM row the writer commits
+    if FixAPI.qEnabled(args):
+        api = FixAPI(args, logger) # Serve recent fixes from memory
+        api.start()
+        sinks.append(api.cache)
+    if Publisher.qEnabled(args):
+        pub = Publisher(args, logger) # Stream rows to subscribers
+        pub.start()
+        sinks.append(pub)
+    if FixRing.qEnabled(args):
+        sinks.append(FixRing(args, logger)) # Recent fixes for other processes
+
+    writer = Writer(args, logger, journal, sinks) # Create the db writer thread
     writer.start() # Start the writer thread
 
+    if journal is not None: # Replay what was not finished before the last shutdown
+        for (name, q) in (("writer", writer.q), ("forward", fwd.q)):
+            items = journal.replay(name)
+            if items: logger.info("Replaying %s journaled packets to the %s", len(items), name)
+            for (seq, t, addr, msg) in items:
+                q.put((t, addr, msg, seq))
+
     queues = [fwd.q, writer.q]
+    readers = [] # Reader threads which may still be running
+    dedup = Dedup(args) # Shared by the readers, so retransmits are dropped before queueing
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         logger.debug('Opened socket')
@@ -45,11 +91,17 @@ try:
         logger.debug('Listening to socket')
         while writer.is_alive():
             (conn, addr) = s.accept() # Wait for a connection
+            t0 = time.monotonic()
+            acceptCount.inc()
             logger.info('Connection from %s', addr)
-            thrd = Reader(conn, addr, logger, queues) # Create a new reader thread
+            thrd = Reader(conn, addr, logger, queues, dedup, journal) # Create a new reader thread
             thrd.start() # Start the new reader thread
-            logger.info('n Threads %s', threading.active_count())
-            while threading.active_count() > args.maxConnections: # don't overload the system
-                time.sleep(1) # Wait for a thread to die before accepting anything else
+            acceptHist.observe(time.monotonic() - t0)
+            readers = [x for x in readers if x.is_alive()]
+            readers.append(thrd)
+            logger.info('n Threads %s readers %s', threading.active_count(), len(readers))
+            while len(readers) >= args.maxConnections: # don't overload the system
+                readers[0].join(timeout=1) # Wait for a reader to finish before accepting anything else
+                readers = [x for x in readers if x.is_alive()]
 except:
     logger.exception('Unexpected exception while listening')
@@ -0,0 +1,247 @@
+#
+# Append only journal of received packets, so a crash or restart loses nothing
+#
+# Each packet is appended to the current segment file, and its reader waits until the
+# segment has been fsynced before queueing the packet to the Writer and Forwarder.
+# A single syncer thread fsyncs everything appended since its last fsync at once, so
+# many packets share each fsync. The Writer and Forwarder mark each sequence number done,
+# and each one's watermark, below which everything is done, is saved in marks.json.
+# On startup, every packet above a consumer's watermark is replayed into that consumer,
+# so delivery is at least once. The Writer stores each packet's sequence number in Raw,
+# so it ignores a replayed packet it has already written. Segments entirely below every
+# watermark are deleted. A packet a consumer gives up on is appended to deadLetters, in
+# the same record format, before being marked done, so the watermark can move on.
+# If the syncer dies, or an fsync takes longer than --journalTimeout, packets are queued
+# without waiting for it, rather than every Reader being held up.
+#
+# Record layout, little endian:
+#   length u32, crc32 u32, then length bytes of
+#   seq u64, t float64 seconds since the epoch, port u16, addrLength u8, addr, message
+
+import argparse
+import logging
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from MyBaseThread import MyBaseThread
+from Metrics import metrics
+
+syncHist = metrics.histogram("journal_fsync_seconds", "Time to fsync the journal")
+syncCount = metrics.counter("journal_records_total", "Records written to the journal")
+
+class Mark:
+    """ Highest sequence number at and below which everything is done """
+    def __init__(self, watermark:int) -> None:
+        self.watermark = watermark
+        self.done = set() # Done sequence numbers above the watermark
+
+    def add(self, seq:int) -> None:
+        if seq <= self.watermark: return # Replayed and done before
+        self.done.add(seq)
+        while (self.watermark + 1) in self.done:
+            self.watermark += 1
+            self.done.remove(self.watermark)
+
+class Journal(MyBaseThread):
+    consumers = ("writer", "forward")
+    header = struct.Struct("<II") # length, crc32
+    fixed = struct.Struct("<QdHB") # seq, t, port, addr length
+
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "Journal", args, logger)
+        self.dirName = args.journal
+        self.cond = threading.Condition()
+        self.marks = {}
+        self.segments = [] # (first seq, filename) oldest first
+        self.fd = None
+        self.size = 0 # Bytes in the current segment
+        self.seq = 1 # Next sequence number
+        self.written = 0 # Last sequence number written
+        self.synced = 0 # Last sequence number fsynced
+        self.pending = [] # Records to replay, from open
+        os.makedirs(self.dirName, exist_ok=True)
+        self.__open()
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Journal options")
+        grp.add_argument("--journal", type=str, metavar="directory",
+                help="Journal received packets here before queueing them")
+        grp.add_argument("--journalSegment", type=int, default=64*1024*1024, metavar="bytes",
+                help="Start a new journal segment after this many bytes")
+        grp.add_argument("--journalDelay", type=float, default=0, metavar="seconds",
+                help="Wait this long after each fsync, so more packets share the next one")
+        grp.add_argument("--journalMarks", type=float, default=1, metavar="seconds",
+                help="How often to save the watermarks and delete finished segments")
+        grp.add_argument("--journalTimeout", type=float, default=10, metavar="seconds",
+                help="Queue a packet without waiting if its fsync takes longer than this")
+
+    @classmethod
+    def encode(cls, seq:int, t:datetime, addr:tuple, msg:bytes) -> bytes:
+        host = bytes(str(addr[0]), "utf-8")[:255]
+        payload = cls.fixed.pack(seq, t.timestamp(), int(addr[1]) & 0xffff, len(host))
+        payload += host + msg
+        return cls.header.pack(len(payload), zlib.crc32(payload)) + payload
+
+    @classmethod
+    def records(cls, fn:str) -> tuple:
+        """ Decode a segment, returns the records and the length of the valid part """
+        with open(fn, "rb") as fp:
+            data = fp.read()
+        items = []
+        offset = 0
+        while (offset + cls.header.size) <= len(data):
+            (n, crc) = cls.header.unpack_from(data, offset)
+            payload = data[(offset + cls.header.size):(offset + cls.header.size + n)]
+            if (len(payload) != n) or (zlib.crc32(payload) != crc): break # Torn write
+            (seq, t, port, nHost) = cls.fixed.unpack_from(payload)
+            host = str(payload[cls.fixed.size:(cls.fixed.size + nHost)], "utf-8")
+            msg = payload[(cls.fixed.size + nHost):]
+            items.append((seq, datetime.fromtimestamp(t, tz=timezone.utc), (host, port), msg))
+            offset += cls.header.size + n
+        return (items, offset)
+
+    def __marksName(self) -> str:
+        return os.path.join(self.dirName, "marks.json")
+
+    def __open(self) -> None:
+        """ Load the watermarks and segments, and find the records to replay """
+        marks = {}
+        if os.path.exists(self.__marksName()):
+            with open(self.__marksName(), "r") as fp:
+                marks = json.load(fp)
+        for name in self.consumers:
+            self.marks[name] = Mark(marks.get(name, 0))
+        low = min(map(lambda x: x.watermark, self.marks.values()))
+
+        for name in sorted(os.listdir(self.dirName)):
+            if not name.endswith(".jnl"): continue
+            fn = os.path.join(self.dirName, name)
+            (items, n) = self.records(fn)
+            if n != os.path.getsize(fn):
+                self.logger.warning("Truncating torn journal tail in %s at %s", fn, n)
+                os.truncate(fn, n)
+            if not items:
+                os.unlink(fn)
+                continue
+            self.segments.append((items[0][0], fn))
+            self.seq = max(self.seq, items[-1][0] + 1)
+            self.pending.extend(filter(lambda x: x[0] > low, items))
+        # Never reuse a sequence number a watermark has passed, even if its segment is gone
+        self.seq = max(self.seq, 1 + max(map(lambda x: x.watermark, self.marks.values())))
+        self.written = self.seq - 1
+        self.synced = self.written
+        first = self.segments[0][0] if self.segments else self.seq
+        for mark in self.marks.values(): # Records before the oldest segment are long done
+            mark.watermark = max(mark.watermark, first - 1)
+        self.__newSegment()
+
+    def __newSegment(self) -> None:
+        if self.fd is not None: os.close(self.fd)
+        fn = os.path.join(self.dirName, "{:020d}.jnl".format(self.seq))
+        self.fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = 0
+        self.segments.append((self.seq, fn))
+        dirFD = os.open(self.dirName, os.O_RDONLY) # Make the new file's name durable
+        try:
+            os.fsync(dirFD)
+        finally:
+            os.close(dirFD)
+
+    def replay(self, consumer:str) -> list:
+        """ Records consumer had not finished with before the last shutdown """
+        wm = self.marks[consumer].watermark
+        return list(filter(lambda x: x[0] > wm, self.pending))
+
+    def append(self, t:datetime, addr:tuple, msg:bytes) -> int:
+        """ Write a packet and wait until it is durable, returns its sequence number,
+            or None if it could not be written, in which case it is queued unjournaled """
+        with self.cond:
+            seq = self.seq
+            record = self.encode(seq, t, addr, msg)
+            try:
+                os.write(self.fd, record)
+            except OSError:
+                self.logger.exception("Unable to journal %s bytes from %s", len(msg), addr)
+                try:
+                    os.ftruncate(self.fd, self.size) # Drop any partial record
+                except OSError:
+                    pass
+                return None
+            self.seq += 1
+            self.size += len(record)
+            self.written = seq
+            syncCount.inc()
+            self.cond.notify_all() # Wake the syncer
+            tEnd = time.monotonic() + self.args.journalTimeout
+            while self.synced < seq:
+                dt = tEnd - time.monotonic()
+                if (dt <= 0) or not self.is_alive(): # Never hold up every Reader
+                    self.logger.error("Journal record %s not fsynced, queueing it anyway", seq)
+                    break
+                self.cond.wait(timeout=min(dt, 1))
+        return seq
+
+    def done(self, consumer:str, seq:int) -> None:
+        if seq is None: return
+        with self.cond:
+            self.marks[consumer].add(seq)
+
+    def deadLetter(self, t:datetime, addr:tuple, msg:bytes, seq:int) -> None:
+        """ Keep a packet which could not be handled, so it can be dealt with by hand """
+        fn = os.path.join(self.dirName, "deadLetters")
+        try:
+            with self.cond, open(fn, "ab") as fp:
+                fp.write(self.encode(0 if seq is None else seq, t, addr, msg))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self.logger.error("Journal record %s saved in %s", seq, fn)
+        except:
+            self.logger.exception("Unable to save journal record %s in %s", seq, fn)
+
+    def __saveMarks(self) -> None:
+        with self.cond:
+            marks = dict(map(lambda x: (x, self.marks[x].watermark), self.marks))
+            segments = list(self.segments)
+        tmp = self.__marksName() + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump(marks, fp)
+        os.replace(tmp, self.__marksName())
+
+        low = min(marks.values())
+        for i in range(len(segments) - 1): # Never the current segment
+            if (segments[i + 1][0] - 1) > low: break # Still has records to be done
+            os.unlink(segments[i][1])
+            with self.cond:
+                self.segments.remove(segments[i])
+        if self.pending and (self.pending[-1][0] <= low):
+            self.pending = [] # Everything replayed is done
+
+    def runAndCatch(self) -> None: # Called on thread start
+        args = self.args
+        tMarks = time.monotonic() + args.journalMarks
+        while True:
+            with self.cond:
+                while self.written == self.synced:
+                    if not self.cond.wait(timeout=max(0, tMarks - time.monotonic())): break
+                target = self.written
+                fd = self.fd
+            if target != self.synced:
+                with syncHist.time():
+                    os.fsync(fd) # Outside the lock, so appends continue meanwhile
+                with self.cond:
+                    self.synced = target
+                    self.cond.notify_all()
+                    if (self.size >= args.journalSegment) and (self.written == target):
+                        self.__newSegment()
+                if args.journalDelay > 0: time.sleep(args.journalDelay)
+            if time.monotonic() >= tMarks:
+                try:
+                    self.__saveMarks()
+                except:
+                    self.logger.exception("Error saving journal watermarks")
+                tMarks = time.monotonic() + args.journalMarks
@@ -0,0 +1,71 @@
+#
+# Split a stream of text into newline terminated lines
+#
+# The SFMC API scripts emit one JSON envelope per line, terminated by a NUL and a newline,
+# with the dialog text in the "data" field. The dialog text itself arrives in arbitrary
+# sized chunks which need to be reassembled into lines.
+#
+# Rather than slicing the buffer after every line, which copies the remainder each time,
+# an offset is kept into the buffer and the consumed prefix is only dropped once per chunk.
+
+import re
+import json
+
+apiEnvelope = re.compile(rb"([{].+[}])\x00\n") # One JSON message from the API scripts
+
+def apiMessage(line:bytes) -> dict:
+    """ Return the decoded JSON envelope in line, or None if it is not an envelope """
+    a = apiEnvelope.fullmatch(line)
+    if a is None: return None
+    return json.loads(a[1])
+
+class LineFramer:
+    """ Incrementally frame text, or bytes when newline=b"\\n", into newline terminated lines """
+    def __init__(self, compactSize:int = 65536, newline = "\n") -> None:
+        self.newline = newline
+        self.empty = newline[:0]
+        self.buffer = self.empty
+        self.offset = 0 # Start of the unconsumed portion of buffer
+        self.compactSize = compactSize # Drop consumed text once offset exceeds this
+
+    def __len__(self) -> int:
+        return len(self.buffer) - self.offset
+
+    def __compact(self) -> None:
+        self.buffer = self.buffer[self.offset:]
+        self.offset = 0
+
+    def put(self, data) -> None:
+        """ Append a chunk of text """
+        if not data: return
+        if self.offset: self.__compact() # One copy per chunk, not per line
+        self.buffer += data
+
+    def lines(self):
+        """ Yield each complete line, including its newline """
+        buffer = self.buffer
+        while True:
+            index = buffer.find(self.newline, self.offset)
+            if index < 0: break # No complete line left
+            line = buffer[self.offset:(index+1)]
+            self.offset = index + 1
+            yield line
+        if self.offset >= len(buffer):
+            self.buffer = self.empty
+            self.offset = 0
+        elif self.offset > self.compactSize:
+            self.__compact()
+
+    def partial(self):
+        """ Return and consume any trailing text without a newline """
+        line = self.buffer[self.offset:]
+        self.buffer = self.empty
+        self.offset = 0
+        return line
+
+    def apiLine(self, line:bytes):
+        """ Yield the complete dialog lines after adding an API envelope's data """
+        msg = apiMessage(line)
+        if (msg is not None) and ("data" in msg):
+            self.put(msg["data"])
+        return self.lines()
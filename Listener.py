@@ -8,21 +8,25 @@
 #  Reading a file with the API's output
 #  Reading a log file
 #
+# With --apiListen several --glider options may be given, in which case all the gliders
+# are listened to from this one process, see Multiplexer.py
+#
 # July-2020, Pat Welch, pat@mousebrains.com
 
 import argparse
 import logging
-import re
-import json
 import subprocess
 import MyLogger
 from Dialog import Dialog
+from LineFramer import LineFramer
+from Multiplexer import Multiplexer
 
 class Listener:
     def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger, dialog:Dialog) -> None:
         self.args = args
         self.logger = logger
         self.dialog = dialog
+        self.__framer = LineFramer()
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
@@ -38,31 +42,20 @@ class Listener:
                 help="Where SFMC's API JavaScripts are located")
         grp.add_argument("--apiCopy", type=str, metavar="filename",
                 help="Write out a copy of what is read from the API")
-        grp.add_argument("--glider", type=str, required=True, metavar="name",
-                help="Name of glider to operate on")
+        grp.add_argument("--glider", type=str, action="append", required=True, metavar="name",
+                help="Name of glider to operate on, may be repeated with --apiListen")
 
     def __procLine(self, line:str) -> None:
         self.logger.debug("%s", line.strip())
         self.dialog.put(line)
 
-    def __procBuffer(self, buffer:str, qPartial:bool = False) -> str:
-        while len(buffer):
-            index = buffer.find("\n")
-            if index < 0: # No newline found
-                if qPartial:
-                    self.__procLine(buffer)
-                    return ""
-                return buffer
-            self.__procLine(buffer[0:(index+1)])
-            buffer = buffer[(index+1):]
-        return ""
-
-    def __apiLine(self, line:bytearray, buffer:str) -> str:
-        a = re.fullmatch(bytes(r"([{].+[}])\x00\n", "utf-8"), line)
-        if a is None: return buffer
-        msg = json.loads(a[1])
-        if "data" not in msg: return buffer
-        return self.__procBuffer(buffer + msg["data"], False)
+    def __procLines(self, lines) -> None:
+        for line in lines:
+            self.__procLine(line)
+
+    def __procPartial(self) -> None:
+        line = self.__framer.partial()
+        if len(line): self.__procLine(line)
 
     def __apiListen(self) -> bool:
         args = self.args
@@ -77,10 +70,9 @@ class Listener:
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT) as p:
             fp = None if args.apiCopy is None else open(args.apiCopy, "ab")
-            buffer = ""
             while True:
                 line = p.stdout.readline()
-                if re.match(b"Error attempting to get glider data", line) is not None:
+                if line.startswith(b"Error attempting to get glider data"):
                     logger.error("ERROR executing\ncmd=%s\ndir=%s\n%s", cmd, args.apiDir, line)
                     raise Exception("Error starting API Listener")
 
@@ -89,32 +81,33 @@ class Listener:
                 if fp is not None:
                     fp.write(line)
                     fp.flush()
-                buffer = self.__apiLine(line, buffer)
+                self.__procLines(self.__framer.apiLine(line))
             if fp is not None: fp.close()
-            self.__procBuffer(buffer, True)
+            self.__procPartial()
         return True
 
     def __apiInput(self, fn:str) -> bool:
         logger = self.logger
         logger.info("Opening %s", fn)
+        framer = self.__framer
         with open(fn, "rb") as fp:
-            buffer= ""
             for line in fp:
-                buffer = self.__apiLine(line, buffer)
-            self.__procBuffer(buffer, True) # partial line
+                self.__procLines(framer.apiLine(line))
+            self.__procPartial() # partial line
         return False
 
     def __dialogInput(self, fn:str) -> bool:
         logger = self.logger
         logger.info("Opening %s", fn)
+        framer = self.__framer
         with open(fn, "r") as fp:
-            buffer = ""
             while True:
                 txt = fp.read(1024)
                 if len(txt) == 0: # EOF
-                    self.__procBuffer(buffer, True)
+                    self.__procPartial()
                     return False
-                buffer = self.__procBuffer(buffer + txt)
+                framer.put(txt)
+                self.__procLines(framer.lines())
         return False
 
     def listen(self) -> bool:
@@ -129,16 +122,27 @@ parser = argparse.ArgumentParser(description="Glider Dialog Listener")
 MyLogger.addArgs(parser)
 Listener.addArgs(parser)
 Dialog.addArgs(parser)
+Multiplexer.addArgs(parser)
 args = parser.parse_args()
 
+if len(args.glider) == 1:
+    args.glider = args.glider[0]
+elif not args.apiListen:
+    parser.error("Multiple --glider options require --apiListen")
+
 logger = MyLogger.mkLogger(args)
 
 logger.info("args=%s", args)
 
-dialog = Dialog(args, logger)
-dialog.start() # Start the update thread
+if isinstance(args.glider, list): # Multiple gliders in this process
+    listener = Multiplexer(args, logger)
+    listener.start() # Start the shared sinks and each glider's dialog thread
+    dialog = listener
+else:
+    dialog = Dialog(args, logger)
+    dialog.start() # Start the update thread
 
-listener = Listener(args, logger, dialog)
+    listener = Listener(args, logger, dialog)
 
 try:
     while listener.listen():
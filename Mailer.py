@@ -0,0 +1,189 @@
+#
+# A shared mail thread
+#
+# Messages are queued, so whoever sends mail never waits on SMTP,
+# messages with the same sender, recipients, and subject are coalesced into a digest
+# which is sent once per --mailWindow, and repeats of an identical message, i.e. an
+# exception storm, are counted rather than included in the digest. Operational mail, such
+# as goto files, is queued with a window of 0, so it is sent straight away on its own.
+# The SMTP connection is reused between digests and closed once idle.
+
+import argparse
+import logging
+import queue
+import smtplib
+import threading
+import time
+from MyBaseThread import MyBaseThread
+
+class Digest:
+    """ Messages waiting to be sent together """
+    maxBodies = 100 # Beyond this many unique bodies, only count them
+
+    def __init__(self, t:float) -> None:
+        self.tSend = t # When to send this digest
+        self.bodies = [] # Unique bodies
+        self.repeats = {} # Number of times each key was seen, keyed on key
+        self.keys = {} # Index into bodies, keyed on key
+        self.dropped = 0 # Bodies beyond maxBodies
+
+    def add(self, body:str, key) -> None:
+        if (len(self.bodies) >= self.maxBodies) and (key not in self.keys):
+            self.dropped += 1
+        elif key is None:
+            self.bodies.append(body)
+        elif key in self.keys:
+            self.repeats[key] += 1
+        else:
+            self.keys[key] = len(self.bodies)
+            self.repeats[key] = 1
+            self.bodies.append(body)
+
+    def message(self, subject:str) -> tuple:
+        n = len(self.bodies) + sum(self.repeats.values()) - len(self.repeats) + self.dropped
+        if n > 1:
+            subject += " ({} messages)".format(n)
+        counts = {}
+        for key in self.keys:
+            counts[self.keys[key]] = self.repeats[key]
+        msg = []
+        for index in range(len(self.bodies)):
+            body = self.bodies[index]
+            cnt = counts.get(index, 1)
+            if cnt > 1:
+                body = "Repeated {} times\n".format(cnt) + body
+            msg.append(body)
+        if self.dropped:
+            msg.append("{} more messages were dropped".format(self.dropped))
+        return (subject, ("\n\n" + "-" * 72 + "\n\n").join(msg))
+
+class Mailer(MyBaseThread):
+    __shared = None
+    __lock = threading.Lock()
+
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "Mailer", args, logger)
+        self.__queue = queue.Queue()
+        self.__flushed = threading.Event()
+        self.host = args.smtpHost
+        self.window = args.mailWindow
+        self.idle = args.mailIdle
+        self.smtp = None
+        self.tLast = None # When smtp was last used
+
+    @staticmethod
+    def addArgs(grp) -> None:
+        grp.add_argument("--mailWindow", type=float, default=60, metavar="seconds",
+                help="Coalesce mail with the same subject sent within this window")
+        grp.add_argument("--mailIdle", type=float, default=300, metavar="seconds",
+                help="Close the SMTP connection after being idle this long")
+
+    @classmethod
+    def shared(cls, args:argparse.ArgumentParser, logger:logging.Logger):
+        """ The process wide mailer, started on first use """
+        with cls.__lock:
+            if cls.__shared is None:
+                cls.__shared = cls(args, logger)
+                cls.__shared.start()
+            return cls.__shared
+
+    def put(self, frm:str, to:list, subject:str, body:str, key=None,
+            window:float = None) -> None:
+        """ Queue a message, messages with the same key in a window are counted, not repeated
+            window overrides --mailWindow, 0 to send it without waiting """
+        self.__queue.put((frm, tuple(to), subject, body, key, window))
+
+    def waitToFinish(self, timeout:float = None) -> bool:
+        """ Send everything pending now, and wait for it to be sent """
+        self.__flushed.clear()
+        self.__queue.put(None)
+        return self.__flushed.wait(timeout)
+
+    def runAndCatch(self) -> None: # Called on start
+        q = self.__queue
+        pending = {} # Digests keyed on (frm, to, subject)
+
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if pending:
+                timeout = max(0, min(map(lambda x: x.tSend, pending.values())) - now)
+            elif self.smtp is not None:
+                timeout = max(0, self.tLast + self.idle - now)
+
+            try:
+                item = q.get(timeout=timeout)
+                if item is None: # Flush request
+                    self.__send(pending, None)
+                    self.__flushed.set()
+                else:
+                    (frm, to, subject, body, key, window) = item
+                    ident = (frm, to, subject)
+                    tSend = time.monotonic() + (self.window if window is None else window)
+                    if ident not in pending:
+                        pending[ident] = Digest(tSend)
+                    pending[ident].tSend = min(pending[ident].tSend, tSend)
+                    pending[ident].add(body, key)
+                q.task_done()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            self.__send(pending, now)
+            if (not pending) and (self.smtp is not None) and (now - self.tLast) >= self.idle:
+                self.__close()
+
+    def __send(self, pending:dict, now:float) -> None:
+        """ Send digests which are due, or all of them if now is None """
+        for ident in list(pending):
+            digest = pending[ident]
+            if (now is not None) and (digest.tSend > now): continue
+            del pending[ident]
+            (frm, to, subject) = ident
+            (subject, body) = digest.message(subject)
+            msg = []
+            msg.append("From: " + frm)
+            msg.append("To: " + ",".join(to))
+            msg.append("Subject: " + subject)
+            msg.append("")
+            msg = "\r\n".join(msg)
+            msg += body
+            self.__sendmail(frm, to, msg)
+
+    def __sendmail(self, frm:str, to:tuple, msg:str) -> None:
+        for attempt in range(2): # Retry once on a fresh connection
+            try:
+                if self.smtp is None:
+                    self.smtp = smtplib.SMTP(self.host)
+                self.smtp.sendmail(frm, list(to), msg)
+                self.tLast = time.monotonic()
+                return
+            except:
+                self.__close()
+                if attempt:
+                    self.logger.exception("Error sending mail to %s from %s", ",".join(to), frm)
+
+    def __close(self) -> None:
+        if self.smtp is None: return
+        try:
+            self.smtp.quit()
+        except:
+            pass
+        self.smtp = None
+
+class MailHandler(logging.Handler):
+    """ Logging handler which queues records to the shared Mailer """
+    def __init__(self, mailer:Mailer, frm:str, to:list, subject:str) -> None:
+        logging.Handler.__init__(self)
+        self.mailer = mailer
+        self.frm = frm
+        self.to = to
+        self.subject = subject
+
+    def emit(self, record:logging.LogRecord) -> None:
+        if record.threadName == self.mailer.name: return # Don't mail about mailing
+        try:
+            key = (record.pathname, record.lineno, record.getMessage())
+            self.mailer.put(self.frm, self.to, self.subject, self.format(record), key)
+        except:
+            self.handleError(record)
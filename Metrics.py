@@ -0,0 +1,200 @@
+#
+# Counters, gauges, and latency histograms for each stage of packet processing
+#
+# Stages record into the process wide registry, metrics, which is exposed in
+# Prometheus' text format on a local HTTP port, --metricsPort, and/or periodically
+# written to a stats file, --metricsFile.
+
+import argparse
+import logging
+import os
+import time
+import queue
+import threading
+import bisect
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from MyBaseThread import MyBaseThread
+
+class Counter:
+    def __init__(self, name:str, help:str) -> None:
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n:float = 1) -> None:
+        with self.lock:
+            self.value += n
+
+    def render(self) -> list:
+        return [
+                "# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} counter".format(self.name),
+                "{} {}".format(self.name, self.value),
+                ]
+
+class Gauge:
+    """ A value sampled when rendered, i.e. a queue's depth """
+    def __init__(self, name:str, help:str, fn) -> None:
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> list:
+        return [
+                "# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} gauge".format(self.name),
+                "{} {}".format(self.name, self.fn()),
+                ]
+
+class Histogram:
+    """ Latencies in seconds """
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self, name:str, help:str) -> None:
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(self.buckets) + 1) # Last is +Inf
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, dt:float) -> None:
+        index = bisect.bisect_left(self.buckets, dt)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += dt
+
+    def time(self):
+        """ Context manager which observes the time spent in its block """
+        return Timer(self)
+
+    def render(self) -> list:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        msg = [
+                "# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} histogram".format(self.name),
+                ]
+        n = 0
+        for index in range(len(self.buckets)):
+            n += counts[index]
+            msg.append('{}_bucket{{le="{}"}} {}'.format(self.name, self.buckets[index], n))
+        n += counts[-1]
+        msg.append('{}_bucket{{le="+Inf"}} {}'.format(self.name, n))
+        msg.append("{}_sum {}".format(self.name, total))
+        msg.append("{}_count {}".format(self.name, n))
+        return msg
+
+class Timer:
+    def __init__(self, hist:Histogram) -> None:
+        self.hist = hist
+
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.hist.observe(time.monotonic() - self.t0)
+        return False
+
+class Registry:
+    def __init__(self) -> None:
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def __get(self, cls, name:str, *argv):
+        with self.lock:
+            if name not in self.items:
+                self.items[name] = cls(name, *argv)
+            return self.items[name]
+
+    def counter(self, name:str, help:str) -> Counter:
+        return self.__get(Counter, name, help)
+
+    def histogram(self, name:str, help:str) -> Histogram:
+        return self.__get(Histogram, name, help)
+
+    def gauge(self, name:str, help:str, fn) -> Gauge:
+        return self.__get(Gauge, name, help, fn)
+
+    def render(self) -> str:
+        with self.lock:
+            items = [self.items[name] for name in sorted(self.items)]
+        msg = []
+        for item in items:
+            msg.extend(item.render())
+        return "\n".join(msg) + "\n"
+
+metrics = Registry() # Process wide registry
+
+class TimedQueue(queue.Queue):
+    """ A queue which records how long each item waited in it """
+    def __init__(self, name:str, help:str, maxsize:int = 0) -> None:
+        queue.Queue.__init__(self, maxsize)
+        self.hist = metrics.histogram(name + "_wait_seconds", help + " wait time")
+        metrics.gauge(name + "_depth", help + " depth", self.qsize)
+
+    def _put(self, item) -> None:
+        self.queue.append((time.monotonic(), item))
+
+    def _get(self):
+        (t, item) = self.queue.popleft()
+        self.hist.observe(time.monotonic() - t)
+        return item
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = bytes(metrics.render(), "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args) -> None:
+        pass # Don't write scrapes to stderr
+
+class MetricsServer(MyBaseThread):
+    """ Serve metrics over HTTP and/or write them to a file periodically """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "Metrics", args, logger)
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Metrics options")
+        grp.add_argument("--metricsPort", type=int, metavar="port",
+                help="Local port to serve Prometheus metrics on")
+        grp.add_argument("--metricsHost", type=str, default="127.0.0.1", metavar="address",
+                help="Address to serve metrics on")
+        grp.add_argument("--metricsFile", type=str, metavar="filename",
+                help="File to periodically write metrics to")
+        grp.add_argument("--metricsInterval", type=float, default=60, metavar="seconds",
+                help="How often to write --metricsFile")
+
+    @staticmethod
+    def qEnabled(args:argparse.ArgumentParser) -> bool:
+        return (args.metricsPort is not None) or (args.metricsFile is not None)
+
+    def runAndCatch(self) -> None: # Called on start
+        args = self.args
+        if args.metricsPort is not None:
+            server = ThreadingHTTPServer((args.metricsHost, args.metricsPort), MetricsHandler)
+            server.daemon_threads = True
+            thr = threading.Thread(target=server.serve_forever, daemon=True, name="MetricsHTTP")
+            thr.start()
+            self.logger.info("Serving metrics on %s:%s", args.metricsHost, args.metricsPort)
+        if args.metricsFile is None: return
+
+        while True:
+            time.sleep(args.metricsInterval)
+            try:
+                tmp = args.metricsFile + ".tmp"
+                with open(tmp, "w") as fp:
+                    fp.write(metrics.render())
+                os.replace(tmp, args.metricsFile) # Readers never see a partial file
+            except:
+                self.logger.exception("Error writing %s", args.metricsFile)
@@ -0,0 +1,159 @@
+#
+# Listen to several gliders' dialogs via SFMC's API in a single process
+#
+# Each glider has its own output_glider_dialog_data.js pipe, line framers, and Dialog/Update
+# state, while the goto sinks, API, MailTo, Archiver, and Filer, are shared by all gliders.
+# The pipes are multiplexed with a selector, so adding a glider costs a pipe, not a process.
+
+import argparse
+import logging
+import copy
+import os
+import time
+import selectors
+import subprocess
+from Dialog import Dialog
+from Update import mkSinks
+from LineFramer import LineFramer
+
+class GliderPipe:
+    """ A glider's API pipe, and where its dialog lines are routed to """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger, sinks:list) -> None:
+        self.args = args
+        self.logger = logger
+        self.glider = args.glider
+        self.dialog = Dialog(args, logger, sinks)
+        self.dialog.name = "Dialog({})".format(self.glider)
+        self.cmd = (args.nodeCommand, "output_glider_dialog_data.js", self.glider)
+        self.pipe = None
+        self.fp = None # API copy
+        self.tRestart = 0 # When the pipe may be reopened
+        self.envelopes = LineFramer(newline=b"\n") # Raw lines from the API script
+        self.framer = LineFramer() # Dialog lines
+
+    def open(self):
+        args = self.args
+        self.pipe = subprocess.Popen(self.cmd,
+                cwd=args.apiDir,
+                shell=False,
+                bufsize=0,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+        if args.apiCopy is not None:
+            self.fp = open(args.apiCopy, "ab")
+        self.logger.info("Opened pipe for %s", " ".join(self.cmd))
+        return self.pipe.stdout
+
+    def close(self, tRestart:float) -> None:
+        pipe = self.pipe
+        self.pipe = None
+        self.tRestart = tRestart
+        try:
+            pipe.stdout.close()
+            if pipe.poll() is None: pipe.kill()
+            pipe.wait()
+        except:
+            self.logger.exception("Closing pipe for %s", self.glider)
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+        self.envelopes.partial() # Drop any partial envelope
+        line = self.framer.partial()
+        if len(line): self.dialog.put(line)
+
+    def read(self) -> bool:
+        """ Read what is available from the pipe, returns False when the pipe should be closed """
+        data = os.read(self.pipe.stdout.fileno(), 65536)
+        if not data: return False # Broken connection
+        self.envelopes.put(data)
+        for line in self.envelopes.lines():
+            if line.startswith(b"Error attempting to get glider data"):
+                self.logger.error("ERROR executing\ncmd=%s\ndir=%s\n%s",
+                        self.cmd, self.args.apiDir, line)
+                return False
+            if self.fp is not None:
+                self.fp.write(line)
+                self.fp.flush()
+            for item in self.framer.apiLine(line):
+                self.logger.debug("%s %s", self.glider, item.strip())
+                self.dialog.put(item)
+        return True
+
+class Multiplexer:
+    """ Route each glider's API pipe to its own Dialog with shared goto sinks """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        if args.apiDir is None:
+            raise Exception("You must specify --apiDir when using --apiListen")
+        self.sinks = mkSinks(args, logger)
+        self.gliders = []
+        for glider in args.glider:
+            self.gliders.append(GliderPipe(self.gliderArgs(args, glider), logger, self.sinks))
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Multiple glider options")
+        grp.add_argument("--apiRestart", type=float, default=10, metavar="seconds",
+                help="How long to wait before restarting a glider's failed API pipe")
+
+    @staticmethod
+    def gliderArgs(args:argparse.ArgumentParser, glider:str) -> argparse.ArgumentParser:
+        """ Copy of args for a single glider, replacing {glider} in per glider filenames """
+        a = copy.copy(args)
+        a.glider = glider
+        for key in ("gliderDB", "wptsDB"): # These would mix gliders if shared
+            val = getattr(a, key)
+            if (val is not None) and ("{glider}" not in val):
+                raise Exception("--" + key + " must contain {glider} with multiple gliders")
+        for key in ("gliderDB", "wptsDB", "apiCopy"):
+            val = getattr(a, key)
+            if val is not None:
+                setattr(a, key, val.replace("{glider}", glider))
+        return a
+
+    def start(self) -> None:
+        for thr in self.sinks:
+            thr.start()
+        for gp in self.gliders:
+            gp.dialog.start()
+
+    def join(self) -> None:
+        for gp in self.gliders:
+            gp.dialog.join()
+
+    def listen(self) -> bool:
+        logger = self.logger
+        delay = self.args.apiRestart
+        sel = selectors.DefaultSelector()
+
+        while True:
+            now = time.monotonic()
+            timeout = None
+            for gp in self.gliders:
+                if gp.pipe is not None: continue
+                if now >= gp.tRestart:
+                    try:
+                        sel.register(gp.open(), selectors.EVENT_READ, gp)
+                        continue
+                    except:
+                        logger.exception("Unable to open pipe for %s", gp.glider)
+                    if gp.pipe is not None: # Opened, but apiCopy or register failed
+                        gp.close(now + delay)
+                    else:
+                        gp.tRestart = now + delay
+                    timeout = delay if timeout is None else min(timeout, delay)
+                else:
+                    dt = gp.tRestart - now
+                    timeout = dt if timeout is None else min(timeout, dt)
+
+            for (key, mask) in sel.select(timeout):
+                gp = key.data
+                try:
+                    if gp.read(): continue
+                except:
+                    logger.exception("Error reading pipe for %s", gp.glider)
+                logger.info("Closing pipe for %s", gp.glider)
+                sel.unregister(key.fileobj)
+                gp.close(time.monotonic() + delay)
+        return True
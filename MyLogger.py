@@ -1,6 +1,10 @@
 #
 # Construct a logger object
 #
+# Records are put on a queue by the logging thread, and written to the logfile, stream,
+# and mail handlers by a QueueListener thread, so disk and SMTP latency stay off the
+# packet paths. Records below WARNING are rate limited per call site.
+#
 # Feb-2020, Pat Welch, pat@mousebrains.com
 
 import argparse
@@ -8,6 +12,44 @@ import logging
 import logging.handlers
 import getpass
 import socket
+import atexit
+import queue
+import threading
+import time
+from Mailer import Mailer, MailHandler
+
+class RateLimit(logging.Filter):
+    """ Allow at most rate records per second, with bursts of up to burst, per call site
+        Records at WARNING and above are always passed """
+    def __init__(self, rate:float, burst:int) -> None:
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.sites = {} # [tokens, tLast, nSuppressed] keyed on (pathname, lineno)
+        self.lock = threading.Lock()
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING: return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None:
+                site = [self.burst, now, 0]
+                self.sites[key] = site
+            tokens = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if tokens < 1:
+                site[0] = tokens
+                site[2] += 1
+                return False
+            site[0] = tokens - 1
+            nSuppressed = site[2]
+            site[2] = 0
+        if nSuppressed:
+            record.msg = record.getMessage() + " ({} similar suppressed)".format(nSuppressed)
+            record.args = None
+        return True
 
 def addArgs(parser:argparse.ArgumentParser) -> None:
     grp = parser.add_argument_group('Logger Related Options')
@@ -17,6 +59,10 @@ def addArgs(parser:argparse.ArgumentParser) -> None:
     grp.add_argument('--logCount', type=int, default=3, metavar='count',
             help='Number of backup files to keep')
     grp.add_argument('--verbose', action='store_true', help='Enable verbose logging')
+    grp.add_argument('--logRate', type=float, default=10, metavar='perSecond',
+            help='Maximum debug/info records per second from each call site, 0 for no limit')
+    grp.add_argument('--logBurst', type=int, default=100, metavar='count',
+            help='Burst of debug/info records allowed from each call site')
     grp.add_argument("--mailTo", action="append", metavar="foo@bar.com",
             help="Where to mail errors and exceptions to")
     grp.add_argument("--mailFrom", type=str, metavar="foo@bar.com",
@@ -25,9 +71,11 @@ def addArgs(parser:argparse.ArgumentParser) -> None:
             help="Mail subject line")
     grp.add_argument("--smtpHost", type=str, default="localhost", metavar="foo.bar.com",
             help="SMTP server to mail to")
+    Mailer.addArgs(grp)
 
 def mkLogger(args:argparse.ArgumentParser) -> logging.Logger:
     logger = logging.getLogger()
+    handlers = []
     if args.logfile:
         ch = logging.handlers.RotatingFileHandler(args.logfile,
                 maxBytes=args.logBytes,
@@ -45,7 +93,7 @@ def mkLogger(args:argparse.ArgumentParser) -> logging.Logger:
     formatter = logging.Formatter('%(asctime)s %(threadName)s %(levelname)s: %(message)s')
     ch.setFormatter(formatter)
 
-    logger.addHandler(ch)
+    handlers.append(ch)
 
     if args.mailTo is not None:
         frm = args.mailFrom if args.mailFrom is not None else \
@@ -53,9 +101,21 @@ def mkLogger(args:argparse.ArgumentParser) -> logging.Logger:
         subj = args.mailSubject if args.mailSubject is not None else \
                 ("Error on " + socket.getfqdn())
 
-        ch = logging.handlers.SMTPHandler(args.smtpHost, frm, args.mailTo, subj)
+        mailer = Mailer.shared(args, logger)
+        atexit.register(mailer.waitToFinish, 30) # Send pending errors before exiting
+        ch = MailHandler(mailer, frm, args.mailTo, subj)
         ch.setLevel(logging.ERROR)
         ch.setFormatter(formatter)
-        logger.addHandler(ch)
+        handlers.append(ch)
+
+    q = queue.SimpleQueue()
+    ch = logging.handlers.QueueHandler(q)
+    if args.logRate > 0:
+        ch.addFilter(RateLimit(args.logRate, args.logBurst))
+    logger.addHandler(ch)
+
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Registered last, so drained before the mail flush
 
     return logger
@@ -10,6 +10,35 @@ import datetime as dt
 import logging
 from BitArray import BitArray
 
+def headerOffset(msg:bytes) -> int:
+    """ Offset of the MO header information element in a DirectIP message, or None """
+    if (len(msg) < 3) or (msg[0] != 1): return None # Not a version 1 message
+    offset = 3
+    while (offset + 3) <= len(msg): # Walk the information elements
+        n = int.from_bytes(msg[(offset+1):(offset+3)], "big")
+        if (msg[offset] == 1) and (n == 28) and ((offset + 31) <= len(msg)):
+            return offset
+        offset += 3 + n
+    return None
+
+def getIMEI(msg:bytes) -> str:
+    """ IMEI from the MO header, without decoding the rest of the message, or None """
+    offset = headerOffset(msg)
+    if offset is None: return None
+    return str(msg[(offset+7):(offset+22)], "utf-8", "replace")
+
+def jsonable(record:dict) -> dict:
+    """ record with times as ISO 8601 strings and binary fields as hex, for json.dumps """
+    out = {}
+    for key in record:
+        val = record[key]
+        if isinstance(val, dt.datetime):
+            val = val.isoformat()
+        elif isinstance(val, (bytes, bytearray, memoryview)):
+            val = bytes(val).hex()
+        out[key] = val
+    return out
+
 class Message(dict):
     """ A Mobile Originated message decoded """
     def __init__(self, msg:bytes, logger:logging.Logger) -> None:
@@ -151,21 +180,16 @@ class Message(dict):
         and
         https://github.com/darren1713/GSatMicroPublic/blob/master/GSatMicroLibrary/GSatMicroPosition.cs
         """
-        self.logger.info("msg=%s", msg)
-        self.logger.info("int=%s", int.from_bytes(msg, "big"))
-        self.logger.info("bin=%s", "{:0152b}".format(int.from_bytes(msg, "big")))
         bits = BitArray(msg)
-        self.logger.info("GPS18 %s", msg)
-        self.logger.info("GPS18\n%s", bits)
+        if self.logger.isEnabledFor(logging.DEBUG): # Don't build the dump unless it is used
+            self.logger.debug("GPS18 %s\n%s", msg, bits)
 
         magic = bits.getInt(0, 3)
-        self.logger.info("magic %s %s", bits.get(0, 3), magic)
         if magic != 0:
             self.logger.error("Invalid magic in 18Byte message, %s, %s", magic, msg)
             return
 
         self['longitude'] = bits.getFloat(3, 26) / 186413 - 180
-        self.logger.info("lon %s %s %s", bits.get(3,26), bits.getInt(3,26), self['longitude'])
         self['extPwr'] = bits.getInt(29, 1) != 0
         self['qDistress'] = bits.getInt(30, 1) != 0
         self['qCheckin'] = bits.getInt(31, 1) != 0
@@ -0,0 +1,144 @@
+#
+# Monthly partitions of the packet database
+#
+# With Writer's --partition, packets received in August 2020 are written to
+# GSatMicro.2020-08.db next to GSatMicro.db, so each month is its own file. Once a month
+# is over its file is never written again, so it can be backed up or archived as is.
+# Readers use connect, which attaches the partitions read only and creates temporary
+# views, so MOM and Raw can still be queried as single tables. Any rows in the original
+# unpartitioned file are included, as the oldest partition. Closed partitions are only
+# ever rewritten to a new file which replaces the old one, see compactDB.py.
+# SQLite can only attach maxAttached files at once, so a query over more of them, such as
+# a long history, is run on each of batches' connections and the results merged.
+#
+# Readers only ever open the files read only. The Writer uses WAL mode, so readers and
+# the Writer do not block each other, and reader, below, keeps each thread's connection
+# open between queries instead of opening the files again every time.
+
+import datetime
+import glob
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+maxAttached = 10 # SQLite's default limit on attached databases
+readers = threading.local() # Each thread's open reader connections, see reader
+
+def name(dbName:str, t:datetime.datetime) -> str:
+    """ Partition file for packets received at time t """
+    (base, ext) = os.path.splitext(dbName)
+    return "{}.{}{}".format(base, t.strftime("%Y-%m"), ext)
+
+def partitions(dbName:str) -> list:
+    """ Existing partition files, oldest first """
+    (base, ext) = os.path.splitext(dbName)
+    return sorted(glob.glob(glob.escape(base) + ".[0-9][0-9][0-9][0-9]-[0-9][0-9]" + ext))
+
+def files(dbName:str) -> list:
+    """ The unpartitioned file, if it exists, followed by the partitions, oldest first """
+    return ([dbName] if os.path.exists(dbName) else []) + partitions(dbName)
+
+def qClosed(dbName:str, fn:str) -> bool:
+    """ Is fn a partition before last month, which the Writer is finished with? """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    lastMonth = name(dbName, now.replace(day=1) - datetime.timedelta(days=1))
+    return (fn != dbName) and (fn in partitions(dbName)) and (fn < lastMonth)
+
+def uri(fn:str, qImmutable:bool = False) -> str:
+    """ Read only URI for fn """
+    uri = "file:" + urllib.parse.quote(os.path.abspath(fn)) + "?mode=ro"
+    # Closed partitions are only replaced, never modified, so SQLite can skip locking them.
+    # The Writer checkpoints a partition's WAL when it moves on to the next, but immutable
+    # ignores the WAL, so the file is only opened immutable if its WAL is gone or empty.
+    if qImmutable and not qWAL(fn): uri += "&immutable=1"
+    return uri
+
+def qWAL(fn:str) -> bool:
+    """ Does fn have rows in a WAL file which are not in fn itself? """
+    try:
+        return os.path.getsize(fn + "-wal") > 0
+    except FileNotFoundError:
+        return False
+
+def recent(dbName:str, months:int = None) -> list:
+    """ files, only the last months of them unless months is None """
+    names = files(dbName)
+    if months is not None: names = names[-months:]
+    return names
+
+def after(dbName:str, t:datetime.datetime) -> list:
+    """ files which may hold rows received at or after t, oldest first """
+    first = name(dbName, t)
+    return list(filter(lambda x: (x == dbName) or (x >= first), files(dbName)))
+
+def attach(dbName:str, names:list, tables:tuple, timeout:float) -> tuple:
+    """ (connection with names attached read only, tables which have a view) """
+    conn = sqlite3.connect("file::memory:", uri=True, timeout=timeout)
+    for (i, fn) in enumerate(names):
+        conn.execute("ATTACH DATABASE ? AS p{};".format(i), (uri(fn, qClosed(dbName, fn)),))
+
+    views = []
+    for tbl in tables:
+        selects = []
+        for i in range(len(names)):
+            sql = "SELECT name FROM p{}.sqlite_master".format(i)
+            sql+= " WHERE type='table' AND name=? COLLATE NOCASE;"
+            if conn.execute(sql, (tbl,)).fetchone() is not None:
+                selects.append("SELECT * FROM p{}.{}".format(i, tbl))
+        if selects:
+            conn.execute("CREATE TEMP VIEW " + tbl + " AS " + " UNION ALL ".join(selects) + ";")
+            views.append(tbl)
+    return (conn, views)
+
+def connect(dbName:str, months:int = None, tables:tuple = ("MOM", "Raw"),
+        timeout:float = 5) -> sqlite3.Connection:
+    """ Read only connection with tables as views over the most recent months' partitions,
+        or all of them if months is None. An unpartitioned database is opened directly.
+        timeout is how long to wait for the Writer's lock.
+        For more than maxAttached files use batches. """
+    parts = partitions(dbName)
+    if not parts: return sqlite3.connect(uri(dbName), uri=True, timeout=timeout)
+
+    names = recent(dbName, months)
+    if len(names) > maxAttached:
+        raise Exception("{} partitions of {} is more than {} can be attached".format(
+            len(names), dbName, maxAttached))
+    return attach(dbName, names, tables, timeout)[0]
+
+def batches(dbName:str, names:list = None, tables:tuple = ("MOM", "Raw"),
+        timeout:float = 5):
+    """ Read only connections over names, all the files if None, oldest first, each with at
+        most maxAttached of them attached. Batches without any of tables are skipped.
+        Each connection is closed once the next one is asked for. """
+    if not partitions(dbName): # Opened directly, as by connect
+        if not os.path.exists(dbName): return
+        conn = sqlite3.connect(uri(dbName), uri=True, timeout=timeout)
+        try:
+            yield conn
+        finally:
+            conn.close()
+        return
+    if names is None: names = files(dbName)
+    for i in range(0, len(names), maxAttached):
+        (conn, views) = attach(dbName, names[i:(i + maxAttached)], tables, timeout)
+        try:
+            if views: yield conn
+        finally:
+            conn.close()
+
+def reader(dbName:str, months:int = None, tables:tuple = ("MOM", "Raw"),
+        timeout:float = 5) -> sqlite3.Connection:
+    """ connect's connection, kept open for reuse by this thread until a partition is
+        added or replaced """
+    key = (dbName, months, tables)
+    state = tuple(map(lambda x: (x, os.stat(x).st_ino), recent(dbName, months)))
+    conns = readers.__dict__.setdefault("conns", {})
+    if key in conns:
+        (conn, prev) = conns[key]
+        if prev == state: return conn
+        conn.close()
+        del conns[key]
+    conn = connect(dbName, months, tables, timeout)
+    conns[key] = (conn, state)
+    return conn
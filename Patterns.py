@@ -2,11 +2,45 @@
 #
 # Load a YAML file containing the pattern
 #
+# Each glider's pattern is compiled once, when loaded, into a NumPy array of offsets, and
+# rotated along the drifter's heading once per heading rather than once per waypoint.
+# PatternWatcher reloads the file in the background when it changes, and swaps in the
+# newly compiled patterns, so looking up a pattern while making a goto costs nothing.
+#
 # July-2020, Pat Welch, pat@mousebrains.com
 
+import argparse
+import logging
+import copy
 import math
+import os
+import threading
+import time
 import yaml
-from WayPoint import Pattern
+import numpy as np
+from WayPoint import Pattern, Point
+from MyBaseThread import MyBaseThread
+
+class CompiledPattern(list):
+    """ A glider's Pattern objects, with their offsets in an array """
+    def __init__(self, offsets:np.ndarray, qRotate:bool) -> None:
+        self.offsets = offsets # n by 2, eastward and northward meters
+        self.qRotate = qRotate
+        self.lock = threading.Lock()
+        self.theta = None # Heading self.points were rotated to
+        self.points = None
+        list.__init__(self, [Pattern(float(x), float(y), qRotate, self, i)
+            for (i, (x, y)) in enumerate(offsets)])
+
+    def rotated(self, theta:float, index:int) -> Point:
+        """ Pattern index's offset rotated by theta radians """
+        with self.lock:
+            if (self.points is None) or (theta != self.theta):
+                (c, s) = (math.cos(theta), math.sin(theta))
+                xy = self.offsets @ np.array([[c, s], [-s, c]]) # All of them at once
+                self.points = [Point(float(x), float(y)) for (x, y) in xy]
+                self.theta = theta
+            return copy.copy(self.points[index])
 
 class Patterns(dict):
     """ A dictionary of Pattern objects """
@@ -16,7 +50,6 @@ class Patterns(dict):
             with open(fn, 'r') as fp:
                 data = yaml.safe_load(fp)
                 for glider in data:
-                    print(glider, data[glider])
                     data[glider]["patterns"] = self.__toPattern(data[glider])
                 self.update(data)
         except Exception as e:
@@ -24,39 +57,25 @@ class Patterns(dict):
             raise e
 
     @staticmethod
-    def __transform(info:dict) -> list:
+    def __transform(info:dict) -> np.ndarray:
         patterns = info["pattern"] if "pattern" in info else []
         theta = info["theta"] if "theta" in info else None
         norm = info["norm"] if "norm" in info else 1
+        offsets = np.array(patterns, dtype=float).reshape(-1, 2)
 
         if (theta is not None) and (theta != 0):
             theta = math.radians(theta) # Degrees -> radians
-            stheta = math.sin(theta)
-            ctheta = math.cos(theta)
-            items = []
-            for item in patterns:
-                x = ctheta * item[0] - stheta * item[1]
-                y = stheta * item[0] + ctheta * item[1]
-                items.append((x, y))
-            patterns = items
+            (c, s) = (math.cos(theta), math.sin(theta))
+            offsets = offsets @ np.array([[c, s], [-s, c]])
 
         if (norm is not None) and (norm != 1):
-            items = []
-            for item in patterns:
-                x = norm * item[0]
-                y = norm * item[1]
-                items.append((x, y))
-            patterns = items
+            offsets = offsets * norm
 
-        return patterns
+        return offsets
 
-    def __toPattern(self, info:dict) -> list:
-        patterns = self.__transform(info)
+    def __toPattern(self, info:dict) -> CompiledPattern:
         qRotate = info['qRotate'] if 'qRotate' in info else False
-        items = []
-        for pattern in patterns:
-            items.append(Pattern(pattern[0], pattern[1], qRotate))
-        return items
+        return CompiledPattern(self.__transform(info), qRotate)
 
     def qGlider(self, glider:str) -> bool:
         return glider in self
@@ -76,6 +95,51 @@ class Patterns(dict):
         if "IMEI" not in self[glider]: return None
         return self[glider]["IMEI"]
 
+class PatternWatcher(MyBaseThread):
+    """ Keep the compiled patterns from a file current """
+    watchers = {} # By filename, so gliders in one process share a watcher
+    lock = threading.Lock()
+
+    @classmethod
+    def get(cls, args:argparse.ArgumentParser, logger:logging.Logger):
+        with cls.lock:
+            if args.pattern not in cls.watchers:
+                watcher = PatternWatcher(args, logger)
+                watcher.start()
+                cls.watchers[args.pattern] = watcher
+            return cls.watchers[args.pattern]
+
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "Patterns", args, logger)
+        self.fn = args.pattern
+        self.stat = None # (mtime, size, inode) when last loaded
+        self.patterns = None # Replaced, never modified, so readers need no lock
+        self.__load() # So the first goto has patterns
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Pattern options")
+        grp.add_argument("--patternCheck", type=float, default=5, metavar="seconds",
+                help="How often to check if the pattern file has changed")
+
+    def __load(self) -> None:
+        try:
+            info = os.stat(self.fn)
+        except FileNotFoundError:
+            return
+        stat = (info.st_mtime_ns, info.st_size, info.st_ino)
+        if stat == self.stat: return # Unchanged
+        self.stat = stat
+        try:
+            self.patterns = Patterns(self.fn)
+            self.logger.info("Loaded patterns for %s", ", ".join(sorted(self.patterns)))
+        except:
+            self.logger.exception("Unable to load %s, keeping the previous patterns", self.fn)
+
+    def runAndCatch(self) -> None: # Called on thread start
+        while True:
+            time.sleep(self.args.patternCheck)
+            self.__load()
 
 if __name__ == "__main__":
     import argparse
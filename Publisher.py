@@ -0,0 +1,212 @@
+#
+# Stream each MOM row the Writer commits to subscribers on a TCP and/or Unix socket
+#
+# A subscriber connects and sends one line of JSON, or an empty line for everything:
+#   {"IMEI": ["300534061845790", "30053406*"], "format": "json"}
+# IMEI limits the stream to those beacons, a trailing * matching every IMEI starting with
+# what precedes it. format is json, one JSON object per line, or binary, fixed size
+# records of binary.format, below, with NaN for anything a fix lacks.
+# Each subscriber has its own thread and a queue of at most --pubQueue rows. When a
+# subscriber falls that far behind, --pubSlow decides if it is disconnected, drop, or
+# its oldest rows are discarded, skip, so a slow subscriber never holds up the Writer.
+
+import argparse
+import logging
+import json
+import math
+import os
+import queue
+import socket
+import struct
+import threading
+from MyBaseThread import MyBaseThread
+from Metrics import metrics
+from ParseMessage import jsonable
+
+pubRecords = metrics.counter("pub_records_total", "Rows published")
+pubDropped = metrics.counter("pub_dropped_total", "Slow subscribers disconnected")
+pubSkipped = metrics.counter("pub_skipped_total", "Rows discarded for slow subscribers")
+
+# IMEI, seconds since the epoch, latitude, longitude, accuracy, speed, heading, battery
+binary = struct.Struct("<15sdddffff")
+
+def encodeBinary(row:dict) -> bytes:
+    vals = []
+    for key in ("latitude", "longitude", "accuracy", "speed", "heading", "battery"):
+        val = row.get(key)
+        vals.append(math.nan if val is None else float(val))
+    return binary.pack(bytes(row["IMEI"], "utf-8"), row["t"].timestamp(), *vals)
+
+class Filter:
+    """ Which IMEIs a subscriber wants, None for all of them """
+    def __init__(self, IMEIs:list = None) -> None:
+        self.exact = None
+        self.prefixes = ()
+        if IMEIs is None: return
+        self.exact = set()
+        prefixes = set()
+        for IMEI in map(str, IMEIs):
+            if IMEI.endswith("*"):
+                prefixes.add(IMEI[:-1])
+            else:
+                self.exact.add(IMEI)
+            if "*" in IMEI[:-1]:
+                raise Exception("Only a trailing * wildcard is supported, " + IMEI)
+        self.prefixes = tuple(prefixes)
+
+    def __contains__(self, IMEI:str) -> bool:
+        if self.exact is None: return True
+        return (IMEI in self.exact) or IMEI.startswith(self.prefixes)
+
+class Subscriber(MyBaseThread):
+    """ Read a subscription, then send matching rows until disconnected """
+    def __init__(self, conn:socket.socket, name:str, publisher,
+            args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "SUB:" + name, args, logger)
+        self.conn = conn
+        self.publisher = publisher
+        self.q = queue.Queue(maxsize=args.pubQueue)
+        self.filter = None
+        self.format = "json"
+
+    def put(self, data:dict) -> bool:
+        """ Called from the Writer with each row's encodings, False to disconnect """
+        try:
+            self.q.put_nowait(data[self.format])
+            return True
+        except queue.Full:
+            pass
+        if self.args.pubSlow == "drop": return False
+        try: # Discard the oldest row to make room
+            self.q.get_nowait()
+            pubSkipped.inc()
+        except queue.Empty:
+            pass
+        try:
+            self.q.put_nowait(data[self.format])
+        except queue.Full:
+            pubSkipped.inc()
+        return True
+
+    def close(self) -> None:
+        try:
+            self.q.put_nowait(None) # Wake the thread
+        except queue.Full:
+            pass
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def __subscribe(self) -> None:
+        line = b""
+        while not line.endswith(b"\n"):
+            data = self.conn.recv(4096)
+            if not data: raise Exception("Closed before subscribing")
+            line += data
+            if len(line) > 65536: raise Exception("Subscription too long")
+        info = json.loads(line) if line.strip() else {}
+        self.format = info.get("format", "json")
+        if self.format not in ("json", "binary"):
+            raise Exception("Unknown format, " + str(self.format))
+        self.filter = Filter(info.get("IMEI"))
+
+    def runAndCatch(self) -> None: # Called on thread start
+        conn = self.conn
+        try:
+            conn.settimeout(self.args.pubTimeout)
+            self.__subscribe()
+            self.logger.info("Subscribed format %s", self.format)
+            self.publisher.add(self)
+            while True:
+                data = self.q.get()
+                if data is None: break
+                conn.sendall(data)
+        except:
+            self.logger.info("Disconnected", exc_info=self.logger.isEnabledFor(logging.DEBUG))
+        finally:
+            self.publisher.remove(self)
+            conn.close()
+
+class PubListener(MyBaseThread):
+    """ Accept subscribers on a socket """
+    def __init__(self, s:socket.socket, name:str, publisher,
+            args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        MyBaseThread.__init__(self, "PUB:" + name, args, logger)
+        self.s = s
+        self.publisher = publisher
+
+    def runAndCatch(self) -> None: # Called on thread start
+        self.logger.info("Listening")
+        while True:
+            (conn, addr) = self.s.accept()
+            name = "{}:{}".format(addr[0], addr[1]) if isinstance(addr, tuple) else "unix"
+            Subscriber(conn, name, self.publisher, self.args, self.logger).start()
+
+class Publisher:
+    """ Writer sink sending each row to its subscribers """
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        metrics.gauge("pub_subscribers", "Connected subscribers", lambda: len(self.subscribers))
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Publish/subscribe options")
+        grp.add_argument("--pubPort", type=int, metavar="port",
+                help="TCP port to stream fixes to subscribers on")
+        grp.add_argument("--pubHost", type=str, default="127.0.0.1", metavar="address",
+                help="Address to listen for subscribers on")
+        grp.add_argument("--pubSocket", type=str, metavar="filename",
+                help="Unix socket to stream fixes to subscribers on")
+        grp.add_argument("--pubQueue", type=int, default=1000, metavar="count",
+                help="Rows queued per subscriber before it is considered slow")
+        grp.add_argument("--pubSlow", type=str, default="drop", choices=("drop", "skip"),
+                help="Disconnect slow subscribers, or discard their oldest rows")
+        grp.add_argument("--pubTimeout", type=float, default=30, metavar="seconds",
+                help="Disconnect subscribers which take this long to subscribe or receive")
+
+    @staticmethod
+    def qEnabled(args:argparse.ArgumentParser) -> bool:
+        return (args.pubPort is not None) or (args.pubSocket is not None)
+
+    def start(self) -> None:
+        args = self.args
+        if args.pubPort is not None:
+            s = socket.create_server((args.pubHost, args.pubPort))
+            PubListener(s, "{}:{}".format(args.pubHost, args.pubPort), self,
+                    args, self.logger).start()
+        if args.pubSocket is not None:
+            if os.path.exists(args.pubSocket): os.unlink(args.pubSocket) # From a previous run
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.bind(args.pubSocket)
+            s.listen()
+            PubListener(s, args.pubSocket, self, args, self.logger).start()
+
+    def add(self, sub:Subscriber) -> None:
+        with self.lock:
+            self.subscribers.add(sub)
+
+    def remove(self, sub:Subscriber) -> None:
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def put(self, row:dict) -> None:
+        """ Called by the Writer with each committed MOM row """
+        pubRecords.inc()
+        with self.lock:
+            subs = [x for x in self.subscribers if row["IMEI"] in x.filter]
+        if not subs: return
+        data = {} # Each encoding is only built if somebody wants it
+        if any(map(lambda x: x.format == "json", subs)):
+            data["json"] = bytes(json.dumps(jsonable(row)) + "\n", "utf-8")
+        if any(map(lambda x: x.format == "binary", subs)):
+            data["binary"] = encodeBinary(row)
+        for sub in subs:
+            if not sub.put(data):
+                pubDropped.inc()
+                self.logger.warning("Disconnecting slow subscriber %s", sub.name)
+                self.remove(sub)
+                sub.close()
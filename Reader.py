@@ -5,33 +5,56 @@
 # Feb-2020, Pat Welch, pat@mousebrains.com
 
 from datetime import datetime, timezone
+import time
 import socket
 import queue
 import argparse
 import logging
 from MyBaseThread import MyBaseThread
+from Metrics import metrics
+
+recvHist = metrics.histogram("reader_receive_seconds", "Connection accepted until message complete")
+recvBytes = metrics.counter("reader_bytes_total", "Bytes received")
+recvMsgs = metrics.counter("reader_messages_total", "Messages received")
+recvErrors = metrics.counter("reader_errors_total", "Exceptions while receiving")
+recvDuplicates = metrics.counter("reader_duplicates_total", "Retransmitted messages dropped")
 
 class Reader(MyBaseThread):
     ''' Read from a connection, parse it, and send to the output queue '''
-    def __init__(self, conn, addr, logger:logging.Logger, q:list):
+    def __init__(self, conn, addr, logger:logging.Logger, q:list, dedup = None, journal = None):
         MyBaseThread.__init__(self, "Reader({}:{})".format(addr[0], addr[1]), None, logger)
         self.conn = conn
         self.addr = addr
         self.q = q
+        self.dedup = dedup
+        self.journal = journal
 
     def runAndCatch(self) -> None:
         '''Called on thread start '''
         try:
             msg = b''
+            nChunks = 0
             with self.conn as conn:
                 t0 = datetime.now(tz=timezone.utc)
+                tStart = time.monotonic()
                 while True: # Get the whole message until the socket is closed
                     data = conn.recv(8192) # Get the data
-                    self.logger.debug('data=%s', data)
                     if not data: break # connection has dropped
                     msg += data
-            vals = (t0, self.addr, msg)
+                    nChunks += 1
+            recvHist.observe(time.monotonic() - tStart)
+            recvBytes.inc(len(msg))
+            recvMsgs.inc()
+            self.logger.debug('Received %s bytes in %s chunks', len(msg), nChunks)
+            if (self.dedup is not None) and self.dedup.qDuplicate(msg):
+                recvDuplicates.inc()
+                self.logger.info('Dropped duplicate of %s bytes from %s', len(msg), self.addr)
+                return
+            # Durable in the journal before anyone else sees it
+            seq = None if self.journal is None else self.journal.append(t0, self.addr, msg)
+            vals = (t0, self.addr, msg, seq)
             for q in self.q:
                 q.put(vals)
         except:
+            recvErrors.inc()
             self.logger.exception('Exception while reading from address %s', self.addr)
@@ -0,0 +1,70 @@
+#
+# Load a YAML file routing IMEIs to forwarding destinations
+#
+# partnerA:                    # Name of the route, for reference
+#     destinations:            # Where to send these beacons' messages
+#     - partner.example.com:11000
+#     IMEI:                    # Which beacons, quote them so YAML keeps them as strings
+#     - "300534061845790"
+#     - "30053406*"            # A trailing * matches every IMEI starting with 30053406
+#
+# The routes are compiled into hash tables, and each IMEI's destinations are cached,
+# so routing costs the same however many partners and beacons there are.
+# IMEIs which match no route are sent to the default destinations.
+
+import os
+import yaml
+
+class Routes:
+    """ Destinations for each IMEI """
+    maxCache = 100000 # Forget cached lookups past this many IMEIs
+
+    def __init__(self, fn:str, default:tuple = ()) -> None:
+        self.fn = fn
+        self.default = default
+        self.mtime = os.stat(fn).st_mtime_ns
+        self.exact = {} # Destinations by IMEI
+        self.prefixes = {} # Destinations by IMEI prefix
+        self.cache = {} # Lookup results by IMEI
+        destinations = set()
+        with open(fn, "r") as fp:
+            data = yaml.safe_load(fp) or {}
+        for name in data:
+            info = data[name]
+            dests = set(map(self.__destination, info.get("destinations") or []))
+            destinations.update(dests)
+            for IMEI in map(str, info.get("IMEI") or []):
+                if IMEI.endswith("*"):
+                    IMEI = IMEI[:-1]
+                    tbl = self.prefixes
+                else:
+                    tbl = self.exact
+                if "*" in IMEI:
+                    raise Exception("Only a trailing * wildcard is supported, {} in {}".format(
+                        IMEI, name))
+                tbl.setdefault(IMEI, set()).update(dests)
+        self.lengths = sorted(set(map(len, self.prefixes))) # Prefix lengths to try
+        self.nDestinations = len(destinations)
+
+    def __repr__(self) -> str:
+        return "{} IMEIs and {} prefixes routed to {} destinations from {}".format(
+                len(self.exact), len(self.prefixes), self.nDestinations, self.fn)
+
+    @staticmethod
+    def __destination(dest:str) -> str:
+        (host, port) = str(dest).rsplit(":", 1)
+        int(port) # Raises an exception if this isn't host:port
+        return "{}:{}".format(host, port)
+
+    def qChanged(self) -> bool:
+        return os.stat(self.fn).st_mtime_ns != self.mtime
+
+    def lookup(self, IMEI:str) -> tuple:
+        if IMEI in self.cache: return self.cache[IMEI]
+        names = set(self.exact.get(IMEI, ()))
+        for n in self.lengths:
+            names.update(self.prefixes.get("" if IMEI is None else IMEI[:n], ()))
+        names = tuple(sorted(names)) if names else self.default
+        if len(self.cache) >= self.maxCache: self.cache.clear()
+        self.cache[IMEI] = names
+        return names
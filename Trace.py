@@ -0,0 +1,102 @@
+#
+# Time each stage from a glider surfacing to its goto being deployed
+#
+# A Trace is created when Dialog sees the line which triggers an update, and travels with
+# the update through Update's queue, loading the glider state, estimating the drifter,
+# planning waypoints, and each of the goto sinks. Once every sink is done, one JSON
+# record of the stage timings is appended to --traceFile.
+
+import argparse
+import logging
+import datetime
+import json
+import threading
+import time
+import uuid
+
+class Stage:
+    def __init__(self, trace, name:str) -> None:
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.trace.span(self.name, self.t0)
+        return False
+
+class Trace:
+    __lock = threading.Lock() # Serialize writes to the trace file between gliders
+
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger,
+            glider:str, tLine:datetime.datetime) -> None:
+        self.fn = args.traceFile
+        self.logger = logger
+        self.id = uuid.uuid4().hex[:16]
+        self.glider = glider
+        self.tLine = tLine # When the triggering line was received
+        self.t0 = time.monotonic()
+        self.stages = {} # Seconds spent in each stage
+        self.info = {}
+        self.pending = 0 # Sinks which have not finished yet
+        self.lock = threading.Lock()
+        self.span("dialog", self.t0 -
+                (datetime.datetime.now(tz=datetime.timezone.utc) - tLine).total_seconds())
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Tracing options")
+        grp.add_argument("--traceFile", type=str, metavar="filename",
+                help="Append a JSON line of stage timings per update to this file")
+
+    def __repr__(self) -> str:
+        return self.id
+
+    def stage(self, name:str) -> Stage:
+        """ Context manager which times its block as stage name """
+        return Stage(self, name)
+
+    def span(self, name:str, t0:float) -> None:
+        """ Record stage name as having run from monotonic time t0 until now """
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + time.monotonic() - t0
+
+    def set(self, key:str, val) -> None:
+        with self.lock:
+            self.info[key] = val
+
+    def expect(self, n:int) -> None:
+        """ n sinks will call finish before the trace is complete """
+        with self.lock:
+            self.pending += n
+
+    def finish(self) -> None:
+        """ Called by each sink, and by Update, the last one writes the record """
+        with self.lock:
+            self.pending -= 1
+            if self.pending > 0: return
+        self.write()
+
+    def record(self) -> dict:
+        with self.lock:
+            rec = {
+                    "id": self.id,
+                    "glider": self.glider,
+                    "tLine": self.tLine.isoformat(),
+                    "total": self.stages.get("dialog", 0) + time.monotonic() - self.t0,
+                    "stages": dict(self.stages),
+                    }
+            rec.update(self.info)
+        return rec
+
+    def write(self) -> None:
+        if self.fn is None: return
+        line = json.dumps(self.record(), default=str) + "\n"
+        try:
+            with self.__lock:
+                with open(self.fn, "a") as fp:
+                    fp.write(line)
+        except OSError:
+            self.logger.exception("Unable to write trace %s to %s", self.id, self.fn)
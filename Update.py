@@ -10,28 +10,32 @@ import os.path
 import argparse
 import logging
 import queue
-import sqlite3
 import datetime
 import getpass
 import socket
 import subprocess
 import math
-from smtplib import SMTP
+import time
 from tempfile import NamedTemporaryFile
 import WayPoint
-from Patterns import Patterns
+from Patterns import Patterns, PatternWatcher
+import Partitions
 from Drifter import Drifter
 from WayPoints import WayPoints
 from MyBaseThread import MyBaseThread
-from geopy.distance import distance as geodesic
+from APIWorker import APIWorker
+from Mailer import Mailer
+from Trace import Trace
 
 class API(MyBaseThread):
     def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
         MyBaseThread.__init__(self, "API", args, logger)
         self.__queue = queue.Queue()
+        self.__worker = None if args.apiWorker is None else APIWorker(args, logger)
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
+        APIWorker.addArgs(parser)
         grp = parser.add_argument_group(description="Make Goto API Options")
         grp.add_argument("--gotoAPI", type=str, metavar="dir",
                 help="Use SFMC API to update and deploy goto file")
@@ -40,8 +44,8 @@ class API(MyBaseThread):
         grp.add_argument("--nodeCommand", type=str, metavar="filename", default="/usr/bin/node",
                 help="Full path to node command")
 
-    def put(self, glider:str, goto:str, maxDist:float) -> None:
-        self.__queue.put((glider, goto, maxDist))
+    def put(self, glider:str, goto:str, maxDist:float, trace:Trace = None) -> None:
+        self.__queue.put((glider, goto, maxDist, trace))
 
     def waitToFinish(self) -> None:
         self.__queue.join() # Don't return until all messages are processed
@@ -49,17 +53,36 @@ class API(MyBaseThread):
     def runAndCatch(self) -> None: # Called on start
         logger = self.logger
         q = self.__queue
+        worker = self.__worker
         logger.info("Starting")
 
         while True:
-            (glider, goto, maxDist) = q.get()
-            if goto is not None:
-                logger.debug("glider=%s goto\n%s", glider, goto)
-                self.__api(glider, goto)
-            q.task_done()
+            if worker is not None:
+                try:
+                    worker.start() # Keep the helper warm, restarting it if it died
+                except:
+                    logger.exception("Unable to start API helper")
+            try:
+                (glider, goto, maxDist, trace) = q.get(
+                        timeout=None if worker is None else self.args.apiCheck)
+            except queue.Empty:
+                continue
+            try:
+                if goto is not None:
+                    logger.debug("glider=%s goto\n%s", glider, goto)
+                    self.__api(glider, goto, trace)
+            except:
+                logger.exception("Error sending goto for %s trace %s", glider, trace)
+            finally:
+                if trace is not None: trace.finish()
+                q.task_done()
 
     def __apiRun(self, js, *argv) -> bool:
         args = self.args
+        if self.__worker is not None:
+            a = self.__worker.request(js, *argv)
+            if a is not None: return a
+            self.logger.warning("Falling back to spawning %s", js)
         cmd = [args.nodeCommand, js]
         cmd.extend(argv)
         a = subprocess.run(cmd, cwd=args.apiDir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -69,7 +92,7 @@ class API(MyBaseThread):
         self.logger.error("Error executing %s, rc=%s, %s", " ".join(cmd), a.returncode, a.stdout)
         return False
 
-    def __api(self, glider, goto:str) -> None:
+    def __api(self, glider, goto:str, trace:Trace) -> None:
         args = self.args
         logger = self.logger
         if args.gotoAPI is None: return
@@ -78,9 +101,15 @@ class API(MyBaseThread):
                 prefix="goto_list.", suffix=".ma", delete=False) as fp:
             fp.write(bytes(goto, 'utf-8'))
             fn = fp.name
+        t0 = time.monotonic()
         if self.__apiRun("update_waypoint_plan.js", glider, fn):
+            if trace is not None: trace.span("apiUpdate", t0)
+            t0 = time.monotonic()
             if self.__apiRun("deploy_goto_file.js", glider):
-                logger.info("Sent goto file for %s", glider)
+                if trace is not None:
+                    trace.span("apiDeploy", t0)
+                    trace.set("deployed", True)
+                logger.info("Sent goto file for %s trace %s", glider, trace)
 
         if not self.args.gotoRetain:
             os.unlink(fn)
@@ -100,8 +129,8 @@ class MailTo(MyBaseThread):
         grp.add_argument("--gotoMailFrom", type=str, metavar="foo@bar.com",
                 help="Who the email is coming from")
 
-    def put(self, glider:str, goto:str, maxDist:float) -> None:
-        self.__queue.put((glider, goto, maxDist))
+    def put(self, glider:str, goto:str, maxDist:float, trace:Trace = None) -> None:
+        self.__queue.put((glider, goto, maxDist, trace))
 
     def waitToFinish(self) -> None:
         self.__queue.join() # Don't return until all messages are processed
@@ -112,7 +141,7 @@ class MailTo(MyBaseThread):
         logger.info("Starting")
 
         while True:
-            (glider, goto, maxDist) = q.get()
+            (glider, goto, maxDist, trace) = q.get()
             if goto is None:
                 if maxDist is None:
                     goto = "Both goto and maxDist are None, probably no valid solution"
@@ -124,8 +153,11 @@ class MailTo(MyBaseThread):
             else:
                 subject = "Goto file for {}".format(glider)
 
-            self.__mailTo(goto, subject)
-            q.task_done()
+            try:
+                self.__mailTo(goto, subject)
+            finally:
+                if trace is not None: trace.finish()
+                q.task_done()
 
     def __mailTo(self, goto:str, subject:str) -> None:
         args = self.args
@@ -134,17 +166,9 @@ class MailTo(MyBaseThread):
             if args.gotoMailFrom is None:
                 args.gotoMailFrom = getpass.getuser() + "@" + socket.getfqdn()
                 self.logger.debug("mailFrom=%s", args.gotoMailFrom)
-            msg = []
-            msg.append("From: " + args.gotoMailFrom)
-            msg.append("To: " + ",".join(args.gotoMailTo))
-            msg.append("Subject: " + subject)
-            msg.append("")
-            msg = "\r\n".join(msg)
-            msg += goto
-            s = SMTP("localhost")
-            s.set_debuglevel(1)
-            s.sendmail(args.gotoMailFrom, args.gotoMailTo, msg)
-            s.quit()
+            mailer = Mailer.shared(args, self.logger)
+            mailer.put(args.gotoMailFrom, args.gotoMailTo, subject, goto,
+                    window=0) # Sent now, not held for a digest
         except:
             self.logger.exception("Error sending mail to %s from %s", 
                     ",".join(args.gotoMailTo), args.gotoMailFrom)
@@ -160,8 +184,8 @@ class Archiver(MyBaseThread):
         grp.add_argument("--gotoArchive", type=str, metavar="dir",
                 help="Archive a copy of the generated goto file")
 
-    def put(self, glider:str, goto:str, maxDist:float) -> None:
-        self.__queue.put((glider, goto, maxDist))
+    def put(self, glider:str, goto:str, maxDist:float, trace:Trace = None) -> None:
+        self.__queue.put((glider, goto, maxDist, trace))
 
     def waitToFinish(self) -> None:
         self.__queue.join() # Don't return until all messages are processed
@@ -172,11 +196,16 @@ class Archiver(MyBaseThread):
         logger.info("Starting")
 
         while True:
-            (glider, goto, maxDist) = q.get()
-            if goto is not None:
-                logger.debug("glider=%s goto\n%s", glider, goto)
-                self.__archiver(glider, goto)
-            q.task_done()
+            (glider, goto, maxDist, trace) = q.get()
+            try:
+                if goto is not None:
+                    logger.debug("glider=%s goto\n%s", glider, goto)
+                    self.__archiver(glider, goto)
+            except:
+                logger.exception("Error archiving goto for %s trace %s", glider, trace)
+            finally:
+                if trace is not None: trace.finish()
+                q.task_done()
 
     def __archiver(self, glider:str, goto:str) -> None:
         if self.args.gotoArchive is None: return
@@ -198,10 +227,11 @@ class Filer(MyBaseThread):
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
         grp = parser.add_argument_group(description="Make Goto File Options")
-        grp.add_argument("--gotoFile", type=str, metavar="filename", help="Write a goto filename")
+        grp.add_argument("--gotoFile", type=str, metavar="filename",
+                help="Write a goto filename, {glider} is replaced by the glider's name")
 
-    def put(self, glider:str, goto:str, maxDist:float) -> None:
-        self.__queue.put((glider, goto, maxDist))
+    def put(self, glider:str, goto:str, maxDist:float, trace:Trace = None) -> None:
+        self.__queue.put((glider, goto, maxDist, trace))
 
     def waitToFinish(self) -> None:
         self.__queue.join() # Don't return until all messages are processed
@@ -212,31 +242,45 @@ class Filer(MyBaseThread):
         logger.info("Starting")
 
         while True:
-            (glider, goto, maxDist) = q.get()
-            if goto is not None:
-                logger.debug("glider=%s goto\n%s", glider, goto)
-                self.__filer(glider, goto)
-            q.task_done()
+            (glider, goto, maxDist, trace) = q.get()
+            try:
+                if goto is not None:
+                    logger.debug("glider=%s goto\n%s", glider, goto)
+                    self.__filer(glider, goto)
+            except:
+                logger.exception("Error filing goto for %s trace %s", glider, trace)
+            finally:
+                if trace is not None: trace.finish()
+                q.task_done()
 
     def __filer(self, glider:str, goto:str) -> None:
         fn = self.args.gotoFile
         if fn is None: return
+        fn = fn.replace("{glider}", glider)
         with open(fn, "w") as fp:
             fp.write(goto)
 
+def mkSinks(args:argparse.ArgumentParser, logger:logging.Logger) -> list:
+    """ Threads which consume generated goto files, these may be shared between Updates """
+    return [
+            API(args, logger),
+            MailTo(args, logger),
+            Archiver(args, logger),
+            Filer(args, logger),
+            ]
+
 class Update(MyBaseThread):
-    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger,
+            sinks:list = None) -> None:
         MyBaseThread.__init__(self, "Update", args, logger)
         self.__queue = queue.Queue()
-        self.__threads = [
-                API(args, logger),
-                MailTo(args, logger),
-                Archiver(args, logger),
-                Filer(args, logger),
-                ]
+        self.__qOwnSinks = sinks is None # Am I responsible for starting the sinks?
+        self.__threads = mkSinks(args, logger) if sinks is None else sinks
 
+        self.__watcher = PatternWatcher.get(args, logger) # Reloads the pattern file for me
+        self.__patterns = None # Which of the watcher's Patterns self.__pattern is from
         self.__pattern = None
-        self.__patternTime = None
+        self.__patternEnabled = False
         self.__IMEI = None
         self.__newPattern = True
         self.wpts = None
@@ -254,6 +298,8 @@ class Update(MyBaseThread):
         Archiver.addArgs(parser)
         Filer.addArgs(parser)
         WayPoints.addArgs(parser)
+        Trace.addArgs(parser)
+        PatternWatcher.addArgs(parser)
         grp = parser.add_argument_group(description="Make Goto Options")
         grp.add_argument("--gotoDT", type=float, default=900, metavar="seconds",
                 help="How long will the glider spend on the surface")
@@ -263,31 +309,29 @@ class Update(MyBaseThread):
                 help="YAML file of patterns")
         grp.add_argument("--gotoTau", type = float, default=4*3600, metavar="seconds",
                 help="1/e weighting for speed weight in time")
+        grp.add_argument("--gliderTimeout", type=float, default=5, metavar="seconds",
+                help="How long to wait for the dialog's lock on the glider database")
 
     def waitToFinish(self) -> None:
         self.__queue.join()
         for thr in self.__threads:
             thr.waitToFinish()
 
-    def put(self, t, dbName) -> None:
-        self.__queue.put((t, dbName))
+    def put(self, t, dbName, trace:Trace = None) -> None:
+        self.__queue.put((t, dbName, trace, time.monotonic()))
 
     def __getPattern(self, glider:str) -> Patterns:
-        args = self.args
-        logger = self.logger
-        fn = args.pattern
-        if not os.path.isfile(fn):
-            raise Exception("Pattern file, " + fn + ", does not exist")
-        t = os.path.getmtime(fn)
-        if (self.__pattern is None) or (t > self.__patternTime):
-            a = Patterns(fn)
-            self.__patternTime = t
-            if not a.qGlider(glider):
-                raise Exception("Glider, " + glider + ", not in patterns, " + fn)
+        a = self.__watcher.patterns # Swapped in by the watcher when the file changes
+        if a is None:
+            raise Exception("Pattern file, " + self.args.pattern + ", does not exist")
+        if a is not self.__patterns:
+            if not a.qGlider(glider): # Checked again next time, until the file has glider
+                raise Exception("Glider, " + glider + ", not in patterns, " + self.args.pattern)
             self.__patternEnabled = a.qEnabled(glider)
             self.__pattern = a.pattern(glider)
             self.__IMEI = a.IMEI(glider)
             self.__newPattern = True
+            self.__patterns = a # Only once everything above has succeeded
 
         return self.__pattern
 
@@ -304,24 +348,16 @@ class Update(MyBaseThread):
         if ('c_wpt_lat' not in info) or ('c_wpt_lon' not in info):
             return None # current waypoint unknown
 
-        cLatLon = (info['c_wpt_lat'], info['c_wpt_lon'])
-        minDistance = args.gotoIndex
-        minIndex = None
-        for (wpt, dt, index) in self.wpts:
-            wpt = wpt.wpt # Actual lat/lon pair
-            wptLatLon = (wpt.lat, wpt.lon)
-            dist = geodesic(cLatLon, wptLatLon).meters
-            if dist < minDistance:
-                minDistance = dist
-                minIndex = index
-        return minIndex
+        # Vectorized over the previous plan's waypoints, projected to meters once
+        return self.wpts.nearest(info['c_wpt_lat'], info['c_wpt_lon'], args.gotoIndex)
 
     def __loadDB(self, dbName) -> dict:
         sql = "SELECT name,val FROM glider "
         sql+= "INNER JOIN "
         sql+= "(SELECT name AS nameMax, max(t) AS tMax FROM glider GROUP BY name) "
         sql+= "ON name=nameMax AND t=tMax;"
-        db = sqlite3.connect(dbName)
+        # Read only, and kept open between gotos, so the Dialog's writes are never blocked
+        db = Partitions.reader(dbName, tables=(), timeout=self.args.gliderTimeout)
         cur = db.cursor()
         cur.execute(sql)
         info = {}
@@ -381,7 +417,7 @@ class Update(MyBaseThread):
 
 
 
-    def __mkGoto(self, info:dict) -> tuple:
+    def __mkGoto(self, info:dict, trace:Trace) -> tuple:
         args = self.args
         logger = self.logger
         pattern = self.__pattern # Patterns to use
@@ -392,7 +428,8 @@ class Update(MyBaseThread):
         if now is None: now = datetime.datetime.now(tz=datetime.timezone.utc) # Unknown, so use now
         dt = self.args.gotoDT # How long the glider will be at the surfac3
         t0 = now + datetime.timedelta(seconds=dt) # Next dive time
-        d = drifter.estimate(t0) # Estimate where the drifter will be at t0
+        with trace.stage("drifter"):
+            d = drifter.estimate(t0) # Estimate where the drifter will be at t0
         dd = WayPoint.Drifter(d.at[0,'lat'], d.at[0,'lon'], d.at[0,'vx'], d.at[0,'vy'])
         dLat = float(d['vy'] * dt / d['latPerDeg']) # How far the glider will drift
         dLon = float(d['vx'] * dt / d['lonPerDeg'])
@@ -401,9 +438,11 @@ class Update(MyBaseThread):
         index = self.__getIndex(info)
         self.__newPattern = False
         try:
-            self.wpts = WayPoints(dd, glider, water, pattern, args, logger, 
-                    index=index) # Make waypoints
-            (goto, maxDist) = self.wpts.goto(now, self.__IMEI)
+            with trace.stage("waypoints"):
+                self.wpts = WayPoints(dd, glider, water, pattern, args, logger, 
+                        index=index) # Make waypoints
+            with trace.stage("goto"):
+                (goto, maxDist) = self.wpts.goto(now, self.__IMEI)
             return (goto, maxDist)
         except:
             logger.exception("Unable to make waypoints\nDIALOG:\n%s\nDRIFTER:\n%s\n%s", 
@@ -416,30 +455,53 @@ class Update(MyBaseThread):
         logger = self.logger
         q = self.__queue
         threads = self.__threads
-        for thr in threads: # Start my threads
-            thr.start()
+        if self.__qOwnSinks:
+            for thr in threads: # Start my threads
+                thr.start()
 
         logger.info("Starting")
 
         while True:
-            (t, dbName) = q.get()
-            logger.debug("t=%s dbName\n%s", t, dbName)
+            (t, dbName, trace, tQueued) = q.get()
             try:
-                pattern = self.__getPattern(args.glider) # Update the patterns if needed
-                args.IMEI = self.__IMEI # Which drifter beacon to fetch
+                self.__update(t, dbName, trace, tQueued)
             except:
-                logger.exception("Error getting patterns for %s", args.glider)
+                logger.exception("Unexpected exception updating for %s", t)
+            finally:
                 q.task_done()
-                continue
-            if self.__patternEnabled:
-                try:
+
+    def __update(self, t, dbName, trace:Trace, tQueued:float) -> None:
+        args = self.args
+        logger = self.logger
+        if trace is None: trace = Trace(args, logger, args.glider, t)
+        trace.span("queue", tQueued)
+        trace.expect(1) # Finished below, after the sinks have been given the goto
+        logger.debug("t=%s dbName %s trace %s", t, dbName, trace)
+        try:
+            with trace.stage("pattern"):
+                pattern = self.__getPattern(args.glider) # Update the patterns if needed
+            args.IMEI = self.__IMEI # Which drifter beacon to fetch
+        except:
+            logger.exception("Error getting patterns for %s trace %s", args.glider, trace)
+            trace.set("error", "pattern")
+            trace.finish()
+            return
+        if self.__patternEnabled:
+            try:
+                with trace.stage("loadDB"):
                     info = self.__loadDB(dbName)
-                    (goto, maxDist) = self.__mkGoto(info)
-                    for thr in threads:
-                        thr.put(args.glider, goto, maxDist)
-                except:
-                    logger.exception("Exception while updating")
-            q.task_done()
+                (goto, maxDist) = self.__mkGoto(info, trace)
+                trace.set("goto", goto is not None)
+                trace.set("maxDist", maxDist)
+                trace.expect(len(self.__threads))
+                for thr in self.__threads:
+                    thr.put(args.glider, goto, maxDist, trace)
+            except:
+                logger.exception("Exception while updating, trace %s", trace)
+                trace.set("error", "update")
+        else:
+            trace.set("enabled", False)
+        trace.finish()
 
 if __name__ == "__main__":
     import MyLogger
@@ -51,8 +51,33 @@
 
 import math
 import copy
+import numpy as np
 from geopy.distance import distance as geodesic
 
+class LocalIndex:
+    """ Points projected once to local meters, so distances to them are vectorized.
+        Over a pattern's few kilometers this is within a fraction of a meter of geodesic. """
+    def __init__(self, latLons:list) -> None:
+        latLons = np.array(latLons, dtype=float).reshape(-1, 2)
+        (self.lat0, self.lon0) = latLons.mean(axis=0) if len(latLons) else (0, 0)
+        self.latPerDeg = geodesic((self.lat0 - 0.5, self.lon0), (self.lat0 + 0.5, self.lon0)).meters
+        self.lonPerDeg = geodesic((self.lat0, self.lon0 - 0.5), (self.lat0, self.lon0 + 0.5)).meters
+        self.x = (latLons[:,1] - self.lon0) * self.lonPerDeg
+        self.y = (latLons[:,0] - self.lat0) * self.latPerDeg
+
+    def distances(self, lat, lon) -> np.ndarray:
+        """ Meters from each lat/lon to each point, one row per lat/lon """
+        x = (np.atleast_1d(np.asarray(lon, dtype=float)) - self.lon0) * self.lonPerDeg
+        y = (np.atleast_1d(np.asarray(lat, dtype=float)) - self.lat0) * self.latPerDeg
+        return np.hypot(x[:,np.newaxis] - self.x, y[:,np.newaxis] - self.y)
+
+    def nearest(self, lat:float, lon:float, radius:float) -> int:
+        """ Index of the nearest point closer than radius meters, or None """
+        if not len(self.x): return None
+        dist = self.distances(lat, lon)[0]
+        index = int(np.argmin(dist))
+        return index if dist[index] < radius else None
+
 class Point:
     def __init__(self, x:float, y:float) -> None:
         self.x = x
@@ -181,15 +206,20 @@ class Water:
 
 class Pattern:
     """ Data structure with pattern offset from center of drifter location """
-    def __init__(self, xOffset, yOffset, qRotate) -> None:
+    def __init__(self, xOffset, yOffset, qRotate, compiled = None, index:int = None) -> None:
         self.offset = Point(xOffset, yOffset)
         self.qRotate = qRotate
+        self.compiled = compiled # CompiledPattern this is index of, see Patterns.py
+        self.index = index
 
     def __repr__(self) -> str:
         return "PATTERN: {} {}".format(self.offset, self.qRotate)
 
     def rotate(self, theta:float) -> Point:
-        return self.offset.rotate(theta) if self.qRotate else self.offset
+        if not self.qRotate: return self.offset
+        if (self.compiled is not None) and (theta is not None):
+            return self.compiled.rotated(theta, self.index) # Rotated once per theta
+        return self.offset.rotate(theta)
 
 class WayPoint:
     def __init__(self, drifter:Drifter, glider:Glider, water:Water, pattern:Pattern) -> None:
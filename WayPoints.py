@@ -11,6 +11,7 @@ import copy
 import datetime
 import math
 import sqlite3
+import numpy as np
 from geopy.distance import distance as geodesic
 
 class WayPoints(list):
@@ -30,6 +31,7 @@ class WayPoints(list):
         self.args = args
         self.logger = logger
         self.index = index
+        self.__where = None # LocalIndex of my waypoints, made when first needed
 
         dt = 0
         drft = copy.deepcopy(drifter)
@@ -103,7 +105,15 @@ class WayPoints(list):
                 "#       theta: {:.1f} degrees true".format(w.v.theta()),
                 ]
 
-    def __checkForward(self, prev:list) -> float:
+    def nearest(self, lat:float, lon:float, radius:float) -> int:
+        """ Pattern index of my waypoint nearest lat/lon, if closer than radius meters """
+        if self.__where is None:
+            self.__where = WayPoint.LocalIndex([(w.wpt.lat, w.wpt.lon) for (w, dt, i) in self])
+        i = self.__where.nearest(lat, lon, radius)
+        return None if i is None else self[i][2]
+
+    def __checkForward(self, prev:list, distances:np.ndarray) -> float:
+        """ distances[i,i] is from my waypoint i to prev[i] """
         radius = self.args.wptsMatchRadius
         totalTime = 0
         maxDist = 0
@@ -112,20 +122,25 @@ class WayPoints(list):
             (t, iwpt, lat, lon, index, dist, dt) = prev[i]
             if iSelf != index: 
                 return None # Not the same pattern point
-            delta = wpt.wpt.distance(WayPoint.LatLon(lat, lon))
+            delta = distances[i, i]
             if delta > radius:
                 return None # Too far away
             totalTime += dt
             maxDist = max(maxDist, delta)
 
-        return maxDist if totalTime >= self.args.wptsMinDuration else None
+        return float(maxDist) if totalTime >= self.args.wptsMinDuration else None
 
     def __closeEnough(self, prev:list) -> float:
+        if not prev: return None
+        # Distances from each of my waypoints to each previous one, all at once
+        where = WayPoint.LocalIndex([(row[2], row[3]) for row in prev])
+        distances = where.distances([w.wpt.lat for (w, dt, i) in self],
+                [w.wpt.lon for (w, dt, i) in self])
         (wpt, dt, iSelf) = self[0]
         for j in range(len(prev)):
             (t, iwpt, lat, lon, index, dist, dt) = prev[j]
             if index == iSelf:
-                maxDist = self.__checkForward(prev[j:])
+                maxDist = self.__checkForward(prev[j:], distances[:,j:])
                 if maxDist is not None:
                     return maxDist
 
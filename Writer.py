@@ -3,13 +3,19 @@
 #
 # Feb-2020, Pat Welch, pat@mousebrains.com
 
-import queue
 import argparse
 import logging
 import sqlite3
+import time
 from datetime import datetime
 from ParseMessage import Message
+import Partitions
 from MyBaseThread import MyBaseThread
+from Metrics import metrics, TimedQueue
+
+parseHist = metrics.histogram("writer_parse_seconds", "Time to parse a message")
+commitHist = metrics.histogram("writer_commit_seconds", "Time to insert and commit a message")
+writeErrors = metrics.counter("writer_errors_total", "Exceptions while writing to the database")
 
 class Raw:
     def __init__(self, tbl:str, logger:logging.Logger) -> None:
@@ -17,17 +23,45 @@ class Raw:
         self.logger = logger
 
     def createTable(self, cur:sqlite3.Cursor) -> None:
+        # Older tables were keyed on t, so two connections at the same time collided
+        qMigrate = False
+        for row in cur.execute("PRAGMA table_info(" + self.tbl + ");"):
+            if (row[1] == "t") and row[5]: qMigrate = True
+        if qMigrate:
+            self.logger.info("Rekeying %s on rowid instead of t", self.tbl)
+            cur.execute("ALTER TABLE " + self.tbl + " RENAME TO " + self.tbl + "_old;")
+
+        # Rows are keyed on SQLite's rowid, which can not collide
         sql = "CREATE TABLE IF NOT EXISTS " + self.tbl + "( -- GSatMicro DirectIP packets\n"
-        sql+= "    t DATETIME WITH TIME ZONE PRIMARY KEY, -- timestamp when connection was made\n"
+        sql+= "    t DATETIME WITH TIME ZONE, -- timestamp when connection was made\n"
         sql+= "    addr TEXT, --IP address connection was from\n"
         sql+= "    port INTEGER, -- port number connection was from\n"
-        sql+= "    body BLOB -- Binary message\n"
+        sql+= "    body BLOB, -- Binary message\n"
+        sql+= "    seq INTEGER -- Journal sequence number, NULL if not journaled\n"
         sql+= ");"
         cur.execute(sql)
+        cur.execute("CREATE INDEX IF NOT EXISTS " + self.tbl + "_t ON " + self.tbl + "(t);")
+
+        # A journal replay of a packet already written is ignored, see insert
+        cols = set(map(lambda x: x[1], cur.execute("PRAGMA table_info(" + self.tbl + ");")))
+        if "seq" not in cols:
+            cur.execute("ALTER TABLE " + self.tbl + " ADD COLUMN seq INTEGER;")
+        sql = "CREATE UNIQUE INDEX IF NOT EXISTS " + self.tbl + "_seq"
+        sql+= " ON " + self.tbl + "(seq,t);" # t too, in case the journal is ever started afresh
+        cur.execute(sql)
+
+        if qMigrate:
+            sql = "INSERT INTO " + self.tbl + " (t,addr,port,body)"
+            sql+= " SELECT t,addr,port,body FROM " + self.tbl + "_old ORDER BY t;"
+            cur.execute(sql)
+            cur.execute("DROP TABLE " + self.tbl + "_old;")
 
-    def insert(self, cur:sqlite3.Cursor, t:datetime, addr:str, port:int, msg:bytes) -> None:
-        sql = "INSERT OR REPLACE INTO " + self.tbl + " VALUES(?,?,?,?);"
-        cur.execute(sql, (t, addr, port, msg))
+    def insert(self, cur:sqlite3.Cursor, t:datetime, addr:str, port:int, msg:bytes,
+            seq:int = None) -> bool:
+        """ Returns False if the journaled packet seq was already written """
+        sql = "INSERT OR IGNORE INTO " + self.tbl + " (t,addr,port,body,seq) VALUES(?,?,?,?,?);"
+        cur.execute(sql, (t, addr, port, msg, seq))
+        return cur.rowcount > 0
 
 class MOM:
     """ Mobile Originated Message """
@@ -74,9 +108,11 @@ class MOM:
         for row in cur.execute(sql):
             self.cols.add(row[1])
 
-    def insert(self, cur:sqlite3.Cursor, t:datetime, addr:str, port:int, msg:bytes) -> None:
-        a = Message(msg, self.logger)
-        if not a.qSave(): return
+    def insert(self, cur:sqlite3.Cursor, t:datetime, addr:str, port:int, msg:bytes) -> dict:
+        """ Returns the row inserted, or None """
+        with parseHist.time():
+            a = Message(msg, self.logger)
+        if not a.qSave(): return None
         names = ['tRecv']
         vals = [t]
         for key in a:
@@ -87,15 +123,22 @@ class MOM:
         sql+= "(" + ",".join(names) + ")"
         sql+= " VALUES(" + ",".join(["?"] * len(names)) + ");"
         cur.execute(sql, vals)
+        return dict(zip(names, vals))
 
 class Writer(MyBaseThread):
     ''' Wait on a queue, and write the item to a file '''
-    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger,
+            journal = None, sinks:list = ()) -> None:
         MyBaseThread.__init__(self, "Writer", args, logger)
+        self.journal = journal # Told when each journaled message is committed
+        self.sinks = sinks # Given each committed MOM row, with put
         self.dbName = args.db
         self.raw = Raw(args.raw, logger)
         self.mom = MOM(args.mom, logger)
-        self.q = queue.Queue()
+        self.q = TimedQueue("writer_queue", "Writer queue")
+        self.created = set() # Database files whose tables have been created
+        self.conn = None # Kept open between messages
+        self.connName = None # Which file self.conn is to
 
     @staticmethod
     def addArgs(parser:argparse.ArgumentParser) -> None:
@@ -106,29 +149,113 @@ class Writer(MyBaseThread):
                 help="Table name for raw information")
         grp.add_argument("--mom", type=str, default="MOM", metavar='name',
                 help="Table name for Mobile Originated Messages")
+        grp.add_argument("--partition", action="store_true",
+                help="Write each month to its own database file, see Partitions.py")
+        grp.add_argument("--dbJournalMode", type=str, default="WAL", choices=("WAL", "DELETE"),
+                help="SQLite journal mode, WAL lets readers and the writer work concurrently")
+        grp.add_argument("--dbTimeout", type=float, default=30, metavar="seconds",
+                help="How long to wait for another connection's lock")
+        grp.add_argument("--dbGiveUp", type=float, default=300, metavar="seconds",
+                help="How long to retry a message failing with a database or disk error")
 
-    def runAndCatch(self) -> None:
-        '''Called on thread start '''
-        self.logger.debug("Creating tables")
+    def __createTables(self, dbName:str) -> None:
+        self.logger.debug("Creating tables in %s", dbName)
         try:
-            with sqlite3.connect(self.dbName) as conn:
+            with sqlite3.connect(dbName, timeout=self.args.dbTimeout) as conn:
                 cur = conn.cursor()
+                cur.execute("PRAGMA auto_vacuum=INCREMENTAL;") # Only changes new databases
+                cur.execute("PRAGMA journal_mode=" + self.args.dbJournalMode + ";") # Persistent
                 self.raw.createTable(cur)
                 self.mom.createTable(cur)
                 conn.commit()
+            self.created.add(dbName)
         except:
-            self.logger.exception("Error creating tables in %s", self.dbName)
+            self.logger.exception("Error creating tables in %s", dbName)
+
+    def __dbName(self, t:datetime) -> str:
+        """ Database file to write a message received at time t to """
+        if not self.args.partition: return self.dbName
+        return Partitions.name(self.dbName, t)
+
+    def __connect(self, dbName:str) -> sqlite3.Connection:
+        """ Connection to dbName, reused until a message is for another file """
+        if self.connName != dbName:
+            self.__checkpoint() # Leaving a partition, which readers will later open immutable
+            self.__close()
+            if dbName not in self.created: self.__createTables(dbName)
+            self.conn = sqlite3.connect(dbName, timeout=self.args.dbTimeout)
+            self.connName = dbName
+        return self.conn
+
+    def __checkpoint(self) -> None:
+        """ Move everything in the WAL into the file and empty the WAL, readers still holding
+            connections keep SQLite from removing it when the last writer closes """
+        if self.conn is None: return
+        try:
+            (busy, nLog, nDone) = self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()
+            if busy:
+                self.logger.warning("Checkpoint of %s blocked by a reader, %s of %s pages",
+                        self.connName, nDone, nLog)
+        except:
+            self.logger.exception("Error checkpointing %s", self.connName)
+
+    def __close(self) -> None:
+        if self.conn is None: return
+        try:
+            self.conn.close()
+        except:
+            self.logger.exception("Error closing %s", self.connName)
+        self.conn = None
+        self.connName = None
+
+    def runAndCatch(self) -> None:
+        '''Called on thread start '''
+        if not self.args.partition: self.__createTables(self.dbName)
 
         while True: # Loop forever
-            (t, addr, msg) = self.q.get()
+            (t, addr, msg, seq) = self.q.get()
+            self.logger.info('t=%s addr=%s:%s n=%s', t, addr[0], addr[1], len(msg))
+            self.logger.debug('msg=%s', msg)
+            row = self.__write(t, addr, msg, seq)
+            for sink in self.sinks if row is not None else ():
+                try:
+                    sink.put(row)
+                except:
+                    self.logger.exception("Error giving a row to %s", sink)
+            if self.journal is not None: self.journal.done("writer", seq)
+            self.q.task_done()
+
+    def __write(self, t:datetime, addr:tuple, msg:bytes, seq:int) -> dict:
+        """ Insert and commit a message, returns the MOM row, or None if there is none,
+            it was written before, or it could not be written """
+        dbName = self.dbName
+        tGiveUp = time.monotonic() + self.args.dbGiveUp
+        attempt = 0
+        while True:
             try:
-                self.logger.info('t=%s addr=%s:%s msg=%s', t, addr[0], addr[1], msg)
-                with sqlite3.connect(self.dbName) as conn:
-                    self.logger.info('%s', msg)
+                dbName = self.__dbName(t)
+                conn = self.__connect(dbName)
+                with commitHist.time(), conn: # Commits, or rolls back on an exception
                     cur = conn.cursor()
-                    self.raw.insert(cur, t, addr[0], addr[1], msg)
-                    self.mom.insert(cur, t, addr[0], addr[1], msg)
-                    conn.commit()
-            except:
-                self.logger.exception('Exception while writing to %s', self.dbName)
-            self.q.task_done()
+                    if not self.raw.insert(cur, t, addr[0], addr[1], msg, seq):
+                        self.logger.info("Journal record %s was already written", seq)
+                        return None # Replayed, so the sinks have had it too
+                    return self.mom.insert(cur, t, addr[0], addr[1], msg)
+            except (sqlite3.OperationalError, OSError): # Locked, disk full, ..., so retry
+                writeErrors.inc()
+                self.__close() # Start afresh
+                self.logger.warning("Attempt %s of writing to %s failed", attempt + 1, dbName,
+                        exc_info=True)
+            except: # Trying again would fail again
+                writeErrors.inc()
+                self.__close() # Start afresh with the next message
+                self.logger.exception('Exception while writing to %s', dbName)
+                break
+            dt = min(2 ** attempt, 30)
+            attempt += 1
+            if (time.monotonic() + dt) > tGiveUp: break
+            time.sleep(dt)
+        self.logger.error("Giving up writing %s bytes from %s:%s to %s",
+                len(msg), addr[0], addr[1], dbName)
+        if self.journal is not None: self.journal.deadLetter(t, addr, msg, seq)
+        return None
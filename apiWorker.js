@@ -0,0 +1,99 @@
+#! /usr/bin/env node
+//
+// Long lived SFMC API helper for APIWorker.py, Update's --apiWorker
+//
+// Started once in --apiDir as
+//
+//   node apiWorker.js [module.js ...]
+//
+// it reads one JSON request per line on stdin:
+//
+//   {"id": 1, "script": "update_waypoint_plan.js", "argv": ["osu684", "goto_list.ma"]}
+//
+// and writes one JSON reply per request on stdout:
+//
+//   {"id": 1, "ok": true, "msg": ""}
+//
+// Requests are run one at a time, in the order they arrive.
+//
+// Each module.js named on the command line, --apiModule, is loaded once and kept loaded,
+// so anything it keeps at module level, such as an authenticated SFMC session, is reused
+// by every request. Such a module must not do its work when it is required, instead it
+// exports an async function called with the request's argv, which resolves once the work
+// is done and throws on an error:
+//
+//   async function main(argv) { ... }
+//   if (require.main === module) main(process.argv.slice(2)).catch(...);
+//   module.exports = main;
+//
+// Any other script is run in a child node, as Update does without the helper, and
+// succeeds if it exits with status 0 and prints nothing.
+//
+// Everything written to the console is sent to stderr, so stdout only carries replies.
+
+"use strict";
+
+const path = require("path");
+const readline = require("readline");
+const childProcess = require("child_process");
+
+const modules = new Set(process.argv.slice(2).map((x) => path.resolve(x)));
+const loaded = new Map(); // Exported function by filename
+
+for (const level of ["log", "info", "warn", "debug"]) {
+  console[level] = console.error;
+}
+
+function reply(id, ok, msg) {
+  process.stdout.write(JSON.stringify({id: id, ok: ok, msg: msg || ""}) + "\n");
+}
+
+function spawn(fn, argv) {
+  return new Promise((resolve) => {
+    childProcess.execFile(process.execPath, [fn].concat(argv),
+        {encoding: "utf8", maxBuffer: 16 * 1024 * 1024},
+        (err, stdout, stderr) => {
+          const output = (stdout || "") + (stderr || "");
+          if (err) {
+            resolve([false, "rc=" + err.code + ", " + (output || err.message)]);
+          } else {
+            resolve([output.length === 0, output]);
+          }
+        });
+  });
+}
+
+async function run(req) {
+  if ((typeof req.script !== "string") || !Array.isArray(req.argv)) {
+    return [false, "script and argv are required"];
+  }
+  const fn = path.resolve(req.script);
+  const argv = req.argv.map(String);
+  if (!modules.has(fn)) return spawn(fn, argv);
+  if (!loaded.has(fn)) {
+    const main = require(fn);
+    if (typeof main !== "function") throw new Error(fn + " does not export a function");
+    loaded.set(fn, main);
+  }
+  await loaded.get(fn)(argv);
+  return [true, ""];
+}
+
+let chain = Promise.resolve(); // Requests run one at a time
+
+readline.createInterface({input: process.stdin, terminal: false}).on("line", (line) => {
+  if (!line.trim()) return;
+  let req;
+  try {
+    req = JSON.parse(line);
+  } catch (err) {
+    console.error("Invalid request, " + line);
+    return;
+  }
+  chain = chain
+      .then(() => run(req))
+      .then(([ok, msg]) => reply(req.id, ok, msg),
+          (err) => reply(req.id, false, String((err && err.stack) || err)));
+}).on("close", () => {
+  chain.then(() => process.exit(0)); // APIWorker closed stdin, finish and exit
+});
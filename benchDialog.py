@@ -0,0 +1,127 @@
+#! /usr/bin/env python3
+#
+# Benchmark the Dialog/Update pipeline by replaying captured dialogs
+#
+# API captures, written by Listener.py --apiCopy, and/or plain dialog files are fed through
+# Dialog and Update as fast as they can be consumed. The goto sinks are replaced by a stub,
+# so nothing is sent to SFMC or mailed, and a scratch --gliderDB should be used.
+# Lines per second, the time from each FLAG line to its goto, and the peak memory
+# are reported. By default each FLAG's update finishes before the next line is fed,
+# as on a real glider, --pipelined feeds every line without waiting.
+
+import argparse
+import logging
+import json
+import resource
+import threading
+import time
+import tracemalloc
+import MyLogger
+from Dialog import Dialog, patterns
+from LineFramer import LineFramer
+
+class StubSink:
+    """ Stands in for the API, MailTo, Archiver, and Filer sinks """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.gotos = 0
+        self.noGotos = 0
+        self.latencies = [] # FLAG line to goto seconds
+
+    def put(self, glider:str, goto:str, maxDist:float, trace = None) -> None:
+        with self.lock:
+            if goto is None:
+                self.noGotos += 1
+            else:
+                self.gotos += 1
+            if trace is not None:
+                self.latencies.append(trace.record()["total"])
+        if trace is not None: trace.finish()
+
+    def waitToFinish(self) -> None:
+        pass
+
+def readLines(args:argparse.ArgumentParser) -> list:
+    """ Load every dialog line up front, so file reading isn't part of the timing """
+    lines = []
+    for fn in args.api:
+        framer = LineFramer()
+        with open(fn, "rb") as fp:
+            for line in fp:
+                lines.extend(framer.apiLine(line))
+        line = framer.partial()
+        if len(line): lines.append(line)
+    for fn in args.dialog:
+        with open(fn, "r") as fp:
+            lines.extend(fp)
+    return lines
+
+def percentile(vals:list, p:float) -> float:
+    if not vals: return None
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(p / 100 * len(vals)))]
+
+def bench(args:argparse.ArgumentParser, logger:logging.Logger) -> dict:
+    lines = readLines(args)
+    if args.tracemalloc: tracemalloc.start()
+    sink = StubSink()
+    dialog = Dialog(args, logger, [sink])
+    dialog.start()
+
+    flag = patterns[-1] # Line which triggers an update
+
+    t0 = time.monotonic()
+    for line in lines:
+        dialog.put(line)
+        if not args.pipelined and flag.expr.fullmatch(line.strip()):
+            dialog.waitToFinish() # Let the update finish, as the glider would
+    dialog.waitToFinish()
+    dt = time.monotonic() - t0
+
+    info = {
+            "lines": len(lines),
+            "seconds": dt,
+            "linesPerSecond": len(lines) / max(dt, 1e-9),
+            "gotos": sink.gotos,
+            "noGotos": sink.noGotos,
+            "flagToGotoMean": sum(sink.latencies) / len(sink.latencies) if sink.latencies else None,
+            "flagToGotoP50": percentile(sink.latencies, 50),
+            "flagToGotoP95": percentile(sink.latencies, 95),
+            "flagToGotoMax": max(sink.latencies) if sink.latencies else None,
+            "maxRSSkB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            }
+    if args.tracemalloc:
+        info["tracemallocPeak"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return info
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dialog/Update replay benchmark")
+    grp = parser.add_argument_group(description="Benchmark options")
+    grp.add_argument("--api", type=str, action="append", default=[], metavar="filename",
+            help="API capture, from Listener.py --apiCopy, to replay")
+    grp.add_argument("--dialog", type=str, action="append", default=[], metavar="filename",
+            help="Dialog file to replay")
+    grp.add_argument("--glider", type=str, required=True, metavar="name",
+            help="Name of glider in the pattern file")
+    grp.add_argument("--pipelined", action="store_true",
+            help="Don't wait for each FLAG's update before feeding more lines")
+    grp.add_argument("--tracemalloc", action="store_true",
+            help="Also report Python's peak traced allocation, slows things down")
+    grp.add_argument("--output", type=str, metavar="filename", help="Write results as JSON")
+    Dialog.addArgs(parser)
+    MyLogger.addArgs(parser)
+    args = parser.parse_args()
+
+    if not args.api and not args.dialog:
+        parser.error("Specify at least one --api or --dialog file")
+
+    logger = MyLogger.mkLogger(args)
+
+    info = bench(args, logger)
+
+    for key in info:
+        logger.info("%s %s", key, info[key])
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump(info, fp, indent=2)
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+#
+# Micro-benchmarks of the hot functions, with per machine baselines
+#
+# Each benchmark is timed with timeit, and the best time per call over --repeat runs is kept.
+# --save stores the results as this machine's baseline, --baselineDir/hostname.json, and
+# --compare flags any benchmark which is more than --threshold slower than the baseline,
+# exiting with a non-zero status if there are any.
+
+import argparse
+import logging
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import sqlite3
+import sys
+import tempfile
+import timeit
+import warnings
+from datetime import datetime, timedelta, timezone
+import MyLogger
+
+def mkFrame(*ies) -> bytes:
+    """ Wrap DirectIP information elements in a version 1 message """
+    body = b"".join(ies)
+    return (1).to_bytes(1, "big") + len(body).to_bytes(2, "big") + body
+
+def mkFaux():
+    """ Build fixed information elements with fauxDrifter's encoders """
+    from fauxDrifter import FauxDrifter
+    parser = argparse.ArgumentParser()
+    FauxDrifter.addArgs(parser)
+    args = parser.parse_args(["--IMEI", "15", "--seed", "1"])
+    dLogger = logging.getLogger("fauxDrifter") # Don't log every packet
+    dLogger.setLevel(logging.WARNING)
+    faux = FauxDrifter(args, dLogger)
+    return (bytes(faux.hdr.encode()), bytes(faux.location.encode()), bytes(faux.payload.encode()))
+
+def benchMessages(logger:logging.Logger) -> dict:
+    from ParseMessage import Message
+    (hdr, loc, gps18) = mkFaux()
+    reserved = bytes([2, 0, 1, 0]) # Payload block type 0
+    confirm = bytes([4, 0, 1, 1]) # Confirmation IE
+    frames = {
+            "header": mkFrame(hdr),
+            "location": mkFrame(hdr, loc),
+            "payloadReserved": mkFrame(hdr, reserved),
+            "payloadGPS18": mkFrame(hdr, loc, gps18),
+            "confirmation": mkFrame(hdr, confirm),
+            }
+    items = {}
+    for name in frames:
+        frame = frames[name]
+        items["Message." + name] = lambda frame=frame: Message(frame, logger)
+    return items
+
+def benchBitArray(logger:logging.Logger) -> dict:
+    from BitArray import BitArray
+    (hdr, loc, gps18) = mkFaux()
+    bits = BitArray(gps18[4:])
+    return {
+            "BitArray.init": lambda: BitArray(gps18[4:]),
+            "BitArray.getInt": lambda: bits.getInt(32, 29),
+            }
+
+def benchWayPoint(logger:logging.Logger) -> dict:
+    import WayPoint
+    from WayPoints import WayPoints
+    drifter = WayPoint.Drifter(44, -124, 0.1, 0.05)
+    glider = WayPoint.Glider(44.01, -124, 0.4)
+    water = WayPoint.Water(-0.1, 0.1)
+    patterns = [
+            WayPoint.Pattern(1000, 0, True),
+            WayPoint.Pattern(-1000, 0, True),
+            WayPoint.Pattern(0, 1000, True),
+            WayPoint.Pattern(0, -1000, True),
+            ]
+    args = argparse.Namespace(wptsTgtDuration=24*3600, wptsCount=7)
+    wpts = WayPoints(drifter, glider, water, patterns, args, logger, 0)
+    (lat, lon) = (wpts[-1][0].wpt.lat, wpts[-1][0].wpt.lon)
+    wpts.nearest(lat, lon, 100) # Project the plan before timing lookups
+    return {
+            "WayPoint.WayPoint": lambda: WayPoint.WayPoint(drifter, glider, water, patterns[0]),
+            "WayPoints.init": lambda: WayPoints(drifter, glider, water, patterns, args, logger, 0),
+            "WayPoints.nearest": lambda: wpts.nearest(lat, lon, 100),
+            }
+
+def benchDrifter(logger:logging.Logger, tmpDir:str) -> dict:
+    from Drifter import Drifter
+    from Writer import MOM
+    fn = os.path.join(tmpDir, "drifter.db")
+    t0 = datetime(2020, 8, 1, tzinfo=timezone.utc)
+    with sqlite3.connect(fn) as conn:
+        cur = conn.cursor()
+        mom = MOM("mom", logger)
+        mom.createTable(cur)
+        for i in range(50): # Synthetic fixes every 15 minutes drifting northeast
+            cur.execute("INSERT INTO mom (IMEI,t,latitude,longitude,accuracy) VALUES(?,?,?,?,?);",
+                    ("000000000000015", t0 + timedelta(minutes=15*i),
+                        44 + i * 1e-4, -124 + i * 1e-4, 4))
+        conn.commit()
+    args = argparse.Namespace(IMEI="000000000000015", drifterDB=fn, drifterMonths=2,
+            drifterTimeout=5, drifterRing=None, drifterRingAge=3600, drifterNBack=10,
+            drifterTau=60, drifterTearliest=None)
+    t = t0 + timedelta(hours=13)
+    return {
+            "Drifter.estimate": lambda: Drifter(args, logger).estimate(t),
+            }
+
+def benchFixCache(logger:logging.Logger) -> dict:
+    from FixAPI import FixCache
+    cache = FixCache(argparse.Namespace(fixApiHours=1, fixApiMaxFixes=1000))
+    t0 = datetime.now(tz=timezone.utc) - timedelta(minutes=90)
+    cache.tStart = t0 # As if loaded from the database since then
+    for i in range(30): # Every 3 minutes, so the first are pruned by the window
+        cache.put({"IMEI": "1", "t": t0 + timedelta(minutes=3 * i)})
+    cache.put({"IMEI": "1", "t": t0 + timedelta(minutes=88)}) # Cutoff between two fixes
+    if cache.track("1", None, None)[1] is None: # Would be answered by the database
+        raise Exception("FixCache.track missed the cache for the default since")
+    return {
+            "FixCache.track": lambda: cache.track("1", None, None),
+            }
+
+def benchPatterns(logger:logging.Logger) -> dict:
+    from Patterns import Patterns
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "patterns.yaml")
+    return {
+            "Patterns.load": lambda: Patterns(fn),
+            }
+
+def benchDialog(logger:logging.Logger) -> dict:
+    from Dialog import patterns
+    lines = [
+            "m_avg_speed(m/s) 0.31",
+            "Curr Time: Sun Oct 18 21:07:00 2026 MT: 1234",
+            "GPS Location: 4445.000 N -12459.000 E measured 10.0 secs ago",
+            "sensor:c_wpt_lat(lat)=4445.1 20.0 secs ago",
+            "sensor:m_water_vy(m/s)=0.05 20.0 secs ago",
+            "s *.sbd *.tbd",
+            "Vehicle Name: osusim", # Matches nothing, so every pattern is tried
+            ]
+    def matchAll() -> None:
+        for line in lines:
+            for pattern in patterns:
+                if pattern.check(line, logger) is not None: break
+    return {
+            "Dialog.patterns": matchAll,
+            }
+
+def mkBenchmarks(logger:logging.Logger, tmpDir:str) -> dict:
+    items = {}
+    items.update(benchMessages(logger))
+    items.update(benchBitArray(logger))
+    items.update(benchWayPoint(logger))
+    items.update(benchDrifter(logger, tmpDir))
+    items.update(benchFixCache(logger))
+    items.update(benchPatterns(logger))
+    items.update(benchDialog(logger))
+    return items
+
+def run(args:argparse.ArgumentParser, logger:logging.Logger) -> dict:
+    results = {}
+    quiet = logging.getLogger("bench") # Don't time log output
+    quiet.setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmpDir:
+        items = mkBenchmarks(quiet, tmpDir)
+        for name in sorted(items):
+            if args.only and not any(map(lambda x: x in name, args.only)): continue
+            with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+                warnings.simplefilter("ignore") # Some of these print or warn on every call
+                timer = timeit.Timer(items[name])
+                (n, dt) = timer.autorange()
+                n = max(1, round(n * args.minTime / max(dt, 1e-9)))
+                best = min(timer.repeat(repeat=args.repeat, number=n)) / n
+            results[name] = best
+            logger.info("%-26s %12.3f us/call", name, best * 1e6)
+    return results
+
+def baselineName(args:argparse.ArgumentParser) -> str:
+    return os.path.join(args.baselineDir, socket.gethostname() + ".json")
+
+def save(args:argparse.ArgumentParser, logger:logging.Logger, results:dict) -> None:
+    os.makedirs(args.baselineDir, exist_ok=True)
+    fn = baselineName(args)
+    info = {
+            "host": socket.gethostname(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "python": sys.version,
+            "t": datetime.now(tz=timezone.utc).isoformat(),
+            "results": results,
+            }
+    with open(fn, "w") as fp:
+        json.dump(info, fp, indent=2, sort_keys=True)
+    logger.info("Saved baseline to %s", fn)
+
+def compare(args:argparse.ArgumentParser, logger:logging.Logger, results:dict) -> bool:
+    """ Returns True if nothing regressed """
+    fn = baselineName(args)
+    if not os.path.isfile(fn):
+        logger.error("No baseline for this host, %s, run with --save first", fn)
+        return False
+    with open(fn, "r") as fp:
+        baseline = json.load(fp)["results"]
+    qOkay = True
+    for name in sorted(results):
+        if name not in baseline:
+            logger.info("%-26s new", name)
+            continue
+        ratio = results[name] / baseline[name]
+        qRegress = ratio > (1 + args.threshold)
+        qOkay &= not qRegress
+        logger.log(logging.WARNING if qRegress else logging.INFO,
+                "%-26s %12.3f -> %12.3f us/call %6.2fx%s", name,
+                baseline[name] * 1e6, results[name] * 1e6, ratio,
+                " REGRESSION" if qRegress else "")
+    return qOkay
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the hot functions")
+    grp = parser.add_argument_group(description="Benchmark options")
+    grp.add_argument("--save", action="store_true", help="Save results as this machine's baseline")
+    grp.add_argument("--compare", action="store_true",
+            help="Compare results to this machine's baseline")
+    grp.add_argument("--baselineDir", type=str, default="benchmarks", metavar="dir",
+            help="Where per machine baselines are stored")
+    grp.add_argument("--threshold", type=float, default=0.2, metavar="fraction",
+            help="Slow down, relative to the baseline, considered a regression")
+    grp.add_argument("--repeat", type=int, default=5, metavar="count",
+            help="Number of timing runs, the best is kept")
+    grp.add_argument("--minTime", type=float, default=0.2, metavar="seconds",
+            help="Minimum duration of each timing run")
+    grp.add_argument("--only", type=str, action="append", metavar="name",
+            help="Only run benchmarks whose names contain this")
+    MyLogger.addArgs(parser)
+    args = parser.parse_args()
+    logger = MyLogger.mkLogger(args)
+
+    if args.compare and not args.save and not os.path.isfile(baselineName(args)):
+        logger.error("No baseline for this host, %s, run with --save first", baselineName(args))
+        sys.exit(1) # Before spending time on the benchmarks
+
+    results = run(args, logger)
+    qOkay = compare(args, logger, results) if args.compare else True
+    if args.save: save(args, logger, results)
+    sys.exit(0 if qOkay else 1)
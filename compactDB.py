@@ -0,0 +1,179 @@
+#! /usr/bin/env python3
+#
+# Compact a GSatMicroListener database, keeping full resolution for a recent window
+#
+# MOM rows older than --keepDays are thinned to the earliest fix per IMEI per --interval.
+# Raw packets older than --keepDays are appended to gzipped JSON line files in --archive,
+# one per month, which replayRaw.py can replay, and removed from the database.
+# Rows are deleted in --chunk sized transactions and the freed pages are returned with
+# incremental vacuum, with --pause between them, so the live Writer is never locked out
+# for long. Closed monthly partitions, see Partitions.py, are compacted in a copy which
+# then replaces the original, so readers never see one change.
+
+import argparse
+import logging
+import gzip
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+import MyLogger
+import Partitions
+
+class Compactor:
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        t = datetime.now(tz=timezone.utc) - timedelta(days=args.keepDays)
+        self.cutoff = t.strftime("%Y-%m-%d %H:%M:%S+00:00") # As the Writer stores times
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        grp = parser.add_argument_group(description="Compaction options")
+        grp.add_argument("--db", type=str, required=True, metavar="filename",
+                help="GSatMicroListener database, and its partitions if any")
+        grp.add_argument("--raw", type=str, default="Raw", metavar="name",
+                help="Table name for raw packets")
+        grp.add_argument("--mom", type=str, default="MOM", metavar="name",
+                help="Table name for Mobile Originated Messages")
+        grp.add_argument("--keepDays", type=float, default=21, metavar="days",
+                help="Keep everything newer than this")
+        grp.add_argument("--interval", type=float, default=3600, metavar="seconds",
+                help="Keep one older MOM row per IMEI per interval, 0 to keep them all")
+        grp.add_argument("--archive", type=str, metavar="directory",
+                help="Move older Raw packets to here, else they are left alone")
+        grp.add_argument("--chunk", type=int, default=1000, metavar="rows",
+                help="Rows deleted per transaction")
+        grp.add_argument("--vacuumPages", type=int, default=1000, metavar="pages",
+                help="Pages freed per incremental vacuum step")
+        grp.add_argument("--pause", type=float, default=0.05, metavar="seconds",
+                help="Pause between transactions to let the Writer in")
+        grp.add_argument("--busyTimeout", type=float, default=30, metavar="seconds",
+                help="How long to wait for the Writer's lock")
+        grp.add_argument("--convert", action="store_true",
+                help="Switch databases without incremental vacuum to it, a one time full VACUUM")
+
+    def __downsample(self, conn:sqlite3.Connection) -> list:
+        """ rowids of older MOM rows which are not the earliest in their IMEI's interval """
+        args = self.args
+        if args.interval <= 0: return []
+        sql = "SELECT rowid FROM (SELECT rowid, ROW_NUMBER() OVER ("
+        sql+= " PARTITION BY IMEI, CAST(strftime('%s', substr(t,1,19)) AS INTEGER) / ?"
+        sql+= " ORDER BY t) AS n FROM " + args.mom + " WHERE t<?) WHERE n>1;"
+        return [row[0] for row in conn.execute(sql, (int(args.interval), self.cutoff))]
+
+    def __delete(self, conn:sqlite3.Connection, tbl:str, rowids:list, pause:float) -> None:
+        for i in range(0, len(rowids), self.args.chunk):
+            chunk = rowids[i:(i + self.args.chunk)]
+            sql = "DELETE FROM " + tbl + " WHERE rowid IN (" + ",".join(["?"] * len(chunk)) + ");"
+            conn.execute(sql, chunk)
+            conn.commit()
+            if pause: time.sleep(pause)
+
+    def __archive(self, conn:sqlite3.Connection, pause:float) -> int:
+        """ Append older Raw packets to monthly archive files, then delete them """
+        args = self.args
+        if args.archive is None: return 0
+        os.makedirs(args.archive, exist_ok=True)
+        base = os.path.splitext(os.path.basename(args.db))[0]
+        sql = "SELECT rowid,t,addr,port,body FROM " + args.raw
+        sql+= " WHERE t<? ORDER BY t LIMIT ?;"
+        n = 0
+        while True:
+            rows = conn.execute(sql, (self.cutoff, args.chunk)).fetchall()
+            if not rows: return n
+            months = {}
+            for (rowid, t, addr, port, body) in rows:
+                months.setdefault(str(t)[:7], []).append(json.dumps(
+                    {"t": str(t), "addr": addr, "port": port, "body": bytes(body).hex()}))
+            for month in months: # Written before the rows are deleted, so nothing is lost
+                fn = os.path.join(args.archive, "{}.{}.{}.jsonl.gz".format(base, args.raw, month))
+                with gzip.open(fn, "at") as fp:
+                    fp.write("\n".join(months[month]) + "\n")
+            self.__delete(conn, args.raw, [row[0] for row in rows], pause)
+            n += len(rows)
+
+    def __vacuum(self, conn:sqlite3.Connection, pause:float) -> None:
+        args = self.args
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != 2: # Not incremental
+            if not args.convert:
+                self.logger.warning("Incremental vacuum is not enabled, see --convert")
+                return
+            self.logger.info("Converting to incremental vacuum")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+            conn.execute("VACUUM;")
+            return
+        while conn.execute("PRAGMA freelist_count;").fetchone()[0] > 0:
+            conn.execute("PRAGMA incremental_vacuum({});".format(args.vacuumPages)).fetchall()
+            conn.commit()
+            if pause: time.sleep(pause)
+
+    def __tables(self, conn:sqlite3.Connection) -> set:
+        sql = "SELECT name FROM sqlite_master WHERE type='table';"
+        return set(map(lambda x: x[0].lower(), conn.execute(sql)))
+
+    def __compact(self, conn:sqlite3.Connection, pause:float) -> tuple:
+        tables = self.__tables(conn)
+        rowids = self.__downsample(conn) if self.args.mom.lower() in tables else []
+        self.__delete(conn, self.args.mom, rowids, pause)
+        nRaw = self.__archive(conn, pause) if self.args.raw.lower() in tables else 0
+        return (len(rowids), nRaw)
+
+    def __qWork(self, fn:str) -> bool:
+        """ Is there anything to do in fn? """
+        args = self.args
+        with sqlite3.connect(fn, timeout=args.busyTimeout) as conn:
+            tables = self.__tables(conn)
+            if (args.mom.lower() in tables) and self.__downsample(conn): return True
+            if (args.archive is not None) and (args.raw.lower() in tables):
+                sql = "SELECT 1 FROM " + args.raw + " WHERE t<? LIMIT 1;"
+                if conn.execute(sql, (self.cutoff,)).fetchone() is not None: return True
+        return False
+
+    def compactLive(self, fn:str) -> None:
+        """ Compact a file the Writer may be using, a transaction at a time """
+        with sqlite3.connect(fn, timeout=self.args.busyTimeout) as conn:
+            (nMOM, nRaw) = self.__compact(conn, self.args.pause)
+            self.__vacuum(conn, self.args.pause)
+        self.logger.info("%s thinned %s MOM rows and archived %s Raw packets", fn, nMOM, nRaw)
+
+    def compactClosed(self, fn:str) -> None:
+        """ Compact a copy of a closed partition, then replace it """
+        if not self.__qWork(fn):
+            self.logger.debug("Nothing to do in %s", fn)
+            return
+        tmp = fn + ".compact"
+        if os.path.exists(tmp): os.unlink(tmp)
+        conn = sqlite3.connect(fn)
+        try:
+            conn.execute("VACUUM INTO ?;", (tmp,))
+        finally:
+            conn.close()
+        conn = sqlite3.connect(tmp) # Nobody else has this open, so no need to pause
+        try:
+            (nMOM, nRaw) = self.__compact(conn, 0)
+            conn.execute("VACUUM;")
+        finally:
+            conn.close()
+        os.replace(tmp, fn)
+        self.logger.info("%s thinned %s MOM rows and archived %s Raw packets", fn, nMOM, nRaw)
+
+    def run(self) -> None:
+        for fn in Partitions.files(self.args.db):
+            try:
+                if Partitions.qClosed(self.args.db, fn):
+                    self.compactClosed(fn)
+                else:
+                    self.compactLive(fn)
+            except:
+                self.logger.exception("Error compacting %s", fn)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact a GSatMicroListener database")
+    Compactor.addArgs(parser)
+    MyLogger.addArgs(parser)
+    args = parser.parse_args()
+    logger = MyLogger.mkLogger(args)
+
+    Compactor(args, logger).run()
@@ -8,11 +8,10 @@ from argparse import ArgumentParser
 import subprocess
 from logging import Logger
 import time
-import re
-import json
 from queue import Queue
 import MyLogger
 from MyBaseThread import MyBaseThread
+from LineFramer import LineFramer, apiMessage
 
 nodeCommand = "/usr/bin/node"
 
@@ -46,7 +45,6 @@ class Common(MyBaseThread):
     def runAndCatch(self) -> None: # Called on start
         logger = self.logger
         logger.info("Starting")
-        expr = re.compile(bytes(r"([{].+[}])\x00\n", "utf-8"))
 
         try:
             while True:
@@ -56,9 +54,9 @@ class Common(MyBaseThread):
                     self.pipe = None
                     continue
                 logger.info("%s", line)
-                a = expr.fullmatch(line)
+                a = apiMessage(line)
                 if a is not None: 
-                    self.process(json.loads(a[1]))
+                    self.process(a)
         except:
             logger.exception("Unexpected exception")
         q.put(self.name)
@@ -74,16 +72,13 @@ class Events(Common):
 class Dialog(Common):
     def __init__(self, args:ArgumentParser, logger:Logger, q:Queue) -> None:
         Common.__init__(self, "DIALOG", "output_glider_dialog_data.js", args, logger, q)
-        self.buffer = ""
+        self.framer = LineFramer()
 
     def process(self, a) -> None:
         if "data" not in a: return
-        self.buffer += a["data"]
-        while len(self.buffer):
-            index = self.buffer.find("\n")
-            if index < 0: return
-            self.logger.info("LINE %s", self.buffer[0:index])
-            self.buffer = self.buffer[(index+1):]
+        self.framer.put(a["data"])
+        for line in self.framer.lines():
+            self.logger.info("LINE %s", line[:-1])
 
 parser = ArgumentParser()
 Common.addArgs(parser)
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+#
+# Generate a high rate of faux drifter packets from many beacons to measure
+# a listener's ingest ceiling
+#
+# Each simulated IMEI is a FauxDrifter with its own random walk. Packets are produced at
+# an aggregate --rate, optionally with bursts, and sent over --connections concurrent
+# DirectIP connections, one packet per connection. A fraction of the packets can be
+# malformed or dripped out slowly. The achieved throughput and error rate are reported.
+
+import argparse
+import logging
+import copy
+import queue
+import random
+import socket
+import threading
+import time
+import MyLogger
+from fauxDrifter import FauxDrifter
+from MyBaseThread import MyBaseThread
+
+class Stats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.errors = 0
+        self.nBytes = 0
+        self.malformed = 0
+        self.dripped = 0
+        self.latency = 0 # Sum of connect+send+close times
+
+    def add(self, **kwargs) -> None:
+        with self.lock:
+            for key in kwargs:
+                setattr(self, key, getattr(self, key) + kwargs[key])
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(sent=self.sent, errors=self.errors, nBytes=self.nBytes,
+                    malformed=self.malformed, dripped=self.dripped, latency=self.latency)
+
+class Sender(MyBaseThread):
+    """ Take frames off a queue and send each on its own connection """
+    def __init__(self, name:str, args:argparse.ArgumentParser, logger:logging.Logger,
+            q:queue.Queue, stats:Stats) -> None:
+        MyBaseThread.__init__(self, name, args, logger)
+        self.q = q
+        self.stats = stats
+
+    def runAndCatch(self) -> None: # Called on start
+        args = self.args
+        q = self.q
+        stats = self.stats
+        target = (args.hostname, args.portForward)
+        while True:
+            (msg, qDrip) = q.get()
+            t0 = time.monotonic()
+            try:
+                with socket.create_connection(target, timeout=args.timeout) as s:
+                    if qDrip: # Send a few bytes at a time
+                        for i in range(0, len(msg), args.dripSize):
+                            s.sendall(msg[i:(i+args.dripSize)])
+                            time.sleep(args.dripDelay)
+                    else:
+                        s.sendall(msg)
+                stats.add(sent=1, nBytes=len(msg), latency=time.monotonic() - t0)
+            except:
+                stats.add(errors=1)
+                self.logger.debug("Error sending to %s:%s", target[0], target[1], exc_info=True)
+            q.task_done()
+
+class LoadGenerator:
+    def __init__(self, args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        self.stats = Stats()
+        self.q = queue.Queue(maxsize=max(1, args.connections * 2))
+        if args.seed is not None: random.seed(args.seed)
+        dLogger = logging.getLogger("fauxDrifter") # Don't log every packet
+        dLogger.setLevel(logging.WARNING)
+        self.drifters = []
+        for i in range(args.nIMEI):
+            a = copy.copy(args)
+            a.IMEI = args.IMEI + i
+            a.seed = None # Seeded once above
+            a.lat = args.lat + random.uniform(-args.spread, args.spread)
+            a.lon = args.lon + random.uniform(-args.spread, args.spread)
+            self.drifters.append(FauxDrifter(a, dLogger))
+        self.senders = []
+        for i in range(args.connections):
+            name = "Sender({})".format(i)
+            self.senders.append(Sender(name, args, logger, self.q, self.stats))
+
+    @staticmethod
+    def addArgs(parser:argparse.ArgumentParser) -> None:
+        FauxDrifter.addArgs(parser)
+        grp = parser.add_argument_group(description="Load generation options")
+        grp.add_argument("--hostname", type=str, default="localhost", metavar="host",
+                help="Host to send packets to")
+        grp.add_argument("--portForward", type=int, required=True, metavar="port",
+                help="Port to send packets to")
+        grp.add_argument("--nIMEI", type=int, default=100, metavar="count",
+                help="Number of simulated beacons, IMEIs are --IMEI, --IMEI+1, ...")
+        grp.add_argument("--spread", type=float, default=0.1, metavar="degrees",
+                help="Spread of the beacons' initial positions")
+        grp.add_argument("--rate", type=float, default=100, metavar="perSecond",
+                help="Target aggregate packet rate, 0 for as fast as possible")
+        grp.add_argument("--connections", type=int, default=10, metavar="count",
+                help="Number of concurrent connections")
+        grp.add_argument("--burstSize", type=int, default=0, metavar="count",
+                help="Extra packets sent back to back every --burstPeriod")
+        grp.add_argument("--burstPeriod", type=float, default=60, metavar="seconds",
+                help="Time between bursts")
+        grp.add_argument("--malformed", type=float, default=0, metavar="fraction",
+                help="Fraction of packets to corrupt")
+        grp.add_argument("--slowDrip", type=float, default=0, metavar="fraction",
+                help="Fraction of packets to send a few bytes at a time")
+        grp.add_argument("--dripSize", type=int, default=4, metavar="bytes",
+                help="Bytes per send for slow drip packets")
+        grp.add_argument("--dripDelay", type=float, default=0.1, metavar="seconds",
+                help="Delay between sends for slow drip packets")
+        grp.add_argument("--timeout", type=float, default=30, metavar="seconds",
+                help="Socket timeout")
+        grp.add_argument("--duration", type=float, default=60, metavar="seconds",
+                help="How long to generate load for")
+        grp.add_argument("--reportInterval", type=float, default=10, metavar="seconds",
+                help="How often to report throughput")
+
+    @staticmethod
+    def __corrupt(msg:bytes) -> bytes:
+        """ Damage a frame in one of the ways a gateway or network might """
+        how = random.randrange(4)
+        if how == 0: return msg[:random.randrange(1, len(msg))] # Truncated
+        a = bytearray(msg)
+        if how == 1:
+            a[0] = 2 # Bad version
+        elif how == 2:
+            a[1:3] = (len(a) + 10).to_bytes(2, "big") # Bad overall length
+        else:
+            a[3] = 99 # Unknown information element
+        return bytes(a)
+
+    def __mkFrame(self) -> tuple:
+        args = self.args
+        msg = random.choice(self.drifters).mkMessage()
+        if random.random() < args.malformed:
+            msg = self.__corrupt(msg)
+            self.stats.add(malformed=1)
+        qDrip = random.random() < args.slowDrip
+        if qDrip: self.stats.add(dripped=1)
+        return (msg, qDrip)
+
+    def report(self, t0:float, prev:dict, tPrev:float) -> dict:
+        now = time.monotonic()
+        info = self.stats.snapshot()
+        n = info["sent"] + info["errors"]
+        dt = max(now - tPrev, 1e-9)
+        self.logger.info(
+                "t=%.1f sent=%s errors=%s (%.2f%%) malformed=%s dripped=%s"
+                + " rate=%.1f/s interval=%.1f/s %.0f B/s latency=%.4fs",
+                now - t0, info["sent"], info["errors"], 100 * info["errors"] / max(n, 1),
+                info["malformed"], info["dripped"],
+                info["sent"] / max(now - t0, 1e-9),
+                (info["sent"] - prev["sent"]) / dt,
+                (info["nBytes"] - prev["nBytes"]) / dt,
+                info["latency"] / max(info["sent"], 1))
+        return info
+
+    def run(self) -> dict:
+        args = self.args
+        for thr in self.senders:
+            thr.start()
+
+        t0 = time.monotonic()
+        tEnd = t0 + args.duration
+        tNext = t0 # When the next packet is due
+        tBurst = t0 + args.burstPeriod
+        tReport = t0 + args.reportInterval
+        prev = self.stats.snapshot()
+        tPrev = t0
+        dt = 0 if args.rate <= 0 else 1 / args.rate
+
+        while True:
+            now = time.monotonic()
+            if now >= tEnd: break
+            if now >= tReport:
+                prev = self.report(t0, prev, tPrev)
+                tPrev = now
+                tReport += args.reportInterval
+            if (args.burstSize > 0) and (now >= tBurst):
+                for i in range(args.burstSize):
+                    self.q.put(self.__mkFrame())
+                tBurst += args.burstPeriod
+            if now < tNext:
+                time.sleep(min(tNext, tReport, tEnd) - now)
+                continue
+            self.q.put(self.__mkFrame()) # Blocks if the senders can't keep up
+            tNext += dt
+
+        self.q.join() # Wait for everything queued to be sent
+        self.report(t0, prev, tPrev)
+        return self.stats.snapshot()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Many beacon load generator")
+    LoadGenerator.addArgs(parser)
+    MyLogger.addArgs(parser)
+    args = parser.parse_args()
+    logger = MyLogger.mkLogger(args)
+
+    LoadGenerator(args, logger).run()
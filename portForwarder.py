@@ -2,18 +2,25 @@
 #
 # Forward connections to one port to another, possibly on a different machine.
 #
+# A single selector loop relays every connection in both directions, so hundreds of
+# concurrent DirectIP sessions can be carried by one small process.
 #
+# With --tee, each inbound stream is also copied to other destinations, such as a test
+# instance. Each copy has its own bounded buffer and reconnects, so a slow or down tee
+# destination never holds up the primary target or the other tee destinations.
 # Feb-2020, Pat Welch, pat@mousebrains.com
 
 from argparse import ArgumentParser
 import logging
 import logging.handlers
 import getpass
+import errno
+import fcntl
+import os
+import selectors
 import socket
 import time
-import queue
 import sys
-import threading
 
 def addArgsLogger(parser:ArgumentParser) -> None:
     grp = parser.add_argument_group('Logger Related Options')
@@ -66,16 +73,417 @@ def mkLogger(args:ArgumentParser) -> logging.Logger:
 
     return logger
 
-class Forwarder(threading.Thread):
-    def __init__(self, conn, addr:tuple, args:ArgumentParser, logger:logging.Logger) -> None:
-        threading.Thread.__init__(self, daemon=True)
-        self.name = "FWD:{}".format(addr)
+class Buffer:
+    """ Bytes received from one side of a session waiting to be sent to the other side
+        The buffer is allocated once and sliced with a memoryview, so nothing is copied
+        per send """
+    def __init__(self, size:int) -> None:
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.head = 0 # Next byte to send
+        self.tail = 0 # Next byte to receive into
+        self.qEOF = False
+        self.nBytes = 0
+
+    def room(self) -> int:
+        return len(self.buffer) - self.tail
+
+    def pending(self) -> int:
+        return self.tail - self.head
+
+    def fill(self, src:socket.socket) -> None:
+        try:
+            n = src.recv_into(self.view[self.tail:])
+        except (BlockingIOError, InterruptedError):
+            return
+        if n == 0:
+            self.qEOF = True
+        self.tail += n
+        self.nBytes += n
+
+    def drain(self, dst:socket.socket) -> None:
+        try:
+            n = dst.send(self.view[self.head:self.tail])
+        except (BlockingIOError, InterruptedError):
+            return
+        self.head += n
+        if self.head == self.tail: # Everything sent, so start from the beginning again
+            self.head = 0
+            self.tail = 0
+
+    def close(self) -> None:
+        self.view.release()
+
+class SpliceBuffer:
+    """ Bytes moved between the sockets through a kernel pipe with os.splice,
+        so they are never copied into Python """
+    flags = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+    def __init__(self, size:int) -> None:
+        (self.rfd, self.wfd) = os.pipe()
+        try:
+            fcntl.fcntl(self.wfd, fcntl.F_SETPIPE_SZ, size)
+        except:
+            pass
+        try:
+            self.size = fcntl.fcntl(self.wfd, fcntl.F_GETPIPE_SZ)
+        except:
+            self.size = 65536 # Linux's default pipe size
+        self.count = 0 # Bytes in the pipe
+        self.qEOF = False
+        self.nBytes = 0
+
+    def room(self) -> int:
+        return self.size - self.count
+
+    def pending(self) -> int:
+        return self.count
+
+    def fill(self, src:socket.socket) -> None:
+        try:
+            n = os.splice(src.fileno(), self.wfd, self.room(), flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        if n == 0:
+            self.qEOF = True
+        self.count += n
+        self.nBytes += n
+
+    def drain(self, dst:socket.socket) -> None:
+        try:
+            n = os.splice(self.rfd, dst.fileno(), self.count, flags=self.flags)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.count -= n
+
+    def close(self) -> None:
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+class TeeTarget:
+    """ A destination which is sent a copy of every inbound stream """
+    def __init__(self, spec:str) -> None:
+        (host, port) = spec.rsplit(":", 1)
+        self.name = spec
+        self.addr = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)[0]
+        self.streams = set() # Active TeeStreams
+        self.backoff = 1 # Seconds to wait after the next connection failure
+        self.tRetry = 0 # Don't connect before this monotonic time
+        self.nStreams = 0
+        self.nBytes = 0
+        self.nDropped = 0
+        self.nFailures = 0
+
+    def failed(self) -> None:
+        self.nFailures += 1
+        self.tRetry = time.monotonic() + self.backoff
+        self.backoff = min(60, self.backoff * 2)
+
+    def connected(self) -> None:
+        self.backoff = 1
+
+    def lag(self) -> tuple:
+        """ Bytes waiting to be sent and the age of the oldest of them """
+        now = time.monotonic()
+        nBytes = 0
+        dt = 0
+        for stream in self.streams:
+            n = stream.pending()
+            if n:
+                nBytes += n
+                dt = max(dt, now - stream.tUnsent)
+        return (nBytes, dt)
+
+class TeeStream:
+    """ Copy of one session's inbound bytes on its way to a tee destination
+        The copy is held in a bounded buffer, so a slow or down destination can not stall
+        the session. If the connection fails, it is retried with the destination's backoff,
+        and the stream resent from its start, as long as none of it has been discarded. """
+    def __init__(self, dest:TeeTarget, addr:tuple, sel:selectors.BaseSelector,
+            args:ArgumentParser, logger:logging.Logger) -> None:
+        self.dest = dest
+        self.addr = addr
+        self.sel = sel
+        self.logger = logger
+        self.maxSize = args.teeBufferSize
+        self.maxRetries = args.teeRetries
+        self.buffer = bytearray()
+        self.sent = 0 # Offset of the next byte to send
+        self.hwm = 0 # Highest offset sent, so resends aren't counted twice
+        self.qTrimmed = False # Sent bytes have been discarded, so it can't be resent
+        self.qEOF = False
+        self.qShut = False
+        self.qFinished = False
+        self.reason = None
+        self.s = None
+        self.qConnected = False
+        self.mask = 0
+        self.nRetries = 0
+        self.t0 = time.monotonic()
+        self.tLast = self.t0
+        self.tUnsent = self.t0 # When the oldest unsent byte arrived
+        dest.streams.add(self)
+        dest.nStreams += 1
+
+    def __repr__(self) -> str:
+        return "{} => {}".format(self.addr, self.dest.name)
+
+    def pending(self) -> int:
+        return len(self.buffer) - self.sent
+
+    def qDone(self) -> bool:
+        return self.qFinished
+
+    def put(self, data:memoryview) -> None:
+        if self.qFinished: return
+        if (len(self.buffer) + len(data)) > self.maxSize and self.sent:
+            del self.buffer[:self.sent] # Make room by discarding what has been sent
+            self.hwm -= self.sent
+            self.sent = 0
+            self.qTrimmed = True
+        if (len(self.buffer) + len(data)) > self.maxSize:
+            self.__finish("overflow")
+            self.dest.nDropped += 1
+            return
+        if not self.pending(): self.tUnsent = time.monotonic()
+        self.buffer += data
+        self.update(self.sel)
+
+    def eof(self) -> None:
+        if self.qEOF: return
+        self.qEOF = True
+        self.__shutdown()
+        self.update(self.sel)
+
+    def tick(self) -> None:
+        """ Connect, or reconnect, once the destination's backoff has passed """
+        if self.qFinished or (self.s is not None) or (time.monotonic() < self.dest.tRetry):
+            return
+        (family, sockType, proto, canonName, sockAddr) = self.dest.addr
+        self.s = socket.socket(family, sockType, proto)
+        self.s.setblocking(False)
+        self.qConnected = False
+        self.tLast = time.monotonic()
+        err = self.s.connect_ex(sockAddr)
+        if err not in (0, errno.EINPROGRESS):
+            self.__retry(os.strerror(err))
+        self.update(self.sel)
+
+    def update(self, sel:selectors.BaseSelector) -> None:
+        if self.s is None:
+            mask = 0
+        elif not self.qConnected:
+            mask = selectors.EVENT_WRITE # Connection completed
+        else: # Always read, to discard replies and notice the peer closing
+            mask = selectors.EVENT_READ
+            if self.pending(): mask |= selectors.EVENT_WRITE
+        if mask == self.mask: return
+        if not self.mask:
+            sel.register(self.s, mask, self)
+        elif not mask:
+            sel.unregister(self.s)
+        else:
+            sel.modify(self.s, mask, self)
+        self.mask = mask
+
+    def handle(self, s:socket.socket, mask:int) -> None:
+        self.tLast = time.monotonic()
+        try:
+            if not self.qConnected:
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err: raise ConnectionError(err, os.strerror(err))
+                self.qConnected = True
+                self.dest.connected()
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = s.recv(4096)
+                except (BlockingIOError, InterruptedError):
+                    data = None
+                if data == b"":
+                    if self.qShut: # Everything was sent
+                        self.__finish("done")
+                        return
+                    raise ConnectionError("Closed by peer")
+            if (mask & selectors.EVENT_WRITE) and self.pending():
+                with memoryview(self.buffer) as mv, mv[self.sent:] as part:
+                    try:
+                        n = s.send(part)
+                    except (BlockingIOError, InterruptedError):
+                        n = 0
+                self.sent += n
+                if self.sent > self.hwm:
+                    self.dest.nBytes += self.sent - self.hwm
+                    self.hwm = self.sent
+            self.__shutdown()
+        except OSError as e:
+            self.__retry(str(e))
+
+    def __shutdown(self) -> None:
+        """ Pass the end of file along once everything has been sent """
+        if self.qConnected and self.qEOF and not self.pending() and not self.qShut:
+            try:
+                self.s.shutdown(socket.SHUT_WR)
+                self.qShut = True
+            except OSError as e:
+                self.__retry(str(e))
+
+    def __disconnect(self) -> None:
+        if self.s is None: return
+        if self.mask: self.sel.unregister(self.s)
+        self.mask = 0
+        try:
+            self.s.close()
+        except:
+            pass
+        self.s = None
+        self.qConnected = False
+        self.qShut = False
+
+    def __retry(self, reason:str) -> None:
+        self.__disconnect()
+        self.dest.failed()
+        if self.qTrimmed or (self.nRetries >= self.maxRetries):
+            self.__finish(reason)
+            self.dest.nDropped += 1
+            return
+        self.nRetries += 1
+        self.sent = 0 # Resend from the start on the next connection
+        self.tUnsent = self.t0
+        self.logger.debug("Retry %s for %s, %s", self.nRetries, self, reason)
+
+    def __finish(self, reason:str) -> None:
+        self.__disconnect()
+        self.qFinished = True
+        self.reason = reason
+        self.buffer = bytearray()
+        self.sent = 0
+
+    def close(self, sel:selectors.BaseSelector, reason:str) -> None:
+        reason = self.reason if self.qFinished else reason
+        self.__finish(reason)
+        self.dest.streams.discard(self)
+        self.logger.log(logging.INFO if reason == "done" else logging.WARNING,
+                "Closed %s, %s, %s bytes, %s retries, %.3f seconds", self, reason,
+                self.hwm, self.nRetries, time.monotonic() - self.t0)
+
+class Session:
+    """ One inbound connection and its connection to the target, pumped in both directions """
+    def __init__(self, conn:socket.socket, addr:tuple, target:tuple,
+            args:ArgumentParser, logger:logging.Logger) -> None:
         self.conn = conn
         self.addr = addr
-        self.hostname = args.hostname
-        self.port = args.portForward
         self.logger = logger
-    
+        self.tgt = "{}:{}".format(args.hostname, args.portForward)
+        self.t0 = time.monotonic()
+        self.tLast = self.t0 # Last activity, for the idle timeout
+        mkBuffer = SpliceBuffer if args.splice else Buffer
+        self.up = mkBuffer(args.bufferSize) # conn -> target
+        self.down = mkBuffer(args.bufferSize) # target -> conn
+        self.qShutUp = False # Write side of target shutdown
+        self.qShutDown = False # Write side of conn shutdown
+        self.masks = {} # Currently registered selector events by socket
+        self.streams = [] # TeeStreams copies of the inbound bytes are sent to
+        conn.setblocking(False)
+        (family, sockType, proto, canonName, sockAddr) = target
+        self.target = socket.socket(family, sockType, proto)
+        self.target.setblocking(False)
+        self.qConnected = False
+        err = self.target.connect_ex(sockAddr)
+        if err not in (0, errno.EINPROGRESS):
+            self.target.close()
+            raise ConnectionError(err, os.strerror(err))
+
+    def __repr__(self) -> str:
+        return "{} -> {}".format(self.addr, self.tgt)
+
+    def qDone(self) -> bool:
+        return self.qShutUp and self.qShutDown
+
+    def update(self, sel:selectors.BaseSelector) -> None:
+        """ Register for the events each socket can make progress on """
+        up = self.up
+        down = self.down
+        mConn = 0
+        if not up.qEOF and up.room(): mConn |= selectors.EVENT_READ
+        if down.pending(): mConn |= selectors.EVENT_WRITE
+        if not self.qConnected:
+            mTarget = selectors.EVENT_WRITE # Connection completed
+        else:
+            mTarget = 0
+            if not down.qEOF and down.room(): mTarget |= selectors.EVENT_READ
+            if up.pending(): mTarget |= selectors.EVENT_WRITE
+        for (s, mask) in ((self.conn, mConn), (self.target, mTarget)):
+            prev = self.masks.get(s, 0)
+            if mask == prev: continue
+            if not prev:
+                sel.register(s, mask, self)
+            elif not mask:
+                sel.unregister(s)
+            else:
+                sel.modify(s, mask, self)
+            self.masks[s] = mask
+
+    def handle(self, s:socket.socket, mask:int) -> None:
+        self.tLast = time.monotonic()
+        if s is self.target and not self.qConnected:
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err: raise ConnectionError(err, os.strerror(err))
+            self.qConnected = True
+            self.logger.debug("Connected %s", self)
+        (src, dst) = (self.up, self.down) if s is self.conn else (self.down, self.up)
+        if mask & selectors.EVENT_READ:
+            n = src.nBytes
+            src.fill(s)
+            if self.streams and (src is self.up):
+                n = src.nBytes - n
+                if n:
+                    data = src.view[(src.tail - n):src.tail]
+                    for stream in self.streams: stream.put(data)
+                if src.qEOF:
+                    for stream in self.streams: stream.eof()
+        if (mask & selectors.EVENT_WRITE) and dst.pending():
+            dst.drain(s)
+        # Pass each end of file along once everything before it has been sent
+        if self.qConnected and self.up.qEOF and not self.up.pending() and not self.qShutUp:
+            self.target.shutdown(socket.SHUT_WR)
+            self.qShutUp = True
+        if self.down.qEOF and not self.down.pending() and not self.qShutDown:
+            self.conn.shutdown(socket.SHUT_WR)
+            self.qShutDown = True
+
+    def close(self, sel:selectors.BaseSelector, reason:str) -> None:
+        for s in (self.conn, self.target):
+            if self.masks.get(s): sel.unregister(s)
+            try:
+                s.close()
+            except:
+                pass
+        self.masks = {}
+        for stream in self.streams: stream.eof()
+        self.up.close()
+        self.down.close()
+        self.logger.info("Closed %s, %s, up=%s down=%s bytes, %.3f seconds", self, reason,
+                self.up.nBytes, self.down.nBytes, time.monotonic() - self.t0)
+
+class Proxy:
+    """ Relay every inbound connection to hostname:portForward from a single selector loop """
+    def __init__(self, args:ArgumentParser, logger:logging.Logger) -> None:
+        self.args = args
+        self.logger = logger
+        self.sel = selectors.DefaultSelector()
+        self.sessions = set()
+        self.streams = set() # TeeStreams, which outlive their sessions if need be
+        if args.splice and not hasattr(os, "splice"):
+            logger.warning("os.splice is not available, using buffered copies")
+            args.splice = False
+        if args.splice and args.tee:
+            logger.warning("--tee needs the inbound bytes, using buffered copies")
+            args.splice = False
+        # Resolve the targets once, rather than for every connection
+        self.target = socket.getaddrinfo(args.hostname, args.portForward,
+                type=socket.SOCK_STREAM)[0]
+        self.tees = [TeeTarget(spec) for spec in args.tee]
+
     @staticmethod
     def addArgs(parser:ArgumentParser) -> None:
         grp = parser.add_argument_group(description="Forwarder options")
@@ -83,58 +491,132 @@ class Forwarder(threading.Thread):
                 help="Hostname to forward packets to")
         grp.add_argument("--portForward", type=int, required=True, metavar="port",
                 help="Port on hostname to forward to")
+        grp.add_argument("--bufferSize", type=int, default=65536, metavar="bytes",
+                help="Buffer size for each direction of each connection")
+        grp.add_argument("--idleTimeout", type=float, default=300, metavar="seconds",
+                help="Close connections with no traffic for this long")
+        grp.add_argument("--splice", action="store_true",
+                help="Move bytes with os.splice, Linux only, instead of buffered copies")
+        grp.add_argument("--tee", type=str, action="append", default=[], metavar="host:port",
+                help="Also send a copy of each inbound stream here, replies are discarded")
+        grp.add_argument("--teeBufferSize", type=int, default=1024*1024, metavar="bytes",
+                help="Maximum bytes held for each inbound stream to each tee destination")
+        grp.add_argument("--teeRetries", type=int, default=10, metavar="count",
+                help="Times to reconnect to a tee destination before dropping a stream")
+        grp.add_argument("--teeReport", type=float, default=60, metavar="seconds",
+                help="How often to report each tee destination's lag")
 
-    def run(self) -> None: # Called on thread start
-        conn = self.conn
-        logger = self.logger
-        tgt = "{}:{}".format(self.hostname, self.port)
-        logger.info("Starting %s -> %s", self.addr, tgt)
+    def __accept(self, listener:socket.socket) -> None:
+        try:
+            (conn, addr) = listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                logger.debug("Opened socket")
-                s.connect((self.hostname, self.port))
-                logger.debug("Connected to %s", tgt)
-                while True:
-                    msg = conn.recv(1024*1024)
-                    logger.debug("Recevied data length %s from %s", len(msg), self.addr)
-                    if not msg: break # Connection has dropped 
-                    while len(msg): # forward the packet
-                        n = s.send(msg)
-                        if n == 0:
-                            logger.error("Socket connection to %s broken", tgt)
-                            return
-                        msg = msg[n:]
+            session = Session(conn, addr, self.target, self.args, self.logger)
         except:
-            logger.exception("Exception %s -> %s", self.addr, tgt)
-
-
-parser = ArgumentParser(description="Forward packets from one port to another")
-addArgsLogger(parser)
-Forwarder.addArgs(parser)
-grp = parser.add_argument_group(description="Listener related options")
-grp.add_argument("--port", type=int, required=True, metavar="port", help="Port to listen on")
-grp.add_argument("--maxConnections", type=int, default=10, metavar="count",
-        help="Maximum number of simultaneous connections")
-args = parser.parse_args()
-
-logger = mkLogger(args)
-logger.info("args=%s", args)
-
-try:
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        logger.debug("Opened socket")
-        s.bind(("", args.port))
-        logger.debug("Bound to port %s", args.port)
-        s.listen()
-        logger.debug("Listening to socket for incoming connections")
-        while True:
-            (conn, addr) = s.accept() # Wait for a connection request
-            logger.info("Connection from %s", addr)
-            thrd = Forwarder(conn, addr, args, logger)
-            thr.start()
-            logger.info("n Threads %s", threading.active_count())
-            while threading.active_count() > (args.maxConnections + 1):
-                time.sleep(1) # Wait for a thread to die before accepting anything else
-except:
-    logger.exception("Unexpected exception while listening for a connection")
-    sys.exit(1)
+            self.logger.exception("Unable to connect %s to %s:%s",
+                    addr, self.args.hostname, self.args.portForward)
+            conn.close()
+            return
+        self.sessions.add(session)
+        session.update(self.sel)
+        for dest in self.tees:
+            stream = TeeStream(dest, addr, self.sel, self.args, self.logger)
+            session.streams.append(stream)
+            self.streams.add(stream)
+            stream.tick()
+        self.logger.info("Connection from %s, n Sessions %s", addr, len(self.sessions))
+
+    def __close(self, session, reason:str) -> None:
+        self.sessions.discard(session)
+        self.streams.discard(session)
+        session.close(self.sel, reason)
+
+    def __reap(self) -> None:
+        """ Close idle sessions and finished tee streams, and reconnect tee streams """
+        tIdle = time.monotonic() - self.args.idleTimeout
+        for session in list(self.sessions):
+            if session.tLast < tIdle:
+                self.__close(session, "idle")
+        for stream in list(self.streams):
+            if stream.qDone():
+                self.__close(stream, "done")
+            elif stream.tLast < tIdle:
+                self.__close(stream, "idle")
+            else:
+                stream.tick()
+
+    def __report(self) -> None:
+        for dest in self.tees:
+            (nBytes, dt) = dest.lag()
+            self.logger.info("Tee %s streams=%s lag=%s bytes %.1f seconds"
+                    + " total streams=%s bytes=%s dropped=%s failures=%s",
+                    dest.name, len(dest.streams), nBytes, dt,
+                    dest.nStreams, dest.nBytes, dest.nDropped, dest.nFailures)
+
+    def run(self) -> None:
+        args = self.args
+        sel = self.sel
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(("", args.port))
+            listener.listen(args.maxConnections)
+            listener.setblocking(False)
+            self.logger.debug("Listening on port %s", args.port)
+            qListening = False
+            tReap = time.monotonic() + 1
+            tReport = time.monotonic() + args.teeReport
+            while True:
+                # Stop accepting at the cap, so further connections wait in the backlog
+                qCap = len(self.sessions) < args.maxConnections
+                if qCap != qListening:
+                    if qCap:
+                        sel.register(listener, selectors.EVENT_READ)
+                    else:
+                        sel.unregister(listener)
+                        self.logger.info("At maximum connections, %s", args.maxConnections)
+                    qListening = qCap
+                for (key, mask) in sel.select(timeout=1):
+                    session = key.data
+                    if session is None:
+                        self.__accept(listener)
+                        continue
+                    if (session not in self.sessions) and (session not in self.streams):
+                        continue # Closed earlier in this batch
+                    try:
+                        session.handle(key.fileobj, mask)
+                        if session.qDone():
+                            self.__close(session, "done")
+                        else:
+                            session.update(sel)
+                    except OSError as e:
+                        self.__close(session, str(e))
+                    except:
+                        self.logger.exception("Unexpected exception for %s", session)
+                        self.__close(session, "exception")
+                now = time.monotonic()
+                if now >= tReap:
+                    self.__reap()
+                    tReap = now + 1
+                if self.tees and (now >= tReport):
+                    self.__report()
+                    tReport = now + args.teeReport
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Forward packets from one port to another")
+    addArgsLogger(parser)
+    Proxy.addArgs(parser)
+    grp = parser.add_argument_group(description="Listener related options")
+    grp.add_argument("--port", type=int, required=True, metavar="port", help="Port to listen on")
+    grp.add_argument("--maxConnections", type=int, default=500, metavar="count",
+            help="Maximum number of simultaneous connections")
+    args = parser.parse_args()
+
+    logger = mkLogger(args)
+    logger.info("args=%s", args)
+
+    try:
+        Proxy(args, logger).run()
+    except:
+        logger.exception("Unexpected exception while forwarding connections")
+        sys.exit(1)
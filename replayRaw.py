@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+#
+# Replay captured DirectIP packets into a listener's port
+#
+# Packets come from the Raw table of a GSatMicroListener database, or from a packet file
+# of JSON lines, {"t": "2020-08-01 12:00:00.123+00:00", "body": "0100..."}, which can be
+# written from a database with --export, or gzipped, as compactDB.py archives them.
+# Each packet is sent on its own connection, as it was originally received, with the
+# original inter-arrival gaps divided by --speed.
+# With --copies, each packet is also sent with the IMEI rewritten to multiply the fleet.
+
+import argparse
+import logging
+import gzip
+import json
+import queue
+import sqlite3
+import time
+from datetime import datetime
+import MyLogger
+import Partitions
+from loadDrifter import Sender, Stats
+from ParseMessage import headerOffset, getIMEI
+
+def setIMEI(msg:bytes, IMEI:str) -> bytes:
+    """ Replace the IMEI in the MO header """
+    offset = headerOffset(msg)
+    if offset is None: return msg
+    a = bytearray(msg)
+    a[(offset+7):(offset+22)] = bytes(IMEI, "utf-8")
+    return bytes(a)
+
+def mkIMEI(iCopy:int, IMEI:str) -> str:
+    """ IMEI for a copy of a beacon, the first copy keeps the original """
+    if (iCopy == 0) or not IMEI.isdigit(): return IMEI
+    return "{:015d}".format((int(IMEI) + iCopy * 10**13) % 10**15)
+
+def mkTime(t) -> datetime:
+    return t if isinstance(t, datetime) else datetime.fromisoformat(str(t))
+
+def fromDB(args:argparse.ArgumentParser):
+    sql = "SELECT t,body FROM " + args.raw
+    criteria = []
+    vals = []
+    if args.tStart is not None:
+        criteria.append("t>=?")
+        vals.append(args.tStart)
+    if args.tEnd is not None:
+        criteria.append("t<=?")
+        vals.append(args.tEnd)
+    if criteria: sql += " WHERE " + " AND ".join(criteria)
+    sql += " ORDER BY t;"
+    for fn in Partitions.files(args.db): # Oldest first
+        with sqlite3.connect(fn) as conn:
+            for (t, body) in conn.execute(sql, vals):
+                yield (mkTime(t), bytes(body))
+
+def fromFile(fn:str):
+    with (gzip.open(fn, "rt") if fn.endswith(".gz") else open(fn, "r")) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line: continue
+            a = json.loads(line)
+            yield (mkTime(a["t"]), bytes.fromhex(a["body"]))
+
+def export(args:argparse.ArgumentParser, logger:logging.Logger) -> None:
+    n = 0
+    with open(args.export, "w") as fp:
+        for (t, body) in fromDB(args):
+            fp.write(json.dumps({"t": str(t), "body": body.hex()}) + "\n")
+            n += 1
+    logger.info("Exported %s packets to %s", n, args.export)
+
+def replay(args:argparse.ArgumentParser, logger:logging.Logger) -> dict:
+    packets = fromDB(args) if args.packets is None else fromFile(args.packets)
+    q = queue.Queue(maxsize=args.connections * 2)
+    stats = Stats()
+    senders = []
+    for i in range(args.connections):
+        senders.append(Sender("Sender({})".format(i), args, logger, q, stats))
+    for thr in senders:
+        thr.start()
+
+    t0 = time.monotonic()
+    tFirst = None
+    nPackets = 0
+    for (t, body) in packets:
+        if tFirst is None: tFirst = t
+        if args.speed > 0: # Preserve the gaps, scaled by speed
+            dt = t0 + (t - tFirst).total_seconds() / args.speed - time.monotonic()
+            if dt > 0: time.sleep(dt)
+        IMEI = getIMEI(body) if args.copies > 1 else None
+        for iCopy in range(args.copies):
+            msg = body if IMEI is None else setIMEI(body, mkIMEI(iCopy, IMEI))
+            q.put((msg, False))
+        nPackets += 1
+
+    q.join()
+    dt = time.monotonic() - t0
+    info = stats.snapshot()
+    logger.info("Replayed %s packets x %s copies in %.2f seconds, sent=%s errors=%s rate=%.1f/s",
+            nPackets, args.copies, dt, info["sent"], info["errors"], info["sent"] / max(dt, 1e-9))
+    return info
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured DirectIP packets")
+    grp = parser.add_mutually_exclusive_group(required=True)
+    grp.add_argument("--db", type=str, metavar="filename", help="GSatMicroListener database")
+    grp.add_argument("--packets", type=str, metavar="filename", help="Packet file to replay")
+    grp = parser.add_argument_group(description="Replay options")
+    grp.add_argument("--raw", type=str, default="Raw", metavar="name",
+            help="Table name for raw packets")
+    grp.add_argument("--tStart", type=str, metavar="timestamp", help="Earliest packet to replay")
+    grp.add_argument("--tEnd", type=str, metavar="timestamp", help="Latest packet to replay")
+    grp.add_argument("--export", type=str, metavar="filename",
+            help="Write the packets from --db to this packet file instead of replaying them")
+    grp.add_argument("--hostname", type=str, default="localhost", metavar="host",
+            help="Host to send packets to")
+    grp.add_argument("--portForward", type=int, metavar="port", help="Port to send packets to")
+    grp.add_argument("--speed", type=float, default=1, metavar="factor",
+            help="Speed up factor, 1 for real time, 0 for as fast as possible")
+    grp.add_argument("--copies", type=int, default=1, metavar="count",
+            help="Send each packet this many times with rewritten IMEIs")
+    grp.add_argument("--connections", type=int, default=10, metavar="count",
+            help="Number of concurrent connections")
+    grp.add_argument("--timeout", type=float, default=30, metavar="seconds",
+            help="Socket timeout")
+    MyLogger.addArgs(parser)
+    args = parser.parse_args()
+    logger = MyLogger.mkLogger(args)
+
+    if args.export is not None:
+        if args.db is None: parser.error("--export requires --db")
+        export(args, logger)
+    else:
+        if args.portForward is None: parser.error("--portForward is required to replay")
+        replay(args, logger)